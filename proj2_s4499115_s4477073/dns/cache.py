@@ -8,15 +8,39 @@ class and a function for converting ResourceRecords from and to JSON strings.
 It is highly recommended to use these.
 """
 
+import fcntl
+import heapq
 import json
+import os
+import random
+import Queue
+from collections import OrderedDict
 
 from dns.resource import ResourceRecord, RecordData
 from dns.rtypes import Type
 from dns.classes import Class
+from dns.rcodes import RCode
+from dns.files import replace_file
+from dns.snapshot import Snapshot, SnapshotError, write_snapshot
 import dns.consts as Consts
 import threading
 import time
 
+#Rough number of bytes a cached record takes besides its name and rdata
+RECORD_OVERHEAD = 200
+
+#Seconds between checks whether the cache journal has to be compacted
+COMPACT_INTERVAL = 60
+
+#Size in bytes from which the cache journal is compacted into the cache file
+COMPACT_SIZE = 1 << 20
+
+
+def record_size(record):
+    """ Approximate number of bytes a ResourceRecord takes in memory """
+    return RECORD_OVERHEAD + len(record.name) + len(str(record.rdata.data))
+
+
 class ResourceEncoder(json.JSONEncoder):
     """ Conver ResourceRecord to JSON
     
@@ -51,29 +75,752 @@ def resource_from_json(dct):
     return ResourceRecord(name, type_, class_, ttl, rdata, timestamp)
 
 
-class RecordCache(object):
-    """ Cache for ResourceRecords """
+class CacheJournal(object):
+    """ Append-only journal of the records added to a cache
+
+    Every record is appended as a line of JSON with a single write to a file
+    opened in append mode, so several processes can share the journal. A
+    compaction first rotates the journal: it takes an exclusive lock on the
+    journal, appends take a shared lock, moves the records to the rotated
+    journal and empties the journal. Appends are only blocked while the
+    records are moved; the rotated journal is then folded into the snapshot
+    and removed. The exclusive lock is taken on a file descriptor of its own,
+    so it also excludes appends of threads of the same process. Compactions
+    are serialized with a lock on a separate lock file.
+    """
+
+    def __init__(self, journal_file):
+        """ Open the journal
+
+        Args:
+            journal_file (str): file the records are appended to
+        """
+        self.journal_file = journal_file
+        self.rotated_file = journal_file + ".old"
+        self.lock_file = journal_file + ".lock"
+        self.fd = os.open(journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.lock_fd = None
+
+    def append(self, record):
+        """ Append a record to the journal """
+        line = json.dumps(record, cls=ResourceEncoder) + "\n"
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            os.write(self.fd, line)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def replay(self):
+        """ Get the records in the journal, and in the rotated journal of a compaction that did not finish """
+        records = []
+        for filename in [self.rotated_file, self.journal_file]:
+            if not os.path.exists(filename):
+                continue
+            try:
+                with open(filename) as infile:
+                    for line in infile:
+                        try:
+                            records.append(resource_from_json(json.loads(line)))
+                        except (ValueError, KeyError):#Torn write of a crashed process
+                            continue
+            except IOError as e:
+                print("An error has occured while replaying the cache journal: " + str(e))
+        return records
+
+    def length(self):
+        """ Size of the journal in bytes """
+        return os.fstat(self.fd).st_size
+
+    def lock(self):
+        """ Block appends (of all processes and threads) """
+        self.lock_fd = os.open(self.journal_file, os.O_WRONLY)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+
+    def unlock(self):
+        """ Allow appends again """
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+    def truncate(self):
+        """ Remove all records from the journal, call with the lock held """
+        os.ftruncate(self.lock_fd, 0)
+
+    def rotate(self):
+        """ Move the records to the rotated journal and empty the journal
+
+        The records are appended to the rotated journal, so the records of a
+        compaction that did not finish are kept.
+        """
+        self.lock()
+        try:
+            with open(self.journal_file, "rb") as infile:
+                data = infile.read()
+            if data:
+                with open(self.rotated_file, "ab") as outfile:
+                    outfile.write(data)
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+            self.truncate()
+        finally:
+            self.unlock()
+
+    def remove_rotated(self):
+        """ Remove the rotated journal once its records are in the snapshot """
+        try:
+            os.remove(self.rotated_file)
+        except OSError:
+            pass
+
+    def lock_compaction(self):
+        """ Block compactions of other processes and threads, appends are not blocked
+
+        Returns:
+            the file descriptor of the lock, to be passed to unlock_compaction
+        """
+        fd = os.open(self.lock_file, os.O_WRONLY | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def unlock_compaction(self, fd):
+        """ Allow compactions again """
+        os.close(fd)
+
+    def sync(self):
+        """ Make sure the journal is on disk """
+        os.fsync(self.fd)
+
+    def close(self):
+        """ Close the journal """
+        self.sync()
+        os.close(self.fd)
+
+
+class DelegationCache(object):
+    """ Cache of zone cuts and the addresses of their nameservers
+
+    The resolver uses it to start resolving a name at the nameservers of the
+    closest enclosing zone it knows of, instead of at the root servers.
+    """
 
     def __init__(self):
+        """ Initialize the DelegationCache """
+        self.cuts = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_subdomain(dname, zone):
+        """ Check if a domain name is in (or equal to) a zone """
+        dname = dname.lower().rstrip('.')
+        zone = zone.lower().rstrip('.')
+        return zone == "" or dname == zone or dname.endswith("." + zone)
+
+    def add(self, zone, addresses, ttl):
+        """ Add the nameservers of a zone cut
+
+        Args:
+            zone (str): domain name of the zone
+            addresses ([str]): IP addresses of the nameservers of the zone
+            ttl (int): seconds for which the delegation may be cached
+        """
+        self.lock.acquire()
+        self.cuts[zone.lower().rstrip('.')] = (int(time.time()) + ttl, list(addresses))
+        self.lock.release()
+
+    def closest(self, dname):
+        """ Find the deepest cached zone cut that encloses a domain name
+
+        Args:
+            dname (str): domain name
+
+        Returns:
+            (zone, addresses) of the closest zone cut, None if none is cached
+        """
+        curTime = int(time.time())
+        labels = dname.lower().rstrip('.').split('.')
+        for i in range(len(labels)):
+            zone = '.'.join(labels[i:])
+            cut = self.cuts.get(zone)
+            if cut is None:
+                continue
+            if cut[0] > curTime:
+                return zone, list(cut[1])
+            self.lock.acquire()
+            if self.cuts.get(zone) is cut:#Expired, unless it was just replaced
+                del self.cuts[zone]
+            self.lock.release()
+        return None
+
+
+class InfraCache(object):
+    """ Smoothed round trip times of nameservers
+
+    Per nameserver a smoothed RTT and RTT variance are kept, as in TCP (RFC
+    6298) and as BIND and Unbound do for nameservers. They are used to pick
+    the nameserver that is expected to respond first, and to derive how long
+    to wait for a nameserver. A nameserver that times out gets its RTT doubled.
+    """
+
+    #Expected RTT in seconds of a nameserver that has not been asked yet
+    UNKNOWN_RTT = 0.376
+
+    #Shortest timeout in seconds for any nameserver
+    MIN_TIMEOUT = 0.05
+
+    #Chance that another nameserver than the fastest is picked first
+    EXPLORATION = 0.05
+
+    def __init__(self, max_timeout, exploration=EXPLORATION):
+        """ Initialize the InfraCache
+
+        Args:
+            max_timeout (float): longest timeout in seconds for any nameserver
+            exploration (float): chance that not the fastest nameserver is
+                picked first, so the RTTs of the others stay up to date
+        """
+        self.max_timeout = max_timeout
+        self.exploration = exploration
+        self.servers = {}
+        self.lock = threading.Lock()
+
+    def rtt(self, server):
+        """ Get the smoothed RTT of a nameserver """
+        entry = self.servers.get(server)
+        return entry[0] if entry is not None else InfraCache.UNKNOWN_RTT
+
+    def timeout(self, server):
+        """ Get the time to wait for a response of a nameserver
+
+        Returns:
+            the smoothed RTT plus four times the RTT variance, bounded by
+            MIN_TIMEOUT and max_timeout
+        """
+        entry = self.servers.get(server)
+        if entry is None:
+            timeout = 2 * InfraCache.UNKNOWN_RTT
+        else:
+            timeout = entry[0] + 4 * entry[1]
+        return min(max(timeout, InfraCache.MIN_TIMEOUT), self.max_timeout)
+
+    def add_rtt(self, server, rtt):
+        """ Add a measured round trip time of a nameserver
+
+        Args:
+            server (str): address of the nameserver
+            rtt (float): seconds between sending the query and the response
+        """
+        self.lock.acquire()
+        entry = self.servers.get(server)
+        if entry is None:
+            self.servers[server] = (rtt, rtt / 2)
+        else:
+            srtt, rttvar = entry
+            rttvar = 0.75 * rttvar + 0.25 * abs(srtt - rtt)
+            srtt = 0.875 * srtt + 0.125 * rtt
+            self.servers[server] = (srtt, rttvar)
+        self.lock.release()
+
+    def add_timeout(self, server):
+        """ Register that a nameserver did not respond in time """
+        self.lock.acquire()
+        srtt, rttvar = self.servers.get(server, (InfraCache.UNKNOWN_RTT, InfraCache.UNKNOWN_RTT / 2))
+        self.servers[server] = (min(2 * srtt, self.max_timeout), rttvar)
+        self.lock.release()
+
+    def order(self, servers):
+        """ Sort nameservers by their expected RTT, fastest first
+
+        With a small chance another nameserver is put first, so that the RTTs
+        of slower nameservers are measured again once in a while.
+
+        Args:
+            servers ([str]): addresses of the nameservers
+        """
+        servers = sorted(servers, key=self.rtt)
+        if len(servers) > 1 and random.random() < self.exploration:
+            i = random.randint(1, len(servers) - 1)
+            servers[0], servers[i] = servers[i], servers[0]
+        return servers
+
+
+class PrefetchQueue(object):
+    """ A bounded queue of keys to refresh, worked off by a few threads
+
+    The threads are started when the first key is submitted. When the queue
+    is full a refresh is dropped, the key is then refreshed on a later hit or
+    resolved again once it has expired.
+    """
+
+    #Number of threads that refresh keys
+    WORKERS = 2
+
+    #Number of keys that can wait to be refreshed
+    SIZE = 256
+
+    def __init__(self, prefetcher, workers=WORKERS, size=SIZE):
+        """ Initialize the queue
+
+        Args:
+            prefetcher (function): called with (dname, type_, class_),
+                expected to add fresh records to the cache
+            workers (int): number of threads that refresh keys
+            size (int): maximum number of keys waiting to be refreshed
+        """
+        self.prefetcher = prefetcher
+        self.workers = workers
+        self.queue = Queue.Queue(size)
+        self.started = False
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def work(self):
+        """ Refresh the submitted keys, run by the worker threads """
+        while True:
+            dname, type_, class_, done = self.queue.get()
+            try:
+                self.prefetcher(dname, type_, class_)
+            except Exception as e:
+                print("An error has occured while prefetching " + dname + ": " + str(e))
+            finally:
+                done()
+
+    def submit(self, dname, type_, class_, done):
+        """ Queue a key to be refreshed
+
+        Args:
+            done (function): called without arguments once the refresh has run
+
+        Returns:
+            False if the queue was full and the key is not refreshed
+        """
+        with self.lock:
+            if not self.started:
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self.work)
+                    thread.daemon = True
+                    thread.start()
+                self.started = True
+        try:
+            self.queue.put_nowait((dname, type_, class_, done))
+            return True
+        except Queue.Full:
+            self.dropped += 1
+            return False
+
+
+class PersistentCache(object):
+    """ Persistence of a record cache
+
+    The base of RecordCache and ShardedRecordCache. It reads and writes the
+    cache file, as JSON or as a memory-mapped binary snapshot (see
+    dns.snapshot), and keeps the journal. The records themselves are kept by
+    the subclass, which provides clear, insert, cleanup and memory_records.
+    """
+
+    FORMATS = ["json", "binary"]
+
+    def __init__(self, cache_file, journal_file, cache_format):
+        """ Initialize the persistence, the cache file is read by read_cache_file
+
+        Args:
+            cache_file (str): file the cache is read from and written to,
+                the cache is not persisted if None
+            journal_file (str): file every added record is appended to, the
+                cache file is then a snapshot that the journal is compacted into
+            cache_format (str): format of the cache file, "json" or "binary"
+        """
+        if cache_format not in PersistentCache.FORMATS:
+            raise ValueError("unknown cache format: " + str(cache_format))
+        self.cache_format = cache_format
+        self.snapshot = None
+        self.loaded = set()
+        self.cache_file = cache_file
+        self.journal = None
+        if cache_file is not None and journal_file is not None:
+            self.journal = CacheJournal(journal_file)
+        #Held while the journal is used, so save can not close it under a compaction or append
+        self.journal_lock = threading.RLock()
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def key(dname, type_, class_):
+        """ Key of the records with a domain name, type and class """
+        return (dname.lower(), type_, class_)
+
+    @staticmethod
+    def expires(record):
+        """ Epoch time at which the TTL of a record runs out """
+        return record.ttl + record.timestamp
+
+    def all_records(self):
+        """ Get all records in the cache, including those still in the snapshot """
+        records = self.memory_records()
+        snapshot = self.snapshot
+        if snapshot is not None:
+            curTime = int(time.time())
+            records += [record for record in snapshot if self.expires(record) > curTime and \
+                    self.key(record.name, record.type_, record.class_) not in self.loaded]
+        return records
+
+    def load_from_snapshot(self, dname, type_, class_):
+        """ Add the records of a key from the snapshot, the first time it is looked up """
+        key = self.key(dname, type_, class_)
+        snapshot = self.snapshot
+        if snapshot is None or key in self.loaded:
+            return
+
+        curTime = int(time.time())
+        found = [record for record in snapshot.lookup(dname, type_, class_) if self.expires(record) > curTime]
+        if found:
+            #Once loaded the key is never loaded again, also not after it has been evicted
+            self.loaded.add(key)
+            for record in found:
+                self.insert(record)
+
+    def add_record(self, new_rec):
+        """ Add a new Record to the cache
+        
+        Args:
+            record (ResourceRecord): the record added to the cache
+        """
+
+        self.insert(new_rec)
+        with self.journal_lock:
+            if self.journal is not None:
+                self.journal.append(new_rec)
+
+    def open_snapshot(self):
+        """ Memory-map the binary cache file """
+        self.snapshot = None
+        self.loaded = set()
+        try:
+            self.snapshot = Snapshot(self.cache_file)
+        except (IOError, SnapshotError) as e:
+            print("An error has occured while loading cache from disk: " + str(e))
+
+    def read_cache_file(self):
+        """ Read the cache file from disk """
+        #Empty current cache
+        self.clear()
+        if self.cache_file is None:
+            return
+
+        if self.cache_format == "binary":
+            self.open_snapshot()
+            if self.journal is not None:
+                self.replay_journal()
+            return
+
+        #Load from file
+        try:
+            with open(self.cache_file) as infile:
+                data = infile.read()
+                curTime = int(time.time())
+                
+                recordlist = json.loads(data, object_hook=resource_from_json)
+
+                #Don't add the entries whose TTL is expired
+                #Save all entries together with the time from which the TTL counts
+                for entry in recordlist:
+                    if self.expires(entry) > curTime:
+                        self.insert(entry)
+
+        except (ValueError, IOError) as e:
+            print("An error has occured while loading cache from disk: " + str(e))
+            self.clear()
+            with open(self.cache_file, 'w') as outfile:
+                outfile.write(json.dumps([], cls=ResourceEncoder, indent=4))
+
+        #Replay the records added since the snapshot was written
+        if self.journal is not None:
+            self.replay_journal()
+
+    def merge_cache_file(self):
+        """ Add the records of the cache file on disk to the cache """
+        try:
+            if self.cache_format == "binary":
+                recordlist = list(Snapshot(self.cache_file))
+            else:
+                with open(self.cache_file) as infile:
+                    recordlist = json.loads(infile.read(), object_hook=resource_from_json)
+        except (ValueError, IOError, SnapshotError) as e:
+            print("An error has occured while merging cache from disk: " + str(e))
+            return
+
+        curTime = int(time.time())
+        for record in recordlist:
+            if self.expires(record) > curTime:
+                self.insert(record)
+
+    def replay_journal(self):
+        """ Add the records in the journal to the cache """
+        curTime = int(time.time())
+        for record in self.journal.replay():
+            if self.expires(record) > curTime:
+                self.insert(record)
+
+    def write_cache_file(self, merge=False):
+        """ Write the cache file to disk
+
+        Args:
+            merge (bool): first add the records of the cache file on disk,
+                used when several processes share the cache file
+        """
+        if self.cache_file is None:
+            return
+        if merge:
+            self.merge_cache_file()
+        self.cleanup()
+        
+        if self.cache_format == "binary":
+            try:
+                write_snapshot(self.cache_file, self.all_records())
+            except (IOError, OSError) as e:
+                print("An error has occured while writing cache to disk: " + str(e))
+                return
+            #Every record is in the new snapshot, the keys in memory must not be loaded from it
+            loaded = set(self.key(r.name, r.type_, r.class_) for r in self.memory_records())
+            self.snapshot = Snapshot(self.cache_file)
+            self.loaded = loaded
+            return
+
+        self.export_json(self.cache_file)
+
+    def export_json(self, filename):
+        """ Write the cache as human-readable JSON
+
+        Args:
+            filename (str): the file to write to
+        """
+        #Write to a temporary file first, a crash must not leave half a cache file
+        try:
+            replace_file(filename, [json.dumps(self.all_records(), cls=ResourceEncoder, indent=4)])
+        except (IOError, OSError) as e:
+            print("An error has occured while writing cache to disk: " + str(e))
+
+    def compact(self):
+        """ Fold the journal into the cache file and empty the journal """
+        journal = self.journal
+        if journal is None:
+            return
+        fd = journal.lock_compaction()
+        try:
+            #Appends only wait for the rotation, not for the cache file to be written
+            with self.journal_lock:
+                if self.journal is None:
+                    return
+                journal.rotate()
+            #Other processes sharing the journal can have appended records we don't have, and
+            #they can have compacted records into the cache file that we never had
+            self.replay_journal()
+            self.write_cache_file(merge=True)
+            journal.remove_rotated()
+        finally:
+            journal.unlock_compaction(fd)
+
+    def start_compactor(self, interval=COMPACT_INTERVAL, min_size=COMPACT_SIZE):
+        """ Start a thread that compacts the journal once it has grown large
+
+        Args:
+            interval (int): seconds between checks of the size of the journal
+            min_size (int): size in bytes from which the journal is compacted
+
+        Returns:
+            the thread, which stops when the cache is saved
+        """
+        def compactor():
+            while not self.stopped.wait(interval):
+                with self.journal_lock:
+                    if self.journal is None:
+                        return
+                    size = self.journal.length()
+                if size >= min_size:
+                    self.compact()
+
+        thread = threading.Thread(target=compactor)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def save(self, merge=False):
+        """ Persist the cache
+
+        With a journal every record is already on disk, so only the journal
+        is synced. Otherwise the whole cache file is written.
+
+        Args:
+            merge (bool): keep the records that other processes wrote to the cache file
+        """
+        self.stopped.set()
+        with self.journal_lock:
+            journal, self.journal = self.journal, None
+            if journal is not None:
+                journal.close()
+        if journal is None:
+            self.write_cache_file(merge)
+
+
+class RecordCache(PersistentCache):
+    """ Cache for ResourceRecords
+
+    The records are stored in a dictionary from (name, type, class) to the
+    list of records with that owner name, type and class, so a lookup does not
+    depend on the size of the cache. A heap of (expiry time, key) pairs makes
+    sure that a cleanup only visits the records whose TTL has expired.
+
+    The cache can be bounded by a number of records and by an approximate
+    number of bytes. When it grows past a bound, all records of a key are
+    evicted at once, the key being chosen by the eviction policy:
+        lru: the least recently used key
+        2q: keys used only once wait in a FIFO probation queue and are
+            evicted first, keys used again are promoted to an LRU queue
+
+    Negative answers (RFC 2308) are kept apart from the records, as the time
+    at which they expire and their RCODE. A NXDOMAIN answer is stored for type
+    ANY, as it holds for every type of the name. Negative answers are not
+    persisted, and a bounded cache keeps at most max_entries of them.
+
+    The cache file is either JSON or a binary snapshot (see dns.snapshot).
+    A binary snapshot is memory-mapped, the records of a key are only added
+    to the cache when the key is first looked up.
+
+    The cache counts the hits of every key. When a key that has been hit
+    before is hit again in the last prefetch_fraction of the TTL of its
+    records, it is put on a PrefetchQueue (see set_prefetcher) to be resolved
+    again by a background thread, while the records are still served. At most
+    one refresh per key is waiting or in progress.
+
+    With a stale window (RFC 8767) records are kept for stale_window seconds
+    after their TTL has run out. lookup does not return them, but lookup_stale
+    does, so an answer can still be given when the records can not be
+    resolved again.
+    """
+
+    POLICIES = ["lru", "2q"]
+
+    #Share of the keys that the probation queue of 2q may hold
+    PROBATION_SHARE = 0.25
+
+    #Number of hits after which a key is refreshed before it expires
+    PREFETCH_HITS = 2
+
+    #TTL of records that are served after their TTL has run out
+    STALE_TTL = 30
+
+    def __init__(self, cache_file=Consts.CACHE_FILE, max_entries=0, max_bytes=0, policy="lru", journal_file=None,
+            cache_format="json", prefetch_fraction=0.1, stale_window=0):
         """ Initialize the RecordCache
         
         Args:
-            ttl (int): TTL of cached entries (if > 0)
+            cache_file (str): file the cache is read from and written to,
+                the cache is not persisted if None
+            max_entries (int): maximum number of records (if > 0)
+            max_bytes (int): approximate maximum size in bytes (if > 0)
+            policy (str): eviction policy, "lru" or "2q"
+            journal_file (str): file every added record is appended to, the
+                cache file is then a snapshot that the journal is compacted into
+            cache_format (str): format of the cache file, "json" or "binary"
+            prefetch_fraction (float): final part of the TTL in which a hit
+                refreshes a popular key, 0 disables prefetching
+            stale_window (int): seconds that records are kept after their
+                TTL has run out, to be served by lookup_stale
         """
-        self.records = []
+        if policy not in RecordCache.POLICIES:
+            raise ValueError("unknown eviction policy: " + str(policy))
+        PersistentCache.__init__(self, cache_file, journal_file, cache_format)
+        self.records = {}
+        self.expiry = []
+        self.negatives = OrderedDict()
+        self.negative_expiry = []
         self.lock = threading.Lock()
 
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = 0
+        self.size = 0
+        self.evictions = 0
+        self.probation = OrderedDict()
+        self.recent = OrderedDict()
+        self.hits = {}
+        self.prefetch_fraction = prefetch_fraction
+        self.prefetcher = None
+        self.prefetching = set()
+        self.prefetches = 0
+        self.stale_window = stale_window
+
         #Lees de cache in, update de ttls, gooi alle invalid data weg
         self.read_cache_file()
         self.lastCleanup = time.time()
-    
+
+    def memory_records(self):
+        """ Get all records that have been added to the cache """
+        return [record for recordlist in self.records.values() for record in recordlist]
+
+    def touch(self, key):
+        """ Mark a key as used for the eviction policy """
+        if key in self.recent:
+            self.recent[key] = self.recent.pop(key)
+        elif key in self.probation and self.policy == "2q":#Used again, promote it
+            del self.probation[key]
+            self.recent[key] = None
+        elif key not in self.probation:
+            if self.policy == "2q":
+                self.probation[key] = None
+            else:
+                self.recent[key] = None
+
+    def remove(self, key, recordlist):
+        """ Remove records of a key, and the key itself when none are left """
+        self.entries -= len(recordlist)
+        self.size -= sum(record_size(record) for record in recordlist)
+        remaining = [record for record in self.records[key] if record not in recordlist]
+        if remaining:
+            self.records[key] = remaining
+            return
+        del self.records[key]
+        self.probation.pop(key, None)
+        self.recent.pop(key, None)
+        self.hits.pop(key, None)
+
+    def bounded(self):
+        """ Check if the cache has a bound on its size """
+        return self.max_entries > 0 or self.max_bytes > 0
+
+    def over_budget(self):
+        """ Check if the cache has grown past one of its bounds """
+        return (self.max_entries > 0 and self.entries > self.max_entries) or \
+                (self.max_bytes > 0 and self.size > self.max_bytes)
+
+    def evict(self):
+        """ Evict keys chosen by the eviction policy until the cache fits its bounds """
+        while self.over_budget() and (self.probation or self.recent):
+            if self.probation and (not self.recent or \
+                    len(self.probation) > RecordCache.PROBATION_SHARE * len(self.records)):
+                key = next(iter(self.probation))
+            else:
+                key = next(iter(self.recent))
+            self.remove(key, self.records[key])
+            self.evictions += 1
+
     def cleanup(self):
-        """ Remove all entries in the cache whose TTL has expired """
+        """ Remove all entries in the cache whose TTL (and stale window) has expired """
 
         #gooi de entries weg met ttl <=0
         self.lock.acquire()
         curTime = int(time.time())
-        self.records = [record for record in self.records if record.ttl + record.timestamp > curTime]
+        staleTime = curTime - self.stale_window
+        while self.expiry and self.expiry[0][0] <= staleTime:
+            _, key = heapq.heappop(self.expiry)
+            if key not in self.records:#Already removed by an earlier heap entry or evicted
+                continue
+            #The TTL of a record can have been extended since this entry was pushed
+            expired = [record for record in self.records[key] if self.expires(record) <= staleTime]
+            if expired:
+                self.remove(key, expired)
+        while self.negative_expiry and self.negative_expiry[0][0] <= curTime:
+            _, key = heapq.heappop(self.negative_expiry)
+            if key in self.negatives and self.negatives[key][0] <= curTime:
+                del self.negatives[key]
         self.lock.release()
 
         self.lastCleanup = curTime
@@ -92,68 +839,280 @@ class RecordCache(object):
 
         if (int(time.time()) - self.lastCleanup >= 3600): #Cache al een uur lang niet gecleaned
             self.cleanup()
+        self.load_from_snapshot(dname, type_, class_)
 
-        foundrecords = [record for record in self.records \
-                if record.name == dname and record.type_ == type_ and record.class_ == class_ \
-                and record.ttl > time.time()]
-        
-        #Verschuif de ttl en timestamp naar nu
+        key = self.key(dname, type_, class_)
         curTime = int(time.time())
-        for record in foundrecords:
-            record.ttl = int(record.ttl - (curTime - record.timestamp))
-            record.timestamp = curTime
+        foundrecords = [record for record in self.records.get(key, []) \
+                if self.expires(record) > curTime]
+        if foundrecords:
+            self.count_hit(key, dname, type_, class_, foundrecords, curTime)
+        
+        #Verschuif de ttl en timestamp naar nu, in kopieen zodat de records in de cache niet veranderen
+        foundrecords = [ResourceRecord(record.name, record.type_, record.class_, \
+                self.expires(record) - curTime, record.rdata, curTime) for record in foundrecords]
+
+        #Only a bounded cache has to keep track of use, an unbounded cache is read without locking
+        if foundrecords and self.bounded():
+            self.lock.acquire()
+            if key in self.records:
+                self.touch(key)
+            self.lock.release()
             
         return foundrecords
-        
-    def add_record(self, new_rec):
-        """ Add a new Record to the cache
-        
+
+    def lookup_stale(self, dname, type_, class_):
+        """ Lookup resource records whose TTL has run out within the stale window
+
         Args:
-            record (ResourceRecord): the record added to the cache
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+
+        Returns:
+            copies of the stale records with a TTL of STALE_TTL
+        """
+        key = self.key(dname, type_, class_)
+        curTime = int(time.time())
+        return [ResourceRecord(record.name, record.type_, record.class_, RecordCache.STALE_TTL, \
+                record.rdata, curTime) for record in self.records.get(key, []) \
+                if self.expires(record) <= curTime < self.expires(record) + self.stale_window]
+
+    def count_hit(self, key, dname, type_, class_, records, curTime):
+        """ Count a hit of a key and refresh the key if it is popular and about to expire """
+        #Hit counts are approximate, they are counted without the lock
+        hits = self.hits.get(key, 0) + 1
+        self.hits[key] = hits
+        if hits < RecordCache.PREFETCH_HITS or self.prefetcher is None or self.prefetch_fraction <= 0:
+            return
+        if any(self.expires(record) - curTime <= record.ttl * self.prefetch_fraction for record in records):
+            self.prefetch(key, dname, type_, class_)
+
+    def hit_count(self, dname, type_, class_):
+        """ Get the number of hits of the records with a domain name, type and class """
+        return self.hits.get(self.key(dname, type_, class_), 0)
+
+    def set_prefetcher(self, prefetcher):
+        """ Set the function that refreshes popular keys before they expire
+
+        Args:
+            prefetcher (function): called with (dname, type_, class_) in a
+                background thread, expected to add fresh records to the cache
         """
+        self.set_prefetch_queue(PrefetchQueue(prefetcher))
 
+    def set_prefetch_queue(self, queue):
+        """ Set the PrefetchQueue that popular keys are refreshed through """
+        self.prefetcher = queue
+
+    def prefetch(self, key, dname, type_, class_):
+        """ Refresh a key in the background, unless a refresh of the key is in progress """
         self.lock.acquire()
-        found = self.lookup(new_rec.name, new_rec.type_, new_rec.class_)
-        if found:
-            for record in self.records:#Het zou er maar 1 mogen zijn, maar bij een foute json-file kunnen het er meerdere zijn
-                if (record.ttl + record.timestamp < new_rec.ttl + new_rec.timestamp):
-                    record.ttl = new_rec.ttl
-                    record.timestamp = new_rec.timestamp
-        else:
-            self.records.append(new_rec)
+        busy = key in self.prefetching
+        self.prefetching.add(key)
         self.lock.release()
+        if busy:
+            return
 
-    def read_cache_file(self, cache_file=Consts.CACHE_FILE):
-        """ Read the cache file from disk """
-        #Empty current cache
-        self.records = []
+        def done():
+            self.lock.acquire()
+            self.prefetching.discard(key)
+            self.lock.release()
 
-        #Load from file
-        try:
-            with open(cache_file) as infile:
-                data = infile.read()
-                curTime = int(time.time())
-                
-                recordlist = json.loads(data, object_hook=resource_from_json)
+        if self.prefetcher.submit(dname, type_, class_, done):
+            self.prefetches += 1
+        else:
+            done()
 
-                #Don't add the entries whose TTL is expired
-                recordlist = [entry for entry in recordlist if entry.ttl + entry.timestamp > curTime]
+    def add_negative(self, dname, type_, class_, rcode, ttl):
+        """ Add a negative answer to the cache
 
-                #Save all entries together with the time from which the TTL counts
-                self.records = recordlist
+        Args:
+            dname (str): domain name
+            type_ (Type): type, ignored for NXDOMAIN
+            class_ (Class): class
+            rcode (RCode): NXDomain, or NoError for NODATA
+            ttl (int): seconds for which the answer may be cached
+        """
+        if rcode == RCode.NXDomain:
+            type_ = Type.ANY
+        key = self.key(dname, type_, class_)
+        expires = int(time.time()) + ttl
 
-        except (ValueError, IOError) as e:
-            print("An error has occured while loading cache from disk: " + str(e))
-            self.records = []
-            with open(cache_file, 'w') as outfile:
-                outfile.write(json.dumps(self.records, cls=ResourceEncoder, indent=4))
+        self.lock.acquire()
+        self.negatives.pop(key, None)
+        self.negatives[key] = (expires, rcode)
+        heapq.heappush(self.negative_expiry, (expires, key))
+        while self.max_entries > 0 and len(self.negatives) > self.max_entries:
+            self.negatives.popitem(last=False)
+            self.evictions += 1
+        self.lock.release()
 
-    def write_cache_file(self):
-        """ Write the cache file to disk """
-        self.cleanup()
+    def lookup_negative(self, dname, type_, class_):
+        """ Lookup a negative answer in the cache
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+
+        Returns:
+            the RCODE of the negative answer (NXDomain or NoError for NODATA),
+            None if the cache holds no negative answer
+        """
+        curTime = int(time.time())
+        for key in [self.key(dname, Type.ANY, class_), self.key(dname, type_, class_)]:
+            negative = self.negatives.get(key)
+            if negative is not None and negative[0] > curTime:
+                return negative[1]
+        return None
+
+    def store(self, new_rec):
+        """ Store a record, extending the TTL of an equal record in the cache """
+        key = self.key(new_rec.name, new_rec.type_, new_rec.class_)
+
+        #A positive answer overrules cached negative answers for the name
+        self.negatives.pop(key, None)
+        self.negatives.pop(self.key(new_rec.name, Type.ANY, new_rec.class_), None)
+        recordlist = self.records.setdefault(key, [])
+        for i, record in enumerate(recordlist):
+            if record.rdata.data == new_rec.rdata.data:
+                if self.expires(record) < self.expires(new_rec):
+                    #Replace instead of update, a reader without the lock must never see half a change
+                    recordlist[i] = new_rec
+                    self.size += record_size(new_rec) - record_size(record)
+                    heapq.heappush(self.expiry, (self.expires(new_rec), key))
+                self.touch(key)
+                return
+        recordlist.append(new_rec)
+        heapq.heappush(self.expiry, (self.expires(new_rec), key))
+        self.entries += 1
+        self.size += record_size(new_rec)
+        self.touch(key)
+        self.evict()
         
-        try:
-            with open(Consts.CACHE_FILE, 'w') as outfile:
-                outfile.write(json.dumps(self.records, cls=ResourceEncoder, indent=4))
-        except IOError as e:
-            print("An error has occured while writing cache to disk: " + str(e))
+    def insert(self, new_rec):
+        """ Add a new Record to the cache without journaling it """
+        self.lock.acquire()
+        self.store(new_rec)
+        self.lock.release()
+        
+    def clear(self):
+        """ Remove all records from the cache """
+        self.records = {}
+        self.expiry = []
+        self.negatives = OrderedDict()
+        self.negative_expiry = []
+        self.probation = OrderedDict()
+        self.recent = OrderedDict()
+        self.hits = {}
+        self.entries = 0
+        self.size = 0
+
+
+
+class ShardedRecordCache(PersistentCache):
+    """ Cache for ResourceRecords, split over independently locked shards
+
+    The owner name of a record decides which shard (a RecordCache without a
+    cache file) holds it, so threads that add records for different names
+    rarely wait for each other. The bounds of the cache are divided evenly
+    over the shards. Persistence works as for a RecordCache.
+
+    The sharded cache is not a RecordCache itself: every method of it routes
+    to the shards or to PersistentCache.
+    """
+
+    def __init__(self, cache_file=Consts.CACHE_FILE, shards=16, max_entries=0, max_bytes=0, policy="lru",
+            journal_file=None, cache_format="json", prefetch_fraction=0.1, stale_window=0):
+        """ Initialize the ShardedRecordCache
+
+        Args:
+            cache_file (str): file the cache is read from and written to,
+                the cache is not persisted if None
+            shards (int): number of shards
+            max_entries (int): maximum number of records (if > 0)
+            max_bytes (int): approximate maximum size in bytes (if > 0)
+            policy (str): eviction policy, "lru" or "2q"
+            journal_file (str): file every added record is appended to
+            cache_format (str): format of the cache file, "json" or "binary"
+            prefetch_fraction (float): final part of the TTL in which a hit
+                refreshes a popular key, 0 disables prefetching
+            stale_window (int): seconds that records are kept after their
+                TTL has run out, to be served by lookup_stale
+        """
+        PersistentCache.__init__(self, cache_file, journal_file, cache_format)
+        self.shards = [RecordCache(None, max_entries // shards, max_bytes // shards, policy,
+                prefetch_fraction=prefetch_fraction, stale_window=stale_window) for _ in range(shards)]
+        self.read_cache_file()
+
+    def shard(self, dname):
+        """ Get the shard that holds the records of a domain name """
+        return self.shards[hash(dname.lower()) % len(self.shards)]
+
+    @property
+    def entries(self):
+        return sum(shard.entries for shard in self.shards)
+
+    @property
+    def size(self):
+        return sum(shard.size for shard in self.shards)
+
+    @property
+    def evictions(self):
+        return sum(shard.evictions for shard in self.shards)
+
+    @property
+    def prefetches(self):
+        return sum(shard.prefetches for shard in self.shards)
+
+    def memory_records(self):
+        """ Get all records that have been added to the cache """
+        return [record for shard in self.shards for record in shard.memory_records()]
+
+    def clear(self):
+        """ Remove all records from the cache """
+        for shard in self.shards:
+            shard.clear()
+
+    def cleanup(self):
+        """ Remove all entries in the cache whose TTL has expired """
+        for shard in self.shards:
+            shard.cleanup()
+
+    def lookup(self, dname, type_, class_):
+        """ Lookup resource records in cache
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+        """
+        self.load_from_snapshot(dname, type_, class_)
+        return self.shard(dname).lookup(dname, type_, class_)
+
+    def lookup_stale(self, dname, type_, class_):
+        """ Lookup stale resource records in the shard of the domain name """
+        return self.shard(dname).lookup_stale(dname, type_, class_)
+
+    def hit_count(self, dname, type_, class_):
+        """ Get the number of hits of the records with a domain name, type and class """
+        return self.shard(dname).hit_count(dname, type_, class_)
+
+    def set_prefetcher(self, prefetcher):
+        """ Set the function that refreshes popular keys of all shards, through one PrefetchQueue """
+        queue = PrefetchQueue(prefetcher)
+        for shard in self.shards:
+            shard.set_prefetch_queue(queue)
+
+    def add_negative(self, dname, type_, class_, rcode, ttl):
+        """ Add a negative answer to the shard of the domain name """
+        self.shard(dname).add_negative(dname, type_, class_, rcode, ttl)
+
+    def lookup_negative(self, dname, type_, class_):
+        """ Lookup a negative answer in the shard of the domain name """
+        return self.shard(dname).lookup_negative(dname, type_, class_)
+
+    def insert(self, new_rec):
+        """ Add a new Record to its shard without journaling it """
+        self.shard(new_rec.name).insert(new_rec)
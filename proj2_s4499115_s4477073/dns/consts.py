@@ -18,5 +18,12 @@ ROOT_SERVERS = [
 #Relative path to the cache file's location on disk
 CACHE_FILE = "cache.json"
 
+#Relative path to the binary cache snapshot's location on disk
+SNAPSHOT_FILE = "cache.bin"
+
+#Relative path to the cache journal's location on disk
+JOURNAL_FILE = "cache.journal"
+
 #Relative path to the zone file's location on disk
 ZONE_FILE = "zone.txt"
+ZONE_IMAGE = "zone.img"
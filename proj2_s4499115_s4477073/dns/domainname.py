@@ -56,58 +56,104 @@ class Composer(object):
         return result
 
 
+class ParseError(Exception):
+    """ The packet is not a valid DNS message """
+    pass
+
+
 class Parser(object):
-    def __init__(self):
-        self.labels = dict()
+    """ Reads domain names from a packet
 
-    def from_bytes(self, packet, offset, num):
-        begin_offset = offset
-        dnames = []
+    Labels are sliced from the packet and compression pointers are followed
+    in place. The name from every label that was read is remembered by its
+    offset, so a pointer to a name that was read before costs one lookup. A
+    pointer has to point before the pointer that was followed last, which
+    rules out pointer loops, and every length is checked against the end of
+    the packet. A parser reads the names of one packet.
+    """
 
-        # Read the domain names
-        for i in range(num):
-            # Read a new domain name
-            dname = ""
-            prev_offsets = []
-            done = False
-            while done is False:
-                # Read length of next label
-                llength = struct.unpack_from("!B", packet, offset)[0]
-
-                # Done reading domain when length is zero
-                if llength == 0:
-                    offset += 1
-                    break
-                
-                # Compression label
-                elif (llength >> 6) == 3:
-                    new_offset = offset + 2
-                    target = struct.unpack_from("!H", packet, offset)[0]
-                    target -= 3 << 14
-                    label = self.labels[target]
-                    done = True
-
-                # Normal label
-                else:
-                    new_offset = offset + llength + 1
-                    label = struct.unpack_from("{}s".format(llength),
-                            packet, offset+1)[0]
+    #Maximum length of a domain name, without the trailing dot
+    MAX_LENGTH = 253
 
-                # Add label to dictionary
-                self.labels[offset] = label
-                for prev_offset in prev_offsets:
-                    self.labels[prev_offset] += "." + label
-                prev_offsets.append(offset)
+    POINTER = struct.Struct("!H")
 
-                # Update offset
-                offset = new_offset
+    def __init__(self):
+        self.names = dict()
+
+    def from_bytes(self, packet, offset, num):
+        """ Read a number of consecutive domain names
 
-                # Append label to domain name
-                if len(dname) > 0:
-                    dname += "."
-                dname += label
+        Args:
+            packet (bytes): the packet, or another buffer such as an mmap
+            offset (int): offset of the first name
+            num (int): number of names
 
-            # Append domain name to list
+        Returns:
+            (dnames, offset): the names and the offset after the last one
+        """
+        dnames = []
+        for _ in range(num):
+            dname, offset = self.read_name(packet, offset)
             dnames.append(dname)
-        
         return dnames, offset
+
+    def read_name(self, packet, offset):
+        """ Read a domain name
+
+        Args:
+            packet (bytes): the packet
+            offset (int): offset of the name
+
+        Returns:
+            (dname, offset): the name and the offset after it
+        """
+        size = len(packet)
+        names = self.names
+        labels = []
+        offsets = []
+        suffix = None
+        end = None
+        limit = offset
+        while True:
+            if offset >= size:
+                raise ParseError("domain name runs past the end of the packet")
+            llength = ord(packet[offset])
+
+            # Done reading domain when length is zero
+            if llength == 0:
+                if end is None:
+                    end = offset + 1
+                break
+
+            # Compression label, must point back to stop loops
+            if llength >= 0xC0:
+                if offset + 2 > size:
+                    raise ParseError("compression pointer runs past the end of the packet")
+                target = self.POINTER.unpack_from(packet, offset)[0] & 0x3FFF
+                if target >= limit:
+                    raise ParseError("compression pointer does not point back")
+                if end is None:
+                    end = offset + 2
+                if target in names:
+                    suffix = names[target]
+                    break
+                offset = limit = target
+                continue
+
+            if llength > 63:
+                raise ParseError("unsupported label type")
+
+            # Normal label
+            if offset + 1 + llength > size:
+                raise ParseError("label runs past the end of the packet")
+            labels.append(packet[offset+1:offset+1+llength])
+            offsets.append(offset)
+            offset += 1 + llength
+
+        # Remember the name from every label that was read
+        for i in range(len(labels) - 1, -1, -1):
+            suffix = labels[i] + "." + suffix if suffix else labels[i]
+            names[offsets[i]] = suffix
+        if suffix and len(suffix) > self.MAX_LENGTH:
+            raise ParseError("domain name too long")
+        return suffix or "", end
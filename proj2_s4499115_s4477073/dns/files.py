@@ -0,0 +1,42 @@
+#!/usr/bin/env python2
+
+""" Writing files that others may be reading
+
+This module contains a function that replaces a file atomically, used for the
+cache file, the binary snapshots of the cache and the compiled zone images. A
+reader sees either the old or the new file, never half a file, and a file
+that a reader has memory-mapped is never changed.
+"""
+
+import os
+import tempfile
+
+
+#The umask can only be read by setting it, which is done once at import instead of at every write
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def replace_file(filename, chunks):
+    """ Write a file through a temporary file that is renamed to filename
+
+    The temporary file has a unique name in the directory of filename, so
+    processes that write the same file at the same time never write into each
+    other's temporary file. mkstemp creates it readable by the owner only, so it
+    is given the permissions of a file created with open, following the umask.
+
+    Args:
+        filename (str): the file
+        chunks ([bytes]): the contents of the file
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            for chunk in chunks:
+                outfile.write(chunk)
+        os.chmod(tmp_file, 0o666 & ~UMASK)
+        os.rename(tmp_file, filename)
+    except:
+        os.remove(tmp_file)
+        raise
@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+
+""" Coalescing of identical calls in progress
+
+This module contains a table of calls in progress. When a thread makes a call
+that another thread is already making, with the same key, it does not make the
+call itself but waits for the result of the other thread. The server uses it
+so that clients asking the same question at the same time cause one resolution,
+and the resolver so that identical queries to the same servers are sent once.
+"""
+
+import threading
+
+
+class Call(object):
+    """ A call in progress """
+
+    def __init__(self):
+        """ Initialize the call """
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InflightTable(object):
+    """ Table of calls in progress, by key """
+
+    def __init__(self):
+        """ Initialize the table """
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key):
+        """ Get the call in progress with a key, or register a new one
+
+        Returns:
+            (call, leader): leader is True if the call is new and has to be
+            made by the caller, see InflightTable.run
+        """
+        self.lock.acquire()
+        call = self.calls.get(key)
+        leader = call is None
+        if leader:
+            call = Call()
+            self.calls[key] = call
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        self.lock.release()
+        return call, leader
+
+    def run(self, key, call, function, args):
+        """ Make a call that was registered by join and hand its result to the waiting threads """
+        try:
+            call.result = function(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            self.lock.acquire()
+            del self.calls[key]
+            self.lock.release()
+            call.event.set()
+        return call.result
+
+    def call(self, key, function, *args):
+        """ Call function, unless a call with the same key is in progress
+
+        Args:
+            key: identifies the call, must be hashable
+            function (function): the function to call
+            args: the arguments of the function
+
+        Returns:
+            the result of the function, computed by this thread or by the
+            thread that was already making the call
+        """
+        call, leader = self.join(key)
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        return self.run(key, call, function, args)
+
+    def start(self, key, function, *args):
+        """ Call function in a background thread, unless a call with the same key is in progress
+
+        Only the first caller starts a thread, the others get the call that is
+        already in progress, so the number of threads is bounded by the number
+        of keys instead of the number of callers.
+
+        Args:
+            key: identifies the call, must be hashable
+            function (function): the function to call
+            args: the arguments of the function
+
+        Returns:
+            the Call, whose event is set when it is done
+        """
+        call, leader = self.join(key)
+        if leader:
+            def background():
+                try:
+                    self.run(key, call, function, args)
+                except Exception:#Stored in call.error for the callers
+                    pass
+            thread = threading.Thread(target=background)
+            thread.daemon = True
+            thread.start()
+        return call
@@ -10,11 +10,16 @@ import socket
 import struct
 
 from dns.classes import Class
-from dns.domainname import Parser, Composer
+from dns.domainname import Parser, Composer, ParseError
 from dns.resource import ResourceRecord
 from dns.rtypes import Type
 
 
+class ShortHeader(ParseError):
+    """ The packet is too short to hold a header """
+    pass
+
+
 class Message(object):
     """ DNS message """
 
@@ -143,12 +148,14 @@ class Header(object):
                 self.ns_count, 
                 self.ar_count)
 
+    FORMAT = struct.Struct("!6H")
+
     @classmethod
     def from_bytes(cls, packet):
         """ Convert Header from bytes """
         if len(packet) < 12:
-            raise ShortHeader
-        return cls(*struct.unpack_from("!6H", packet))
+            raise ShortHeader("packet of " + str(len(packet)) + " bytes")
+        return cls(*cls.FORMAT.unpack_from(packet))
    
     @property
     def flags(self):
@@ -264,10 +271,13 @@ class Question(object):
         bqclass = struct.pack("!H", self.qclass)
         return bqname + bqtype + bqclass
 
+    FORMAT = struct.Struct("!2H")
+
     @classmethod
     def from_bytes(cls, packet, offset, parser):
         """ Convert Question from bytes """
-        qnames, offset = parser.from_bytes(packet, offset, 1)
-        qname = qnames[0]
-        qtype, qclass = struct.unpack_from("!2H", packet, offset)
+        qname, offset = parser.read_name(packet, offset)
+        if offset + 4 > len(packet):
+            raise ParseError("question runs past the end of the packet")
+        qtype, qclass = cls.FORMAT.unpack_from(packet, offset)
         return cls(qname, qtype, qclass), offset + 4
@@ -0,0 +1,206 @@
+#!/usr/bin/env python2
+
+""" Many resolutions at once on a few sockets
+
+This module contains a multiplexer that runs many resolutions of a Resolver
+at the same time in a single thread. The resolutions are the generators of
+Resolver.resolution: the multiplexer sends the queries they yield over a few
+shared sockets and sends the responses back, which it matches to queries by
+socket and transaction identifier. No thread is needed per resolution, and
+the resolutions share the cache of the resolver.
+
+Usage:
+    multiplexer = Multiplexer(resolver)
+    multiplexer.submit("www.ru.nl", callback)
+    multiplexer.submit("gaia.cs.umass.edu", callback)
+    multiplexer.run()
+"""
+
+import heapq
+import itertools
+import select
+import socket
+import struct
+import time
+from random import randint
+
+
+class Lookup(object):
+    """ A resolution in progress """
+
+    def __init__(self, hostname, steps, callback):
+        """ Initialize the lookup
+
+        Args:
+            hostname (str): the FQDN that is resolved
+            steps (generator): the steps of the resolution
+            callback (function): called with the result of the resolution
+        """
+        self.hostname = hostname
+        self.steps = steps
+        self.callback = callback
+        self.hop = 0
+        self.query = None
+        self.data = None
+        self.sock = None
+        self.candidates = []
+        self.asked = []
+        self.sent = {}
+        self.deadline = 0
+
+
+class Multiplexer(object):
+    """ Runs many resolutions of a resolver at once """
+
+    def __init__(self, resolver, sockets=2):
+        """ Initialize the multiplexer
+
+        Args:
+            resolver (Resolver): the resolver whose resolutions are run
+            sockets (int): number of sockets shared by all queries
+        """
+        self.resolver = resolver
+        self.sockets = [resolver.pool.acquire() for _ in range(sockets)]
+        self.inflight = {}
+        self.timers = []
+        self.counter = itertools.count()
+        self.active = 0
+
+    def close(self):
+        """ Return the sockets to the pool of the resolver """
+        for sock in self.sockets:
+            self.resolver.pool.release(sock)
+        self.sockets = []
+
+    def submit(self, hostname, callback):
+        """ Start resolving a hostname
+
+        Args:
+            hostname (str): the FQDN that we want to resolve
+            callback (function): called with (hostname, aliaslist, ipaddrlist)
+                once hostname is resolved, see Resolver.gethostbyname
+        """
+        steps = self.resolver.resolution(hostname)
+        lookup = Lookup(hostname, steps, callback)
+        self.active += 1
+        self.step(lookup, None)
+
+    def step(self, lookup, result):
+        """ Continue a resolution with the result of its last query """
+        try:
+            if result is None:
+                query, value = next(lookup.steps)
+            else:
+                query, value = lookup.steps.send(result)
+        except Exception as e:
+            print("Resolution of " + lookup.hostname + " failed: " + str(e))
+            query, value = None, (lookup.hostname, [], [])
+
+        if query is None:
+            self.active -= 1
+            lookup.callback(value)
+            return
+
+        #Use an identifier that is not in flight on the socket of the query
+        lookup.hop += 1
+        lookup.sock = self.sockets[lookup.hop % len(self.sockets)]
+        while (lookup.sock, query.header.ident) in self.inflight:
+            query.header.ident = randint(0, 65535)
+        self.inflight[(lookup.sock, query.header.ident)] = lookup
+
+        lookup.query = query
+        lookup.data = query.to_bytes()
+        lookup.candidates = value[:self.resolver.fanout]
+        lookup.asked = []
+        lookup.sent = {}
+        lookup.deadline = 0
+        self.send(lookup)
+
+    def send(self, lookup):
+        """ Send the query of a lookup to its next candidate server """
+        now = time.time()
+        while lookup.candidates:
+            server = lookup.candidates.pop(0)
+            lookup.asked.append(server)
+            try:
+                address = socket.gethostbyname(server)
+                if address in lookup.sent:#Another name of a server that was already asked
+                    continue
+                lookup.sock.sendto(lookup.data, (address, self.resolver.port))
+            except socket.error as e:
+                print("Could not send query to " + server + ": " + str(e))
+                continue
+            lookup.sent[address] = (server, now)
+
+            #Race the next candidate after the stagger, or give up at the deadline
+            timeout = self.resolver.infra.timeout(server)
+            lookup.deadline = max(lookup.deadline, now + timeout)
+            wake = now + min(self.resolver.stagger, timeout) if lookup.candidates else lookup.deadline
+            heapq.heappush(self.timers, (wake, next(self.counter), lookup, lookup.hop))
+            return
+
+        if not lookup.sent:#None of the candidates could be sent to
+            self.finish(lookup, None)
+        else:#Wait for the servers that were asked until the deadline
+            heapq.heappush(self.timers, (lookup.deadline, next(self.counter), lookup, lookup.hop))
+
+    def finish(self, lookup, response):
+        """ End the current query of a lookup and continue its resolution """
+        del self.inflight[(lookup.sock, lookup.query.header.ident)]
+        self.resolver.record_timeouts(lookup.sent, time.time())
+        self.step(lookup, (response, lookup.asked))
+
+    def expire(self):
+        """ Handle the timers that are due """
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, lookup, hop = heapq.heappop(self.timers)
+            if hop != lookup.hop or (lookup.sock, lookup.query.header.ident) not in self.inflight:
+                continue
+            if lookup.candidates:
+                self.send(lookup)
+            elif now >= lookup.deadline:
+                self.finish(lookup, None)
+            else:
+                heapq.heappush(self.timers, (lookup.deadline, next(self.counter), lookup, hop))
+
+    def receive(self, sock):
+        """ Receive a packet and hand it to the lookup it answers """
+        try:
+            packet, addr = sock.recvfrom(4096)
+        except socket.error:
+            return
+        if len(packet) < 2:
+            return
+        ident, = struct.unpack_from("!H", packet)
+        lookup = self.inflight.get((sock, ident))
+        if lookup is None:#Stray or late packet
+            return
+
+        response = self.resolver.parse_response(lookup.query, packet, addr, lookup.sent)
+        if response is None:
+            return
+        server, sent_at = lookup.sent.pop(addr[0])
+        self.resolver.infra.add_rtt(server, time.time() - sent_at)
+        self.resolver.cache_response(response)
+        self.finish(lookup, response)
+
+    def poll(self, timeout=None):
+        """ Wait for packets and timers once
+
+        Args:
+            timeout (float): maximum number of seconds to wait
+        """
+        wait = timeout
+        if self.timers:
+            until_timer = max(self.timers[0][0] - time.time(), 0)
+            wait = until_timer if wait is None else min(wait, until_timer)
+        ready = select.select(self.sockets, [], [], wait)[0]
+        for sock in ready:
+            self.receive(sock)
+        self.expire()
+
+    def run(self):
+        """ Run until all submitted resolutions are done """
+        while self.active:
+            self.poll()
@@ -7,14 +7,20 @@ things in this module. This resolver will be both used by the DNS client and the
 DNS server, but with a different list of servers.
 """
 
+import collections
+import select
 import socket
 from random import randint
 import re
 import time
 
 from dns.classes import Class
+from dns.rcodes import RCode
 from dns.rtypes import Type
-from dns.cache import RecordCache
+from dns.cache import RecordCache, DelegationCache, InfraCache
+from dns.inflight import InflightTable
+from dns.multiplexer import Multiplexer
+from dns.socketpool import SocketPool
 import dns.cache
 import dns.message
 import dns.rcodes
@@ -23,19 +29,40 @@ import dns.consts
 class Resolver(object):
     """ DNS resolver """
     
-    def __init__(self, timeout, caching, ttl, nameservers=[], use_rs=True):
+    def __init__(self, timeout, caching, ttl, nameservers=[], use_rs=True, cache=None, fanout=3, stagger=0.2,
+            pool_size=8, stale_deadline=1.8):
         """ Initialize the resolver
         
         Args:
+            timeout (int): maximum number of seconds to wait for a response of
+                a server, the actual timeout follows from its round trip times
             caching (bool): caching is enabled if True
             ttl (int): ttl of cache entries (if > 0)
+            cache (RecordCache): cache used if caching is enabled, a default
+                RecordCache is created if None
+            fanout (int): maximum number of nameservers a query is sent to at once
+            stagger (float): seconds to wait for a response before the query is
+                also sent to the next nameserver
+            pool_size (int): number of sockets kept open for queries after open
+            stale_deadline (float): seconds to wait for a resolution before
+                answering from stale records, if the cache has any
         """
         self.timeout = timeout
+        self.fanout = max(1, fanout)
+        self.stagger = stagger
+        self.port = 53 #Port of the nameservers
+        self.infra = InfraCache(timeout)
+        self.pool = SocketPool(pool_size)
+        self.upstream = InflightTable()
+        self.refreshing = InflightTable()
+        self.stale_deadline = stale_deadline
         self.caching = caching
         self.ttl = ttl if ttl > 0 else 0 #Deze check is niet nodig voor de resolver gemaakt via de server, maar wel voor de resolver gemaakt door de client
         if caching:
-            self.cache = RecordCache()
-        self.nameservers = nameservers
+            self.cache = cache if cache is not None else RecordCache()
+            self.cache.set_prefetcher(self.refresh)
+            self.delegations = DelegationCache()
+        self.nameservers = list(nameservers)
         if use_rs:
             self.nameservers += dns.consts.ROOT_SERVERS
 
@@ -53,11 +80,28 @@ class Resolver(object):
         return re.match(valid_hostnames, hostname)
 
 
-    def save_cache(self):
-        """ Save the cache if appropriate """
+    def open(self):
+        """ Open the sockets that are reused for queries
+
+        Without calling open every query opens a socket of its own.
+        """
+        self.pool.open()
+
+
+    def close(self):
+        """ Close the sockets that are reused for queries """
+        self.pool.close()
+
+
+    def save_cache(self, merge=False):
+        """ Save the cache if appropriate
+
+        Args:
+            merge (bool): keep the records that other processes wrote to the cache file
+        """
         if self.caching:
             if self.cache is not None:
-                self.cache.write_cache_file()
+                self.cache.save(merge)
 
 
     def ask_server(self, query, server):
@@ -68,32 +112,197 @@ class Resolver(object):
             server (str): IP address of the server that the query must be sent to
         
         Returns:
-            responses ([Message]): the responses received converted to Messages
+            response (Message): the response, None if the server did not respond
         """
-        response = None
-        
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(self.timeout)
+        return self.ask_servers(query, [server])[0]
+
+
+    def cache_response(self, response):
+        """ Add the addresses and aliases in a response to the cache """
+        if self.caching:
+            for record in response.additionals + response.answers + response.authorities:
+                if record.type_ == Type.A or record.type_ == Type.CNAME:
+                    record.ttl = self.ttl
+                    record.timestamp = int(time.time())
+                    self.cache.add_record(record)
+
+
+    def parse_response(self, query, data, addr, addresses):
+        """ Convert data to a response if it answers query
+
+        Args:
+            query (Message): the query that was sent
+            data (bytes): the received data
+            addr ((str, int)): the address the data was received from
+            addresses ([str]): IP addresses the query was sent to
+
+        Returns:
+            response (Message): the response, None if the data is not a
+            response to query from one of the addresses
+        """
+        if addr[0] not in addresses or addr[1] != self.port:
+            return None
         try:
-            sock.sendto(query.to_bytes(), (server, 53))
-            data = sock.recv(1024)
             response = dns.message.Message.from_bytes(data)
-            if response.header.ident != query.header.ident:
-                return None
-            
-            if self.caching:
-                for record in response.additionals + response.answers + response.authorities:
-                    if record.type_ == Type.A or record.type_ == Type.CNAME:
-                        record.ttl = self.ttl
-                        record.timestamp = int(time.time())
-                        self.cache.add_record(record)
-                    
-        except socket.timeout:
-            pass
-        
+        except Exception:
+            return None
+        if response.header.ident != query.header.ident or len(response.questions) != 1:
+            return None
+        question, asked = response.questions[0], query.questions[0]
+        if question.qname.lower() != asked.qname.lower() or question.qtype != asked.qtype \
+                or question.qclass != asked.qclass:
+            return None
         return response
 
 
+    def ask_servers(self, query, servers):
+        """ Send a query to several servers and return the first valid response
+
+        The query is sent to the first server. Whenever no response has
+        arrived stagger seconds after the last send, it is also sent to the
+        next server, up to fanout servers. The first response that matches
+        the identifier and question of the query wins, the others are ignored.
+
+        Args:
+            query (Message): the query that is to be sent
+            servers ([str]): addresses (or names) of the servers, best first
+
+        Returns:
+            response (Message): the response, None if no server responded in time
+            asked ([str]): the servers that were tried
+        """
+        data = query.to_bytes()
+        candidates = servers[:self.fanout]
+        asked = []
+        sent = {}
+        next_send = deadline = time.time()
+
+        sock = self.pool.acquire()
+        try:
+            while True:
+                now = time.time()
+                if candidates and now >= next_send:
+                    server = candidates.pop(0)
+                    asked.append(server)
+                    try:
+                        address = socket.gethostbyname(server)
+                        if address in sent:#Another name of a server that was already asked
+                            continue
+                        sock.sendto(data, (address, self.port))
+                    except socket.error as e:
+                        print("Could not send query to " + server + ": " + str(e))
+                        continue
+                    sent[address] = (server, now)
+
+                    #Wait as long as this server is expected to need before racing the next one
+                    timeout = self.infra.timeout(server)
+                    next_send = now + min(self.stagger, timeout)
+                    deadline = max(deadline, now + timeout)
+                    continue
+
+                wait = (min(next_send, deadline) if candidates else deadline) - now
+                if (wait <= 0 or not sent) and not candidates:
+                    self.record_timeouts(sent, now)
+                    return None, asked
+                if not select.select([sock], [], [], max(wait, 0))[0]:
+                    continue
+
+                packet, addr = sock.recvfrom(1024)
+                response = self.parse_response(query, packet, addr, sent)
+                if response is not None:
+                    now = time.time()
+                    server, sent_at = sent.pop(addr[0])
+                    self.infra.add_rtt(server, now - sent_at)
+                    self.record_timeouts(sent, now)
+                    self.cache_response(response)
+                    return response, asked
+        except socket.error as e:
+            print("Error while querying " + ", ".join(asked) + ": " + str(e))
+            return None, asked
+        finally:
+            self.pool.release(sock)
+
+
+    def record_timeouts(self, sent, now):
+        """ Tell the infrastructure cache which servers did not respond in time
+
+        Args:
+            sent ({str: (str, float)}): server and send time per address
+            now (float): the current time
+        """
+        for server, sent_at in sent.values():
+            if now - sent_at >= self.infra.timeout(server):
+                self.infra.add_timeout(server)
+
+
+    def negative_ttl(self, response):
+        """ Get the TTL of a negative answer, see section 5 of RFC 2308
+
+        Args:
+            response (Message): the negative answer
+
+        Returns:
+            the minimum of the TTL and the MINIMUM field of the SOA record in
+            the authority section, None if there is no SOA record
+        """
+        for record in response.authorities:
+            if record.type_ == Type.SOA:
+                return min(record.ttl, record.rdata.minimum)
+        return None
+
+    def is_negative(self, response):
+        """ Check if a response is a NXDOMAIN or NODATA answer
+
+        Args:
+            response (Message): the response
+
+        Returns:
+            the RCODE to cache (NXDomain or NoError for NODATA), None if
+            the response is not a negative answer
+        """
+        if response.header.rcode == RCode.NXDomain:
+            return RCode.NXDomain
+        referral = any(record.type_ == Type.NS for record in response.authorities)
+        if response.header.rcode == RCode.NoError and not response.answers and not referral \
+                and self.negative_ttl(response) is not None:
+            return RCode.NoError
+        return None
+
+    def follow_referral(self, hostname, response):
+        """ Get the nameservers to ask next from a referral
+
+        The addresses in the glue records of the additional section are used
+        if possible, otherwise the names of the nameservers. The zone cut and
+        the glue addresses are added to the delegation cache.
+
+        Args:
+            hostname (str): the FQDN that we want to resolve
+            response (Message): the referral
+
+        Returns:
+            hints ([str]): addresses or names of the nameservers
+        """
+        nameservers = [record for record in response.authorities if record.type_ == Type.NS]
+        names = [nameserver.rdata.data.lower() for nameserver in nameservers]
+        glue_records = [record for record in response.additionals \
+                if record.type_ == Type.A and record.name.lower() in names]
+        glue = [record.rdata.data for record in glue_records]
+        glued = [record.name.lower() for record in glue_records]
+        unglued = [nameserver.rdata.data for nameserver in nameservers if nameserver.rdata.data.lower() not in glued]
+
+        if self.caching:
+            for nameserver in nameservers:
+                self.cache.add_record(nameserver)
+
+            #Only remember cuts above hostname, a server may not delegate a zone it is not about
+            zones = set(nameserver.name.lower().rstrip('.') for nameserver in nameservers)
+            if glue and len(zones) == 1:
+                zone = zones.pop()
+                if DelegationCache.is_subdomain(hostname, zone):
+                    self.delegations.add(zone, glue, min(nameserver.ttl for nameserver in nameservers))
+
+        return glue + unglued
+
     def gethostbyname(self, hostname):
         """ Resolve hostname to an IP address
 
@@ -106,17 +315,176 @@ class Resolver(object):
             ipaddrlist ([str]): list of IP addresses of the hostname 
 
         """
+        return self.resolve(hostname)[:3]
+
+
+    def resolve(self, hostname):
+        """ Resolve hostname, answering from stale records if that fails or takes too long
+
+        When the cache holds records for hostname whose TTL has run out (see
+        RecordCache.lookup_stale), the resolution runs in a background thread,
+        one per name: requests for a name that is already resolved in the
+        background wait for that resolution.
+        If it fails or does not finish within stale_deadline, the stale records
+        are returned and the resolution goes on in the background, refreshing
+        the cache when it succeeds.
+
+        Args:
+            hostname (str): the FQDN that we want to resolve
+
+        Returns:
+            hostname, aliaslist and ipaddrlist as gethostbyname,
+            stale (bool): True if the answer comes from stale records
+        """
         print("==GETHOSTNAME START=================")
+        stale = self.lookup_stale(hostname) if self.caching else None
+        if stale is None:
+            return self.complete(self.resolution(hostname)) + (False,)
+
+        #Requests for a name that is already being refreshed wait for that refresh, without a thread of their own
+        call = self.refreshing.start(hostname.lower(), self.complete, self.resolution(hostname))
+        call.event.wait(self.stale_deadline)
+        result = call.result if call.event.is_set() else None
+        if call.error is not None:
+            print("Error while resolving " + hostname + ": " + str(call.error))
+
+        #A negative answer is an answer, stale records are only served when resolution fails
+        if result and (result[2] or self.cache.lookup_negative(hostname, Type.A, Class.IN) is not None):
+            return result + (False,)
+        print("Serving stale records for " + hostname)
+        return stale + (True,)
+
+
+    def lookup_stale(self, hostname):
+        """ Get the aliases and addresses of hostname from stale records in the cache
+
+        Returns:
+            (hostname, aliaslist, ipaddrlist), None if the cache holds no
+            stale addresses of hostname
+        """
+        addresses = [record.rdata.data for record in self.cache.lookup_stale(hostname, Type.A, Class.IN)]
+        if not addresses:
+            return None
+        aliases = self.cache.lookup(hostname, Type.CNAME, Class.IN) or \
+                self.cache.lookup_stale(hostname, Type.CNAME, Class.IN)
+        return (hostname, [alias.rdata.data for alias in aliases], addresses)
+
+
+    def refresh(self, dname, type_, class_):
+        """ Resolve a cached name again, without looking in the cache
+
+        The prefetcher of the cache: it is called in a background thread when
+        a popular name is about to expire, and adds the fresh records to the
+        cache like any resolution does.
+
+        Args:
+            dname (str): domain name of the records that are about to expire
+            type_ (Type): type of the records
+            class_ (Class): class of the records
+        """
+        if class_ == Class.IN and type_ in (Type.A, Type.CNAME):
+            self.complete(self.resolution(dname, use_cache=False))
+
+
+    def complete(self, steps):
+        """ Send the queries of a resolution until it is done
+
+        Args:
+            steps (generator): the steps of the resolution, see resolution
+
+        Returns:
+            the result of the resolution
+        """
+        query, value = next(steps)
+        while query is not None:
+            query, value = steps.send(self.ask_upstream(query, value))
+        return value
+
+
+    def resolve_many(self, hostnames, concurrency=100):
+        """ Resolve many hostnames at once
+
+        The hostnames are resolved concurrently in the calling thread by a
+        Multiplexer, at most concurrency at a time. The results are yielded as
+        soon as they are done, so not necessarily in the order of hostnames.
+
+        Args:
+            hostnames (iterable of str): the FQDNs that we want to resolve,
+                which are read lazily
+            concurrency (int): maximum number of resolutions in progress
+
+        Returns:
+            generator of (hostname, aliaslist, ipaddrlist, seconds), the result
+            of gethostbyname for every hostname and the time it took
+        """
+        multiplexer = Multiplexer(self)
+        done = collections.deque()
+        hostnames = iter(hostnames)
+        pending = True
+        try:
+            while True:
+                #Keep up to concurrency resolutions in progress
+                while pending and multiplexer.active < concurrency:
+                    try:
+                        hostname = next(hostnames)
+                    except StopIteration:
+                        pending = False
+                        break
+                    started = time.time()
+                    multiplexer.submit(hostname,
+                            lambda result, started=started: done.append(result + (time.time() - started,)))
+
+                while done:
+                    yield done.popleft()
+                if not multiplexer.active:
+                    if not pending:
+                        return
+                    continue
+                multiplexer.poll()
+        finally:
+            multiplexer.close()
+
+
+    def ask_upstream(self, query, hints):
+        """ Send a query to the best servers, sharing the response with identical queries in progress
+
+        Args:
+            query (Message): the query that is to be sent
+            hints ([str]): addresses (or names) of the servers, best first
+
+        Returns:
+            see ask_servers
+        """
+        question = query.questions[0]
+        key = (tuple(hints[:self.fanout]), question.qname.lower(), question.qtype, question.qclass)
+        return self.upstream.call(key, self.ask_servers, query, hints)
+
+
+    def resolution(self, hostname, use_cache=True):
+        """ The steps of resolving hostname to an IP address
+
+        A generator that does not send queries itself, so the queries can be
+        sent in different ways (see gethostbyname and dns.multiplexer). Every
+        step yields (query, hints): the query to send and the servers to send
+        it to, best first. The result of ask_servers for those must be sent
+        back. The last step yields (None, result), where result is what
+        gethostbyname returns.
+
+        Args:
+            hostname (str): the FQDN that we want to resolve
+            use_cache (bool): answer from the cache if possible
+        """
         aliaslist = []
         ipaddrlist = []
 
         #Check if the hostname is valid
         valid = self.is_valid_hostname(hostname)
         if not valid:
-            return hostname, [], []
+            yield None, (hostname, [], [])
+            return
 
         #Check if the information is in the cache
-        if self.caching:   		
+        if self.caching and use_cache:   		
             for alias in self.cache.lookup(hostname, Type.CNAME, Class.IN):
                 aliaslist.append(alias.rdata.data)
             
@@ -125,15 +493,28 @@ class Resolver(object):
 
             if ipaddrlist:
                 print("We found an address in the cache!")
-                return hostname, aliaslist, ipaddrlist
+                yield None, (hostname, aliaslist, ipaddrlist)
+                return
+
+            if self.cache.lookup_negative(hostname, Type.A, Class.IN) is not None:
+                print("We found a negative answer in the cache!")
+                yield None, (hostname, [], [])
+                return
 
         #Do the recursive algorithm
-        hints = self.nameservers
+        hints = list(self.nameservers)
+
+        hints = self.infra.order(hints)
+
+        #Start at the nameservers of the closest zone cut we know, the root servers remain as fallback
+        if self.caching:
+            closest = self.delegations.closest(hostname)
+            if closest is not None:
+                zone, addresses = closest
+                print("Starting at the nameservers of " + zone)
+                hints = self.infra.order(addresses) + [hint for hint in hints if hint not in addresses]
         
         while hints:
-            #Get the server to ask
-            hint = hints[0]
-            hints = hints[1:]
 
             #Build the query to send to that server
             identifier = randint(0, 65535)
@@ -145,16 +526,28 @@ class Resolver(object):
             header.rd = 0
             query = dns.message.Message(header, [question])
 
-            #Try to get a response
-            response = self.ask_server(query, hint)
+            #Try to get a response from the best servers
+            response, asked = yield query, hints
+            hints = [hint for hint in hints if hint not in asked]
 
-            if response == None:#We didn't get a response for this server, so check the next one
-                print("Server at " + hint + " did not respond.")
+            if response == None:#We didn't get a response from these servers, so check the next ones
+                print("Servers at " + ", ".join(asked) + " did not respond.")
                 continue
 
+            #The name or the address of the name does not exist
+            rcode = self.is_negative(response)
+            if rcode is not None:
+                ttl = self.negative_ttl(response)
+                #Behind a CNAME the answer is about the alias, not about hostname
+                if self.caching and ttl is not None and not response.answers:
+                    self.cache.add_negative(hostname, Type.A, Class.IN, rcode, ttl)
+                print("Negative answer for " + hostname + ": " + RCode.to_string(rcode))
+                yield None, (hostname, [], [])
+                return
+
             #Analyze the response
             for answer in response.answers + response.additionals:#First get the aliases
-                if answer.type_ == Type.CNAME and answer.rdata.data not in aliases:
+                if answer.type_ == Type.CNAME and answer.rdata.data not in aliaslist:
                     aliaslist.append(answer.rdata.data)
 
             for answer in response.answers:#Then try to get an address
@@ -163,15 +556,11 @@ class Resolver(object):
                 
             if ipaddrlist != []:
                 print("We found an address using the recursive search!")
-                return hostname, aliaslist, ipaddrlist
+                yield None, (hostname, aliaslist, ipaddrlist)
+                return
 
             else:
-                for nameserver in response.authorities:
-                    if nameserver.type_ == Type.NS:#Do a lookup for that ns?
-                        #print(nameserver.rdata.data)
-                        if self.caching:
-                            self.cache.add_record(nameserver)
-                        hints = [nameserver.rdata.data] + hints
+                hints = self.infra.order(self.follow_referral(hostname, response)) + hints
 
         print("Recursive search for " + hostname + " was a total failure")
-        return hostname, [], []
+        yield None, (hostname, [], [])
@@ -12,10 +12,15 @@ import struct
 import time
 
 from dns.classes import Class
+from dns.domainname import ParseError
 from dns.rtypes import Type
 
 class ResourceRecord(object):
     """ DNS resource record """
+
+    #Type, class, TTL and rdata length after the name
+    FORMAT = struct.Struct("!HHIH")
+
     def __init__(self, name, type_, class_, ttl, rdata, timestamp=None):
         """ Create a new resource record
 
@@ -44,10 +49,13 @@ class ResourceRecord(object):
     @classmethod
     def from_bytes(cls, packet, offset, parser):
         """ Convert ResourceRecord from bytes """
-        names, offset = parser.from_bytes(packet, offset, 1)
-        name = names[0]
-        type_, class_, ttl, rdlength = struct.unpack_from("!HHIH", packet, offset)
+        name, offset = parser.read_name(packet, offset)
+        if offset + 10 > len(packet):
+            raise ParseError("resource record runs past the end of the packet")
+        type_, class_, ttl, rdlength = cls.FORMAT.unpack_from(packet, offset)
         offset += 10
+        if offset + rdlength > len(packet):
+            raise ParseError("record data runs past the end of the packet")
         rdata = RecordData.from_bytes(type_, packet, offset, rdlength, parser)
         offset += rdlength
         return cls(name, type_, class_, ttl, rdata), offset
@@ -73,16 +81,7 @@ class RecordData(object):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
-        classdict = {
-            Type.A: ARecordData,
-            Type.CNAME: CNAMERecordData,
-            Type.NS: NSRecordData,
-            Type.AAAA: AAAARecordData
-        }
-        if type_ in classdict:
-            return classdict[type_](data)
-        else:
-            return GenericRecordData(data)
+        return RECORD_DATA.get(type_, GenericRecordData)(data)
 
     @staticmethod
     def from_bytes(type_, packet, offset, rdlength, parser):
@@ -95,17 +94,7 @@ class RecordData(object):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
-        classdict = {
-            Type.A: ARecordData,
-            Type.CNAME: CNAMERecordData,
-            Type.NS: NSRecordData,
-            Type.AAAA: AAAARecordData
-        }
-        if type_ in classdict:
-            return classdict[type_].from_bytes(
-                packet, offset, rdlength, parser)
-        else:
-            return GenericRecordData.from_bytes(
+        return RECORD_DATA.get(type_, GenericRecordData).from_bytes(
                 packet, offset, rdlength, parser)
 
 
@@ -129,6 +118,8 @@ class ARecordData(RecordData):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
+        if rdlength != 4:
+            raise ParseError("A record data of " + str(rdlength) + " bytes")
         data = socket.inet_ntoa(packet[offset:offset+4])
         return cls(data)
 
@@ -153,8 +144,9 @@ class CNAMERecordData(RecordData):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
-        names, offset = parser.from_bytes(packet, offset, 1)
-        data = names[0]
+        data, end = parser.read_name(packet, offset)
+        if end > offset + rdlength:
+            raise ParseError("domain name runs past the end of the record data")
         return cls(data)
 
 
@@ -178,11 +170,65 @@ class NSRecordData(RecordData):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
-        names, offset = parser.from_bytes(packet, offset, 1)
-        data = names[0]
+        data, end = parser.read_name(packet, offset)
+        if end > offset + rdlength:
+            raise ParseError("domain name runs past the end of the record data")
         return cls(data)
 
 
+class SOARecordData(RecordData):
+    """ Record data of a SOA record, see section 3.3.13 of RFC 1035
+
+    The data is a string in master file format:
+        "mname rname serial refresh retry expire minimum"
+    """
+
+    #Serial, refresh, retry, expire and minimum after the names
+    NUMBERS = struct.Struct("!5I")
+
+    def __init__(self, data):
+        """ Initialize the record data
+
+        Args:
+            data (str): data
+        """
+        super(SOARecordData, self).__init__(data)
+        parts = data.split()
+        self.mname = parts[0]
+        self.rname = parts[1]
+        self.serial, self.refresh, self.retry, self.expire, self.minimum = \
+                [int(part) for part in parts[2:7]]
+
+    def to_bytes(self, offset, composer):
+        """ Convert to bytes
+
+        Args:
+            offset (int): offset in message
+            composer (Composer): domain name composer
+        """
+        names = composer.to_bytes(offset, [self.mname, self.rname])
+        return names + struct.pack("!5I", self.serial, self.refresh,
+                self.retry, self.expire, self.minimum)
+
+    @classmethod
+    def from_bytes(cls, packet, offset, rdlength, parser):
+        """ Create a RecordData object from bytes
+
+        Args:
+            packet (bytes): packet
+            offset (int): offset in message
+            rdlength (int): length of rdata
+            parser (int): domain name parser
+        """
+        names, end = parser.from_bytes(packet, offset, 2)
+        if end + 20 > offset + rdlength:
+            raise ParseError("SOA record data runs past its length")
+        numbers = cls.NUMBERS.unpack_from(packet, end)
+        if any(len(name.split()) != 1 for name in names):#Not representable in master file format
+            raise ParseError("SOA record with an empty name or whitespace in a name")
+        return cls(" ".join(names + [str(number) for number in numbers]))
+
+
 class AAAARecordData(RecordData):
     def to_bytes(self, offset, composer):
         """ Convert to bytes
@@ -203,6 +249,8 @@ class AAAARecordData(RecordData):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
+        if rdlength != 16:
+            raise ParseError("AAAA record data of " + str(rdlength) + " bytes")
         data = socket.inet_ntop(socket.AF_INET6, packet[offset:offset+16])
         return cls(data)
 
@@ -229,3 +277,13 @@ class GenericRecordData(RecordData):
         """
         data = packet[offset:offset+rdlength]
         return cls(data)
+
+
+#Record data classes by type, other types are read as GenericRecordData
+RECORD_DATA = {
+    Type.A: ARecordData,
+    Type.CNAME: CNAMERecordData,
+    Type.NS: NSRecordData,
+    Type.SOA: SOARecordData,
+    Type.AAAA: AAAARecordData
+}
@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+
+""" Cache of encoded authoritative responses
+
+This module contains a cache of the responses of the server to questions it
+answers from its zones, in wire format. A response is keyed by the question
+and the RD flag of the query, which together fix every byte of the response
+except the transaction identifier. A hit copies the response and writes the
+identifier of the query into the copy, so no records are looked up or encoded.
+
+Every response is stored with the catalog it was answered from. A response
+from another catalog is a miss, so a response from the zones before a reload
+is never served after it, not even when a handler that started before the
+reload stores it afterwards.
+"""
+
+import collections
+import struct
+import threading
+
+
+IDENT = struct.Struct("!H")
+
+
+class ResponseCache(object):
+    """ A thread-safe LRU cache of encoded responses, by question """
+
+    def __init__(self, max_entries=10000):
+        """ Initialize the cache
+
+        Args:
+            max_entries (int): maximum number of cached responses
+        """
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(question, rd):
+        """ Get the key of a question
+
+        The name is not lowercased: the response repeats the question, so
+        names that differ in case have different responses.
+
+        Args:
+            question (Question): the question of the query
+            rd (bool): whether the query desires recursion
+        """
+        return question.qname, question.qtype, question.qclass, bool(rd)
+
+    def get(self, key, catalog, ident):
+        """ Get the response to a question
+
+        Args:
+            key (tuple): key of the question, see ResponseCache.key
+            catalog (Catalog): the catalog the response must be answered from
+            ident (int): transaction identifier of the query
+
+        Returns:
+            the response with the identifier of the query, None if there is none
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] is not catalog:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        response = bytearray(entry[1])
+        IDENT.pack_into(response, 0, ident)
+        return bytes(response)
+
+    def put(self, key, catalog, response):
+        """ Store the response to a question
+
+        Args:
+            key (tuple): key of the question, see ResponseCache.key
+            catalog (Catalog): the catalog the response was answered from
+            response (bytes): the encoded response
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (catalog, response)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """ Remove all responses """
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -6,11 +6,20 @@ This module provides a recursive DNS server. You will have to implement this
 server using the algorithm described in section 4.3.2 of RFC 1034.
 """
 
+import errno
+import os
+import signal
 import socket
+import time
 from threading import Thread, Lock
 import platform
+import Queue
+import dns.cache
+import dns.consts as Consts
+import dns.inflight
 import dns.message
 import dns.resolver
+import dns.responsecache
 import dns.zone
 
 from dns.resource import ResourceRecord, ARecordData, CNAMERecordData
@@ -20,12 +29,22 @@ from dns.rtypes import Type
 
 lock = Lock()
 
+#Not every Python 2.7 build exposes the constant, 15 is its value on Linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
 
 class RequestHandler(Thread):
     """ A handler for requests to the DNS server """
 
-    def __init__(self, serversocket, clientIP, ttl, message, resolver, catalog):
-        """ Initialize the handler thread """
+    def __init__(self, serversocket, clientIP, ttl, message, resolver, catalog, inflight=None, responses=None):
+        """ Initialize the handler thread
+
+        Args:
+            inflight (InflightTable): table through which identical questions
+                that are resolved at the same time are resolved once
+            responses (ResponseCache): cache of the encoded responses to
+                questions answered from the catalog, None disables it
+        """
         super(RequestHandler, self).__init__()
         self.daemon = True
         self.socket = serversocket
@@ -34,12 +53,15 @@ class RequestHandler(Thread):
         self.message = message
         self.resolver = resolver
         self.catalog = catalog
+        self.inflight = inflight if inflight is not None else dns.inflight.InflightTable()
+        self.responses = responses
 
-    def check_zone(self, hname):
+    def check_zone(self, hname, chain=dns.zone.Zone.MAX_CHAIN):
         """ Checks the catalog for entries regarding given hname
 
         Args:
             hname (str): the FQDN of the host we want to look up
+            chain (int): maximum number of CNAME records that are still followed
 
         Returns:
             hname (str): the FQDN of the host we want to look up,
@@ -48,52 +70,25 @@ class RequestHandler(Thread):
             A boolean that tells if we found something
         """
         print("Checking zone for \"" + hname + "\"")
-        
-        h_parts = hname.rstrip('.').split('.')
-
-        zone_match = None
-        best_rdn_parts = []
-
-        #Check if hname is a subdomain for the root domain name
-        for rdn in self.catalog.zones:
-            zone = self.catalog.zones[rdn]
-            rdn_parts = rdn.rstrip('.').split('.')
-            print("HParts: " + h_parts)
-            print("RDNparts: " + rdn_parts)
-            if all(l == r for (l, r) in zip(reversed(h_parts), reversed(rdn_parts))) and len(h_parts) >= len(rdn_parts):
-                zone_match = zone
-                best_rdn_parts = rdn_parts
-                 
-        if zone_match == None:
+
+        #Find the zone that encloses hname most closely
+        match = self.catalog.find_zone(hname)
+        if match == None:
             print("Geen zone gevonden")
             return [], [], False
+        rdn, zone_match = match
 
         #Find the answers
-        authority = []
-        answer = []
-
-        for fqdn, record in zone_match.records.iteritems():   
-            if fqdn.rstrip('.') == hname and record.type_ != Type.NS:#Precies het adres dat we willen
-                if self.message.questions[0].qtype == record.type_:
-                    answer.append(record)
-                    
-                elif self.message.questions[0].qtype != Type.CNAME and record.type_ == Type.CNAME:
-                    answer.append(record)
-                    #Find the info for this new cname if you have it
-                    extra_answer, extra_authority, extra_found = self.check_zone(record.rdata.data)
-                    answer = answer + extra_answer
-                    authority = authority + extra_authority
-                    
-        for i in range(len(hparts)):
-            subaddress = ".".join(hparts[i:])
-            print(subaddress)
-            
+        qtype = self.message.questions[0].qtype
+        answer, authority, exists = zone_match.find(hname, qtype)
 
-            for fqdn, record in zone_match.records.iteritems():                     
-                if fqdn.rstrip('.') == subaddress and record.type_ == Type.NS:
-                    authority.append(record)
+        #Find the info for this new cname if you have it
+        if answer and answer[0].type_ == Type.CNAME and qtype != Type.CNAME and chain > 0:
+            extra_answer, extra_authority, extra_found = self.check_zone(answer[0].rdata.data, chain - 1)
+            answer = answer + extra_answer
+            authority = authority + [record for record in extra_authority if record not in authority]
 
-        return list(set(answer)), list(set(authority)), (bool(answer) or bool(authority))
+        return answer, authority, (bool(answer) or bool(authority))
 
 
 
@@ -105,8 +100,17 @@ class RequestHandler(Thread):
             print("[-] - Invalid request.")#Hier bestaat een statuscode voor toch?
             return
         hname = self.message.questions[0].qname
-        print("Solving " + str(hname))
         ident = self.message.header.ident
+
+        #Answered from the zones before? Then only the identifier changes
+        if self.responses is not None:
+            response_key = dns.responsecache.ResponseCache.key(self.message.questions[0], self.message.header.rd)
+            response = self.responses.get(response_key, self.catalog, ident)
+            if response is not None:
+                self.sendData(response)
+                return
+
+        print("Solving " + str(hname))
         print("Checking zone")
         answer, authority, found = self.check_zone(hname)
         print("Wat we in de zone hebben gevonden")
@@ -127,11 +131,16 @@ class RequestHandler(Thread):
             header.opcode = 0
             header.qr = 1
 
-            self.sendResponse(dns.message.Message(header, self.message.questions, answer, authority))
+            response = dns.message.Message(header, self.message.questions, answer, authority).to_bytes()
+            if self.responses is not None:
+                self.responses.put(response_key, self.catalog, response)
+            self.sendData(response)
 
         elif self.message.header.rd == 256:
             print("In de server waar we het niet in de zone hebben")
-            h, al, ad = self.resolver.gethostbyname(hname)
+            question = self.message.questions[0]
+            key = (hname.lower(), question.qtype, question.qclass)
+            h, al, ad, stale = self.inflight.call(key, self.resolver.resolve, hname)
             print("Server gebruikte online resolver en vond dit")
             print(h)
             print(al)
@@ -143,8 +152,9 @@ class RequestHandler(Thread):
                 header.opcode = 0
                 header.qr = 1
 
-                aliases = [ResourceRecord(h, Type.CNAME, Class.IN, self.ttl, CNAMERecordData(alias)) for alias in al]
-                addresses = [ResourceRecord(h, Type.A, Class.IN, self.ttl, ARecordData(address)) for address in ad]
+                ttl = dns.cache.RecordCache.STALE_TTL if stale else self.ttl
+                aliases = [ResourceRecord(h, Type.CNAME, Class.IN, ttl, CNAMERecordData(alias)) for alias in al]
+                addresses = [ResourceRecord(h, Type.A, Class.IN, ttl, ARecordData(address)) for address in ad]
 
                 self.sendResponse(dns.message.Message(header, self.message.questions, aliases + addresses))
 
@@ -153,9 +163,13 @@ class RequestHandler(Thread):
             
 
     def sendResponse(self, response):
+        self.sendData(response.to_bytes())
+
+    def sendData(self, data):
+        """ Send an encoded response to the client """
         with lock:
             print("[+] - Sending response.")
-            self.socket.sendto(response.to_bytes(), self.clientIP)
+            self.socket.sendto(data, self.clientIP)
 
     def run(self):
         """ Run the handler thread """
@@ -166,39 +180,219 @@ class RequestHandler(Thread):
 
 
 class Server(object):
-    """ A recursive DNS server """
+    """ A recursive DNS server
+
+    Two engines are available for handling requests:
+        threaded: a new RequestHandler thread is started for every datagram
+        pool: a fixed number of worker threads take RequestHandlers from a
+            bounded queue, datagrams are dropped when the queue is full
+    """
 
-    def __init__(self, port, caching, ttl):
+    ENGINES = ["threaded", "pool"]
+
+    def __init__(self, port, caching, ttl, engine="threaded", pool_size=16, queue_size=1024, reuse_port=False,
+            cache_entries=0, cache_bytes=0, cache_policy="lru", cache_shards=0,
+            cache_journal=False, cache_format="json", cache_prefetch=0.1, cache_stale=0, watch_zones=0, config=None,
+            response_cache=10000, compile_zones=True):
         """ Initialize the server
         
         Args:
             port (int): port that server is listening on
             caching (bool): server uses resolver with caching if true
             ttl (int): ttl for records (if > 0) of cache
+            engine (str): "threaded" or "pool"
+            pool_size (int): number of worker threads of the pool engine
+            queue_size (int): maximum number of queued requests of the pool engine
+            reuse_port (bool): share the port with other server processes
+                using SO_REUSEPORT, the cache file is then merged on shutdown
+            cache_entries (int): maximum number of cached records (if > 0)
+            cache_bytes (int): approximate maximum size of the cache (if > 0)
+            cache_policy (str): eviction policy of the cache, "lru" or "2q"
+            cache_shards (int): split the cache over this many locked shards (if > 1)
+            cache_journal (bool): append added records to a journal instead of
+                writing the whole cache file on shutdown
+            cache_format (str): "json" or "binary" (a memory-mapped snapshot)
+            cache_prefetch (float): final part of the TTL in which a hit
+                refreshes a popular record in the background, 0 disables it
+            cache_stale (int): seconds that records are served after their TTL
+                has run out, when they can not be resolved again (RFC 8767)
+            watch_zones (float): check the master files of the zones for changes
+                every this many seconds and reload them (if > 0)
+            config (str): configuration file with the zones, see
+                dns.zone.read_config, the zone ru.nl of zone.txt if None
+            response_cache (int): maximum number of encoded responses to
+                questions answered from the zones that are cached (if > 0)
+            compile_zones (bool): compile the stale zone images of an eager
+                configuration, False when the supervisor has done so
         """
+        if engine not in Server.ENGINES:
+            raise ValueError("unknown engine: " + str(engine))
         self.caching = caching
         self.ttl = ttl if ttl > 0 else 0
         self.port = port
         self.done = False
-        self.resolver = dns.resolver.Resolver(5, self.caching, self.ttl)
-
-        self.zone = dns.zone.Zone()
-        self.zone.read_master_file()
-
-        self.catalog = dns.zone.Catalog()
-        self.catalog.add_zone("ru.nl", self.zone)
+        self.engine = engine
+        self.pool_size = pool_size
+        self.queue = Queue.Queue(queue_size)
+        self.workers = []
+        self.dropped = 0
+        self.inflight = dns.inflight.InflightTable()
+        self.reuse_port = reuse_port
+        cache = None
+        journal_file = Consts.JOURNAL_FILE if cache_journal else None
+        cache_file = Consts.SNAPSHOT_FILE if cache_format == "binary" else Consts.CACHE_FILE
+        if self.caching and cache_shards > 1:
+            cache = dns.cache.ShardedRecordCache(cache_file, shards=cache_shards, max_entries=cache_entries,
+                    max_bytes=cache_bytes, policy=cache_policy, journal_file=journal_file, cache_format=cache_format,
+                    prefetch_fraction=cache_prefetch, stale_window=cache_stale)
+        elif self.caching:
+            cache = dns.cache.RecordCache(cache_file, max_entries=cache_entries, max_bytes=cache_bytes,
+                    policy=cache_policy, journal_file=journal_file, cache_format=cache_format,
+                    prefetch_fraction=cache_prefetch, stale_window=cache_stale)
+        if cache is not None and cache_journal:
+            cache.start_compactor()
+        self.resolver = dns.resolver.Resolver(5, self.caching, self.ttl, cache=cache)
+        self.resolver.open()
+
+        if config is not None:
+            self.catalog = dns.zone.read_config(config, compile=compile_zones)
+        else:
+            zone = dns.zone.Zone()
+            zone.read_zone()
+            self.catalog = dns.zone.Catalog()
+            self.catalog.add_zone("ru.nl", zone)
+        self.report_zones()
+        self.responses = dns.responsecache.ResponseCache(response_cache) if response_cache > 0 else None
+        self.reload_lock = Lock()
+        self.watch_zones = watch_zones
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self.socket.bind(('', self.port))
 
+    def report_zones(self):
+        """ Print the number of records and the memory used per zone
+
+        Called at startup and at shutdown, when the lazy zones that were
+        asked about have been read.
+        """
+        total = 0
+        for name, zone in sorted(self.catalog.zones.items()):
+            if isinstance(zone, dns.zone.LazyZone) and zone.zone is None:
+                print("[*] - Zone " + name + ": not loaded")
+                continue
+            memory = zone.memory()
+            total += memory
+            print("[*] - Zone " + name + ": " + str(zone.count) + " records, %.1f KiB" % (memory / 1024.0))
+        print("[*] - " + str(len(self.catalog.zones)) + " zones, %.1f KiB" % (total / 1024.0))
+
+    def handle_signals(self):
+        """ Reload the zones on SIGHUP, must be called from the main thread """
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+
+    def reload(self):
+        """ Reload the zones in a background thread """
+        thread = Thread(target=self.reload_zones)
+        thread.daemon = True
+        thread.start()
+
+    def reload_zones(self, changed_only=False):
+        """ Reload the zones from their files and swap them into the catalog
+
+        The new zones are read while the old ones are still served. The
+        catalog is then replaced by a copy with the new zones in a single
+        assignment, handlers that started before keep using the old one.
+
+        Args:
+            changed_only (bool): only reload zones whose master file has changed
+
+        Returns:
+            (added, removed): the number of records added to and removed from the zones
+        """
+        self.reload_lock.acquire()
+        try:
+            started = time.time()
+            catalog = self.catalog
+            added = removed = 0
+            new_zones = {}
+            for name, zone in catalog.zones.items():
+                if zone.filename is None or (changed_only and not zone.changed()):
+                    continue
+                new_zone = zone.reload()
+                old_keys = zone.record_keys()
+                new_keys = new_zone.record_keys()
+                added += len(new_keys - old_keys)
+                removed += len(old_keys - new_keys)
+                new_zones[name] = new_zone
+            if new_zones:
+                self.catalog = catalog.with_zones(new_zones)
+                if self.responses is not None:
+                    self.responses.clear()
+            print("[+] - Reloaded " + str(len(new_zones)) + " zones in %.3f s: " % (time.time() - started) \
+                    + str(added) + " records added, " + str(removed) + " removed.")
+            return added, removed
+        except Exception as e:
+            print("An error has occured while reloading the zones: " + str(e))
+            return 0, 0
+        finally:
+            self.reload_lock.release()
+
+    def watch(self):
+        """ Reload zones whose master file has changed, every watch_zones seconds """
+        while not self.done:
+            time.sleep(self.watch_zones)
+            if any(zone.changed() for zone in self.catalog.zones.values()):
+                self.reload_zones(changed_only=True)
+
+    def work(self):
+        """ Handle queued requests until a None sentinel is received (pool engine) """
+        while True:
+            rh = self.queue.get()
+            if rh is None:
+                break
+            try:
+                rh.run()
+            except Exception as e:#A failing request must not take the worker down with it
+                print("[-] - Worker failed handling request: " + str(e))
+
+    def dispatch(self, rh):
+        """ Hand a request handler to the engine """
+        if self.engine == "threaded":
+            rh.start()
+            return
+
+        try:
+            self.queue.put_nowait(rh)
+        except Queue.Full:
+            self.dropped += 1
+            print("[-] - Request queue full, dropping request.")
+
     def serve(self):
         """ Start serving request """
         
-        print("[+] - DNS Server up and running.")
+        if self.engine == "pool":
+            for _ in range(self.pool_size):
+                worker = Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+        if self.watch_zones > 0:
+            watcher = Thread(target=self.watch)
+            watcher.daemon = True
+            watcher.start()
+
+        print("[+] - DNS Server up and running (" + self.engine + " engine).")
         
         while not self.done:
-            data, addr = self.socket.recvfrom(1024)
+            try:
+                data, addr = self.socket.recvfrom(1024)
+            except socket.error as e:
+                if e.errno == errno.EINTR:#Interrupted by a signal such as SIGHUP
+                    continue
+                raise
 
             try:
                 message = dns.message.Message.from_bytes(data)
@@ -206,13 +400,140 @@ class Server(object):
                 print("[-] - Received invalid data.")
                 continue
 
-            rh = RequestHandler(self.socket, addr, self.ttl, message, self.resolver, self.catalog)
-            rh.start()
+            self.dispatch(RequestHandler(self.socket, addr, self.ttl, message, self.resolver, self.catalog,
+                    self.inflight, self.responses))
 
     def shutdown(self):
         """ Shutdown the server """
         print("[*] - Shutting down.")
         self.done = True
         self.socket.close()
-        self.resolver.save_cache()
+        for _ in self.workers:
+            try:
+                self.queue.put_nowait(None)
+            except Queue.Full:
+                break
+        self.resolver.close()
+        self.resolver.save_cache(merge=self.reuse_port)
+        self.report_zones()
+        print("[*] - Coalesced " + str(self.inflight.coalesced) + " questions and " \
+                + str(self.resolver.upstream.coalesced) + " upstream queries.")
+        if self.responses is not None:
+            print("[*] - Response cache: " + str(self.responses.hits) + " hits, " \
+                    + str(self.responses.misses) + " misses.")
         print("[+] - Shut down complete. May your framerates be high and our temperatures low.")
+
+
+class Supervisor(object):
+    """ Runs a Server in each of a number of forked worker processes
+
+    Every worker binds the same port with SO_REUSEPORT, so the kernel spreads
+    the datagrams over the workers. Crashed workers are restarted. On Ctrl-C
+    the workers are stopped one at a time, so each of them can merge its
+    records into the cache file without overwriting those of the others.
+    SIGHUP is passed on to the workers, which then reload their zones.
+    """
+
+    def __init__(self, workers, port, caching, ttl, **server_args):
+        """ Initialize the supervisor
+
+        Args:
+            workers (int): number of worker processes
+            port (int): port that the workers are listening on
+            caching (bool): workers use resolvers with caching if true
+            ttl (int): ttl for records (if > 0) of cache
+            server_args: further keyword arguments for each Server
+        """
+        self.workers = workers
+        self.port = port
+        self.caching = caching
+        self.ttl = ttl
+        self.server_args = server_args
+        self.pids = {}
+        self.started = {}
+        self.done = False
+
+    def run_worker(self):
+        """ Run a Server in the current (child) process, until SIGTERM """
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+
+        #Ctrl-C reaches the whole process group, only the supervisor acts on it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, terminate)
+        #The zones can only be reloaded once they are loaded
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        server = Server(self.port, self.caching, self.ttl, reuse_port=True, compile_zones=False,
+                **self.server_args)
+        server.handle_signals()
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+    def spawn(self, index):
+        """ Fork worker number index """
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self.run_worker()
+            except Exception as e:
+                print("[-] - Worker " + str(index) + " crashed: " + str(e))
+                code = 1
+            os._exit(code)
+
+        print("[+] - Started worker " + str(index) + " (pid " + str(pid) + ").")
+        self.pids[pid] = index
+        self.started[index] = time.time()
+
+    def stop(self):
+        """ Stop the workers one at a time """
+        self.done = True
+        for pid, index in list(self.pids.items()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            print("[*] - Stopped worker " + str(index) + ".")
+        self.pids = {}
+
+    def reload(self, signum, frame):
+        """ Pass SIGHUP on to the workers, so they reload their zones """
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except OSError:
+                pass
+
+    def serve(self):
+        """ Start the workers and restart them when they die """
+        #Compile the zone images once, instead of in every worker at the same time
+        if self.server_args.get("config") is not None:
+            dns.zone.compile_images(self.server_args["config"])
+
+        signal.signal(signal.SIGHUP, self.reload)
+        for index in range(self.workers):
+            self.spawn(index)
+
+        try:
+            while not self.done:
+                try:
+                    pid, status = os.wait()
+                except OSError as e:
+                    if e.errno == errno.EINTR:#Interrupted by a signal such as SIGHUP
+                        continue
+                    raise
+                if pid not in self.pids:
+                    continue
+                index = self.pids.pop(pid)
+                print("[-] - Worker " + str(index) + " exited with status " + str(status) + ".")
+
+                #Don't fork in a tight loop when a worker dies right after starting
+                if time.time() - self.started[index] < 1:
+                    time.sleep(1)
+                self.spawn(index)
+        except KeyboardInterrupt:
+            self.stop()
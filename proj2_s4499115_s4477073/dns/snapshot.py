@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+
+""" Binary snapshots of a cache
+
+This module contains a compact binary format for the records of a RecordCache,
+which can be used instead of the JSON cache file. A snapshot is memory-mapped
+and searched in place, so opening it does not depend on its size, and records
+are only converted to ResourceRecords when they are looked up.
+
+The layout of a snapshot is:
+    header: magic, number of records, number of strings, offset of the string
+        index, offset of the records
+    string data: the owner names and rdata of all records, each stored once
+    string index: (offset, length) of every string
+    records: (name, type, class, ttl, timestamp, rdata) of every record, where
+        name and rdata are indices in the string index. The records are sorted
+        by lowercase owner name, type and class.
+"""
+
+import mmap
+import os
+import struct
+
+from dns.files import replace_file
+from dns.resource import ResourceRecord, RecordData
+
+
+MAGIC = b"PYDNSC01"
+
+HEADER = struct.Struct("!8sIIII")
+STRING = struct.Struct("!II")
+RECORD = struct.Struct("!IHHIII")
+
+
+class SnapshotError(Exception):
+    """ The file is not a valid snapshot """
+    pass
+
+
+def sort_key(record):
+    """ Order of the records in a snapshot """
+    return (encode(record.name).lower(), record.type_, record.class_)
+
+
+def encode(string):
+    """ Convert a name or rdata to bytes """
+    if isinstance(string, unicode):
+        return string.encode("utf-8")
+    return str(string)
+
+
+def write_snapshot(filename, records):
+    """ Write records to a snapshot file
+
+    The snapshot is written to a temporary file which is renamed to filename
+    (see dns.files.replace_file), so a snapshot that is memory-mapped by a reader is
+    never changed.
+
+    Args:
+        filename (str): the snapshot file
+        records ([ResourceRecord]): the records
+    """
+    records = sorted(records, key=sort_key)
+
+    #Intern all strings, every owner name and rdata is stored once
+    strings = []
+    string_ids = {}
+    def intern(string):
+        string = encode(string)
+        if string not in string_ids:
+            string_ids[string] = len(strings)
+            strings.append(string)
+        return string_ids[string]
+
+    packed_records = [RECORD.pack(intern(record.name), record.type_, record.class_,
+            record.ttl, record.timestamp, intern(record.rdata.data)) for record in records]
+
+    data_offset = HEADER.size
+    index = []
+    offset = data_offset
+    for string in strings:
+        index.append(STRING.pack(offset, len(string)))
+        offset += len(string)
+    index_offset = offset
+    record_offset = index_offset + len(index) * STRING.size
+
+    replace_file(filename, [HEADER.pack(MAGIC, len(records), len(strings), index_offset, record_offset),
+            b"".join(strings), b"".join(index), b"".join(packed_records)])
+
+
+class Snapshot(object):
+    """ A memory-mapped snapshot of cached records """
+
+    def __init__(self, filename):
+        """ Open a snapshot
+
+        Args:
+            filename (str): the snapshot file
+        """
+        with open(filename, "rb") as infile:
+            size = os.fstat(infile.fileno()).st_size
+            if size < HEADER.size:
+                raise SnapshotError("snapshot too short: " + filename)
+            self.data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.record_count, self.string_count, self.index_offset, self.record_offset = \
+                HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or self.record_offset + self.record_count * RECORD.size != size:
+            raise SnapshotError("not a cache snapshot: " + filename)
+
+    def __len__(self):
+        return self.record_count
+
+    def string(self, index):
+        """ Get a string from the string table """
+        offset, length = STRING.unpack_from(self.data, self.index_offset + index * STRING.size)
+        return self.data[offset:offset+length]
+
+    def name(self, i):
+        """ Get the lowercase owner name of record i """
+        name_id, = struct.unpack_from("!I", self.data, self.record_offset + i * RECORD.size)
+        return self.string(name_id).lower()
+
+    def record(self, i):
+        """ Convert record i to a ResourceRecord """
+        name_id, type_, class_, ttl, timestamp, rdata_id = \
+                RECORD.unpack_from(self.data, self.record_offset + i * RECORD.size)
+        rdata = RecordData.create(type_, self.string(rdata_id))
+        return ResourceRecord(self.string(name_id), type_, class_, ttl, rdata, timestamp)
+
+    def __iter__(self):
+        for i in range(self.record_count):
+            yield self.record(i)
+
+    def lookup(self, dname, type_, class_):
+        """ Get the records with a domain name, type and class
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+        """
+        dname = encode(dname).lower()
+
+        #Binary search for the first record with the owner name
+        low, high = 0, self.record_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.name(middle) < dname:
+                low = middle + 1
+            else:
+                high = middle
+
+        found = []
+        for i in range(low, self.record_count):
+            if self.name(i) != dname:
+                break
+            record = self.record(i)
+            if record.type_ == type_ and record.class_ == class_:
+                found.append(record)
+        return found
@@ -0,0 +1,90 @@
+#!/usr/bin/env python2
+
+""" A pool of UDP sockets for upstream queries
+
+This module contains a pool of pre-opened UDP sockets, each bound to a random
+source port, which the resolver reuses for its queries instead of opening a
+new socket for every query. A socket is used by one query at a time. Packets
+that arrive for an earlier query are thrown away before the socket is reused.
+"""
+
+import errno
+import random
+import socket
+import Queue
+
+
+class SocketPool(object):
+    """ A thread-safe pool of UDP sockets """
+
+    #Range of the random source ports
+    MIN_PORT = 1024
+    MAX_PORT = 65535
+
+    def __init__(self, size=8):
+        """ Initialize the pool, the sockets are opened by open
+
+        Args:
+            size (int): number of sockets kept open
+        """
+        self.size = size
+        self.sockets = Queue.Queue()
+        self.opened = False
+        self.random = random.SystemRandom()
+
+    def new_socket(self):
+        """ Open a UDP socket bound to a random source port """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        while True:
+            try:
+                sock.bind(('', self.random.randint(SocketPool.MIN_PORT, SocketPool.MAX_PORT)))
+                return sock
+            except socket.error as e:
+                if e.errno != errno.EADDRINUSE:
+                    sock.close()
+                    raise
+
+    def open(self):
+        """ Open the sockets of the pool """
+        for _ in range(self.size):
+            self.sockets.put(self.new_socket())
+        self.opened = True
+
+    def close(self):
+        """ Close the sockets of the pool """
+        self.opened = False
+        while True:
+            try:
+                self.sockets.get_nowait().close()
+            except Queue.Empty:
+                break
+
+    def acquire(self):
+        """ Take a socket from the pool
+
+        When the pool is closed or all its sockets are in use, a new socket
+        is opened, which is closed again when it is released.
+        """
+        try:
+            return self.sockets.get_nowait()
+        except Queue.Empty:
+            return self.new_socket()
+
+    def drain(self, sock):
+        """ Throw away the packets that are waiting on a socket """
+        sock.setblocking(0)
+        try:
+            while True:
+                sock.recv(4096)
+        except socket.error:
+            pass
+        finally:
+            sock.setblocking(1)
+
+    def release(self, sock):
+        """ Return a socket to the pool """
+        if not self.opened or self.sockets.qsize() >= self.size:
+            sock.close()
+            return
+        self.drain(sock)
+        self.sockets.put(sock)
@@ -1,25 +1,98 @@
 #!/usr/bin/env python2
+import json
+import multiprocessing
+import os
 import re
+import sys
+import threading
+import time
 import dns.zone
 import dns.consts as Consts
 import dns.classes
 import dns.resource
+import dns.rtypes
+import dns.zoneimage
 
 """ Zones of domain name space 
 
 See section 6.1.2 of RFC 1035 and section 4.2 of RFC 1034.
-Instead of tree structures we simply use dictionaries from domain names to
-zones or record sets.
+The catalog and the zones are trees of labels, from the root down.
 
 These classes are merely a suggestion, feel free to use something else.
 """
 
+TOKEN = re.compile(r'"[^"]*"|[()]|;.*|[^\s();"]+')
+TTL = re.compile(r"^(\d+[smhdw]?)+$", re.IGNORECASE)
+TIME = re.compile(r"(\d+)([smhdw]?)", re.IGNORECASE)
+TIME_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def labels(dname):
+    """ Get the lowercase labels of a domain name, from the root down """
+    dname = dname.rstrip('.').lower()
+    return list(reversed(dname.split('.'))) if dname else []
+
+
+def tokenize(lines):
+    """ Split the lines of a master file into entries
+
+    Comments are left out, and an entry in parentheses continues over the
+    next lines until they are closed. Quotes are removed from strings.
+
+    Args:
+        lines (iterable of str): the lines of the master file
+
+    Returns:
+        generator of (tokens, blank_owner), where blank_owner is True if the
+        entry starts with whitespace, so it has the owner of the previous one
+    """
+    tokens = []
+    depth = 0
+    blank_owner = False
+    for line in lines:
+        if depth == 0:
+            blank_owner = line[:1] in (" ", "\t")
+        for token in TOKEN.findall(line):
+            if token[0] == ";":
+                break
+            elif token == "(":
+                depth += 1
+            elif token == ")":
+                depth = max(depth - 1, 0)
+            elif token[0] == '"':
+                tokens.append(token[1:-1])
+            else:
+                tokens.append(token)
+        if depth == 0 and tokens:
+            yield tokens, blank_owner
+            tokens = []
+    if tokens:
+        yield tokens, blank_owner
+
+
+class CatalogNode(object):
+    """ A node in the label trie of a Catalog """
+
+    def __init__(self):
+        """ Initialize the node """
+        self.children = {}
+        self.name = None
+
+
 class Catalog(object):
-    """ A catalog of zones """
+    """ A catalog of zones
+
+    Besides the dictionary from root domain names to zones, the catalog keeps
+    a trie of the labels of the root domain names, from the root down. The
+    zone that encloses a domain name most closely is found by following the
+    labels of the name, so the time it takes depends on the number of labels
+    and not on the number of zones.
+    """
 
     def __init__(self):
         """ Initialize the catalog """
         self.zones = {}
+        self.root = CatalogNode()
 
     def add_zone(self, name, zone):
         """ Add a new zone to the catalog
@@ -29,95 +102,595 @@ class Catalog(object):
             zone (Zone): zone
         """
         self.zones[name] = zone
+        if zone.origin is None:
+            zone.origin = name
+        node = self.root
+        for label in labels(name):
+            node = node.children.setdefault(label, CatalogNode())
+        node.name = name
+
+    def with_zone(self, name, zone):
+        """ Get a copy of the catalog in which a zone is added or replaced
+
+        The catalog itself is not changed (copy-on-write), so handlers that
+        are using it never see a catalog or zone that is half changed.
+
+        Args:
+            name (str): root domain name
+            zone (Zone): zone
+        """
+        return self.with_zones({name: zone})
+
+    def with_zones(self, zones):
+        """ Get a copy of the catalog in which a number of zones are added or replaced
+
+        The copy is built once, whatever the number of zones, see with_zone.
+
+        Args:
+            zones ({str: Zone}): the zones by root domain name
+        """
+        catalog = Catalog()
+        for name, zone in self.zones.items():
+            if name not in zones:
+                catalog.add_zone(name, zone)
+        for name, zone in zones.items():
+            catalog.add_zone(name, zone)
+        return catalog
+
+    def find_zone(self, dname):
+        """ Find the zone that encloses a domain name most closely
+
+        Args:
+            dname (str): domain name
+
+        Returns:
+            (name, zone): the root domain name and the zone, None if no zone
+            in the catalog encloses dname
+        """
+        node = self.root
+        found = node.name
+        for label in labels(dname):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.name is not None:
+                found = node.name
+        if found is None:
+            return None
+        return found, self.zones[found]
+
+
+class ZoneNode(object):
+    """ A node in the name tree of a Zone """
+
+    __slots__ = ("name", "children", "rrsets")
+
+    def __init__(self, name):
+        """ Initialize the node
+
+        Args:
+            name (str): the lowercase domain name of the node
+        """
+        self.name = name
+        self.children = {}
+        self.rrsets = {}
 
 
 class Zone(object):
-    """ A zone in the domain name space """
+    """ A zone in the domain name space
 
-    def __init__(self):
-        """ Initialize the Zone """
-        self.records = {}
+    The records are kept in a tree with a node per domain name, from the root
+    down, and every node holds the record sets of its name by type. A lookup
+    (see find) descends the tree once along the labels of the name, on its
+    way noticing delegations to other nameservers and wildcards, so its cost
+    does not depend on the size of the zone.
+
+    A zone can also be served from a compiled image (see dns.zoneimage and
+    read_image) instead of the tree. Such a zone is read-only.
+    """
+
+    #Maximum number of CNAME records followed within a zone
+    MAX_CHAIN = 8
+
+    def __init__(self, origin=None):
+        """ Initialize the Zone
+
+        Args:
+            origin (str): root domain name of the zone, set by the catalog
+                when the zone is added if None
+        """
+        self.origin = origin
+        self.root = ZoneNode("")
+        self.count = 0
+        self.image = None
+        self.filename = None
+        self.image_file = None
+        self.mtime = None
+
+    def node(self, name, create=False):
+        """ Get the node of a domain name
+
+        Args:
+            name (str): domain name
+            create (bool): create the node and its parents if they do not exist
+
+        Returns:
+            the node, None if it does not exist
+        """
+        node = self.root
+        for label in labels(name):
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = ZoneNode(label + "." + node.name if node.name else label)
+                node.children[label] = child
+            node = child
+        return node
 
     def add_node(self, name, record_set):
         """ Add a record set to the zone
 
+        Records are added to the record set of their name and type, a record
+        that is already in the zone is not added again.
+
         Args:
             name (str): domain name
-            record_set ([ResourceRecord]): resource records
+            record_set ([ResourceRecord]): resource records, or a single record
         """
-        self.records[name] = record_set
+        if isinstance(record_set, dns.resource.ResourceRecord):
+            record_set = [record_set]
+        node = self.node(name, create=True)
+        for record in record_set:
+            rrset = node.rrsets.setdefault(record.type_, [])
+            if all(other.rdata.data != record.rdata.data for other in rrset):
+                rrset.append(record)
+                self.count += 1
+
+    def rrset(self, name, type_):
+        """ Get the record set of a domain name and type, [] if there is none """
+        if self.image is not None:
+            return self.image.rrset(name, type_)
+        node = self.node(name)
+        return list(node.rrsets.get(type_, [])) if node is not None else []
+
+    def rrsets(self):
+        """ Generate (name, type, records) for every record set in the zone """
+        if self.image is not None:
+            for rrset in self.image.rrsets():
+                yield rrset
+            return
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            for type_, records in node.rrsets.items():
+                yield node.name, type_, records
+            nodes.extend(node.children.values())
+
+    def find(self, dname, type_):
+        """ Look up the records of a domain name and type in one descent
+
+        A node with NS records below the origin is a delegation: the lookup
+        stops there and the NS records are returned as authority. When a
+        label does not exist, the records of the wildcard (*) at that level
+        are used, with dname as owner name. When dname has a CNAME record and
+        another type is asked for, the CNAME record is the answer.
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+
+        Returns:
+            answer ([ResourceRecord]): the records of dname (or its CNAME),
+            authority ([ResourceRecord]): the NS records of the delegation, or
+                of the origin if there is an answer,
+            exists (bool): if dname exists in the zone
+        """
+        if self.image is not None:
+            answer, authority, exists = self.image.find(dname, type_, self.origin)
+            return answer, authority or self.origin_ns(answer), exists
+
+        apex = len(labels(self.origin)) if self.origin is not None else 0
+        node = self.root
+        for depth, label in enumerate(labels(dname)):
+            child = node.children.get(label)
+            if child is None:
+                wildcard = node.children.get("*")
+                if wildcard is None or depth < apex:
+                    return [], [], False
+                answer = [dns.resource.ResourceRecord(dname, record.type_, record.class_, record.ttl,
+                        record.rdata) for record in self.answer(wildcard, type_)]
+                return answer, self.origin_ns(answer), True
+            node = child
+            if depth >= apex and dns.rtypes.Type.NS in node.rrsets:#Delegated to other nameservers
+                return [], list(node.rrsets[dns.rtypes.Type.NS]), True
+
+        answer = self.answer(node, type_)
+        return answer, self.origin_ns(answer), True
+
+    def answer(self, node, type_):
+        """ Get the records of a node for a type, or its CNAME record """
+        if type_ in node.rrsets:
+            return list(node.rrsets[type_])
+        return list(node.rrsets.get(dns.rtypes.Type.CNAME, []))
+
+    def origin_ns(self, answer):
+        """ Get the NS records of the origin to go along with an answer """
+        if not answer or self.origin is None:
+            return []
+        return self.rrset(self.origin, dns.rtypes.Type.NS)
 
     def read_master_file(self, filename=Consts.ZONE_FILE):
         """ Read the zone from a master file
 
-        See section 5 of RFC 1035.
+        See section 5 of RFC 1035. The file is read line by line and every
+        record is added as soon as it is parsed, so the file is never in
+        memory as a whole. The number of records loaded per second is kept
+        in load_rate.
 
         Args:
             filename (str): the filename of the master file
         """
         try:
+            started = time.time()
             with open(filename) as infile:
-                data = infile.read()
-                self.load_and_parse(data)
+                count = self.load(infile)
+            elapsed = time.time() - started
+            self.load_rate = count / elapsed if elapsed > 0 else float(count)
+            print("[+] - Loaded {0} records from {1} in {2:.2f} s ({3:.0f} records/s)".format(
+                    count, filename, elapsed, self.load_rate))
         except IOError as e:
             print("An error has occured while reading the zone from file: " \
                 + str(filename) + " - " + str(e))
 
-    #Kan mooier met een dict, maar het werkt.
-    #Als je zin hebt om het te verbeteren, ga je gang.
-    def time_to_seconds_helper(self, timestring):
-        if (timestring[-1] in ['s', 'S']):
-            return int(timestring[:-1])
-        if (timestring[-1] in ['m', 'M']):
-            return 60 * int(timestring[:-1])
-        if (timestring[-1] in ['h', 'H']):
-            return 3600 * int(timestring[:-1])
-        if (timestring[-1] in ['w', 'W']):
-            return 86400 * int(timestring[:-1])
-        if (timestring[-1] in ['d', 'D']):
-            return 604800 * int(timestring[:-1])
-        try:
-            if timestring == int(timestring):
-                return int(timestring)
-            else:
-                return 0
-        except:
-            return 0
+    def read_image(self, filename):
+        """ Serve the zone from a compiled image, see dns_zonec.py
+
+        Args:
+            filename (str): the image file
+        """
+        self.image = dns.zoneimage.ZoneImage(filename)
+        self.count = len(self.image)
+        if self.origin is None:
+            self.origin = self.image.origin
 
-    def time_to_seconds(self, timestring):
-        return sum(map(self.time_to_seconds_helper, re.findall(re.compile("\d+\w"), timestring)))
+    def read_zone(self, filename=Consts.ZONE_FILE, image_file=Consts.ZONE_IMAGE):
+        """ Read the zone from its image if that is up to date, else from the master file
+
+        The image is up to date if it was compiled from a master file with the
+        same SHA-1 checksum as filename.
+
+        Args:
+            filename (str): the filename of the master file
+            image_file (str): the filename of the compiled image
+        """
+        self.filename = filename
+        self.image_file = image_file
+        self.mtime = os.path.getmtime(filename) if os.path.exists(filename) else None
+        if image_file is not None and os.path.exists(image_file):
+            try:
+                image = dns.zoneimage.ZoneImage(image_file)
+                if os.path.exists(filename) and image.digest != dns.zoneimage.checksum(filename):
+                    print("[-] - Zone image " + image_file + " is stale, reading " + filename)
+                else:
+                    self.read_image(image_file)
+                    print("[+] - Serving " + str(self.count) + " records from " + image_file)
+                    return
+            except (IOError, dns.zoneimage.ZoneImageError) as e:
+                print("An error has occured while opening the zone image: " + str(e))
+        self.read_master_file(filename)
+
+    def reload(self):
+        """ Read the zone again from the files it was read from
+
+        Returns:
+            a new Zone, this zone is not changed
+        """
+        zone = Zone(self.origin)
+        zone.read_zone(self.filename, self.image_file)
+        return zone
+
+    def changed(self):
+        """ Check if the master file of the zone has changed since it was read """
+        if self.filename is None or not os.path.exists(self.filename):
+            return False
+        return os.path.getmtime(self.filename) != self.mtime
+
+    def memory(self):
+        """ Estimate the number of bytes the zone takes
+
+        For a zone served from an image this is the size of the image, which
+        is mapped into memory and shared by all processes that serve it.
+        """
+        if self.image is not None:
+            return len(self.image.data)
+        size = 0
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            size += sys.getsizeof(node) + sys.getsizeof(node.name) + sys.getsizeof(node.children) + \
+                    sys.getsizeof(node.rrsets)
+            for records in node.rrsets.values():
+                size += sys.getsizeof(records)
+                for record in records:
+                    size += sys.getsizeof(record) + sys.getsizeof(record.__dict__) + \
+                            sys.getsizeof(record.rdata) + sys.getsizeof(record.rdata.data)
+            nodes.extend(node.children.values())
+        return size
+
+    def record_keys(self):
+        """ Get a set that identifies every record in the zone, to compare zones """
+        return set((name, type_, record.class_, record.ttl, record.rdata.data)
+                for name, type_, records in self.rrsets() for record in records)
+
+    def load(self, lines):
+        """ Add the records of a master file to the zone
+
+        A zone without origin gets the owner of its SOA record as origin.
+
+        Args:
+            lines (iterable of str): the lines of the master file
+
+        Returns:
+            the number of records that were parsed
+        """
+        count = 0
+        for record in self.parse(lines):
+            #The SOA record is at the origin of the zone
+            if self.origin is None and record.type_ == dns.rtypes.Type.SOA:
+                self.origin = record.name
+            self.add_node(record.name, record)
+            count += 1
+        return count
 
     def load_and_parse(self, content):
-        content = re.sub(re.compile(";.*?\n"), "\n", content) #Remove comments
-        content = re.sub(re.compile("\n\n*\n") , "\n", content) #Remove whitespaces
-        content = re.sub(re.compile("  * ") , " ", content) #Remove multiple spaces between words
-        content = re.sub(re.compile("\t\t*\t") , " ", content) #Remove tabs between words
-        content = re.sub(re.compile("\n *") , "\n", content) #Remove spaces at start of line
-        content = re.sub(re.compile("\n\t*") , "\n", content) #Remove tabs at start of line
-        content = re.compile(r'\(.*?\)', re.DOTALL)\
-        .sub(lambda x: x.group().replace('\n', ''), content) #Remove newlines between ()
-        content = re.sub(re.compile("\t+") , " ", content) #Remove tabs between words
+        """ Add the records of a master file in a string to the zone """
+        return self.load(content.splitlines(True))
+
+    @staticmethod
+    def time_to_seconds(timestring):
+        """ Convert a TTL such as 3600 or 1h30m to seconds """
+        return sum(int(number) * TIME_UNITS[unit.lower()] for number, unit in TIME.findall(timestring))
+
+    @staticmethod
+    def absolute(name, origin):
+        """ Make a domain name of a master file absolute, without the trailing dot
 
+        Args:
+            name (str): domain name, @ for the origin
+            origin (str): the current origin
+        """
+        if name == "@":
+            return origin or ""
+        if name.endswith("."):
+            return name.rstrip(".")
+        return name + "." + origin if origin else name
+
+    def parse(self, lines):
+        """ Parse the records of a master file
+
+        A generator that handles comments, parentheses around data that spans
+        several lines, $TTL, $ORIGIN, @, relative names, blank owner names
+        (the owner of the previous record) and TTL and class in either order.
+
+        Args:
+            lines (iterable of str): the lines of the master file
+
+        Returns:
+            generator of ResourceRecords
+        """
+        origin = self.origin
         default_ttl = None
-        origin = None
-
-        recordSet = []
-
-        for line in content.split('\n'):
-            if line[:4] == "$TTL":
-                prev_ttl = self.time_to_seconds(line[4:].strip())
-            elif line[:7] == "$ORIGIN":
-                origin = line[7:].strip()
-            elif "SOA" not in line:
-                parts = line.split(' ')
-                rr_name = parts[0]
-                
-                rr_ttl = self.time_to_seconds(parts[1])
-                offset = int(rr_ttl == 0)
-                if offset:
-                    rr_ttl = prev_ttl
-
-                rr_class = dns.classes.Class.from_string(parts[1+offset])
-                rr_type = parts[2+offset]
-                rr_data = dns.resource.RecordData.create(rr_type, parts[3+offset].rstrip('.'))
-                self.add_node(rr_name, dns.resource.ResourceRecord(rr_name, dns.rtypes.Type.by_string[rr_type], rr_class, rr_ttl, rr_data))
+        last_ttl = 0
+        owner = origin
+        for tokens, blank_owner in tokenize(lines):
+            directive = tokens[0].upper()
+            if directive == "$TTL":
+                default_ttl = self.time_to_seconds(tokens[1])
+                continue
+            elif directive == "$ORIGIN":
+                origin = self.absolute(tokens[1], origin)
+                continue
+            elif directive.startswith("$"):
+                print("[-] - Unsupported directive in master file: " + tokens[0])
+                continue
+
+            if not blank_owner:
+                owner = self.absolute(tokens.pop(0), origin)
+
+            #The TTL and class are optional and can be in either order
+            rr_ttl = None
+            rr_class = dns.classes.Class.IN
+            while len(tokens) > 1:
+                if TTL.match(tokens[0]):
+                    rr_ttl = self.time_to_seconds(tokens.pop(0))
+                elif tokens[0].upper() in dns.classes.Class.by_string:
+                    rr_class = dns.classes.Class.from_string(tokens.pop(0).upper())
+                else:
+                    break
+            if rr_ttl is None:
+                rr_ttl = default_ttl if default_ttl is not None else last_ttl
+            last_ttl = rr_ttl
+
+            rr_type = dns.rtypes.Type.by_string.get(tokens[0].upper())
+            if rr_type is None:
+                print("[-] - Unknown type in master file: " + tokens[0])
+                continue
+            rdata = tokens[1:]
+            if rr_type in (dns.rtypes.Type.NS, dns.rtypes.Type.CNAME):
+                rdata = [self.absolute(rdata[0], origin)]
+            elif rr_type == dns.rtypes.Type.SOA:
+                rdata = [self.absolute(rdata[0], origin), self.absolute(rdata[1], origin)] + \
+                        [str(self.time_to_seconds(field)) for field in rdata[2:7]]
+            rr_data = dns.resource.RecordData.create(rr_type, " ".join(rdata))
+            yield dns.resource.ResourceRecord(owner, rr_type, rr_class, rr_ttl, rr_data)
+
+
+class LazyZone(object):
+    """ A zone that is only read when it is first used
+
+    Every attribute that the LazyZone does not have itself is taken from the
+    Zone, which is read (see Zone.read_zone) the first time one is asked for.
+    """
+
+    def __init__(self, origin, filename, image_file=None):
+        """ Initialize the zone, without reading it
+
+        Args:
+            origin (str): root domain name of the zone
+            filename (str): the filename of the master file
+            image_file (str): the filename of the compiled image
+        """
+        self.origin = origin
+        self.filename = filename
+        self.image_file = image_file
+        self.zone = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Read the zone if that has not been done yet and return it
+
+        The number of records and the memory of the zone are printed once it
+        is read, because at startup a lazy zone can only be reported as not loaded.
+        """
+        if self.zone is None:
+            with self.lock:
+                if self.zone is None:
+                    zone = Zone(self.origin)
+                    zone.read_zone(self.filename, self.image_file)
+                    self.zone = zone
+                    print("[*] - Zone " + self.origin + " loaded: " + str(zone.count) + " records, %.1f KiB" \
+                            % (zone.memory() / 1024.0))
+        return self.zone
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def reload(self):
+        """ Read the zone again, a zone that was not read yet stays lazy """
+        if self.zone is None:
+            return LazyZone(self.origin, self.filename, self.image_file)
+        return self.zone.reload()
+
+    def changed(self):
+        """ Check if the master file has changed since the zone was read """
+        return self.zone is not None and self.zone.changed()
+
+    def memory(self):
+        """ Estimate the number of bytes the zone takes, 0 if it was not read yet """
+        return self.zone.memory() if self.zone is not None else 0
+
+    def record_keys(self):
+        """ Get a set that identifies every record in the zone, empty if it was not read yet """
+        return self.zone.record_keys() if self.zone is not None else set()
+
+
+#How the zones of a configuration file are loaded
+LOAD_MODES = ["lazy", "eager"]
+
+
+def compile_zone(spec):
+    """ Compile the image of a zone if it is missing or stale
+
+    Runs in a worker process of read_config.
+
+    Args:
+        spec ((str, str, str)): root domain name, master file and image file
+
+    Returns:
+        (name, compiled): compiled is True if the image was written
+    """
+    name, filename, image_file = spec
+    digest = dns.zoneimage.checksum(filename)
+    try:
+        if dns.zoneimage.ZoneImage(image_file).digest == digest:
+            return name, False
+    except (IOError, dns.zoneimage.ZoneImageError):
+        pass
+    zone = Zone(name)
+    zone.read_master_file(filename)
+    dns.zoneimage.write_image(image_file, zone, digest)
+    return name, True
+
+
+def load_config(filename):
+    """ Read a configuration file, see read_config
+
+    Args:
+        filename (str): the configuration file
+
+    Returns:
+        (load, processes, specs): the load mode, the number of compiling
+        processes and (root domain name, master file, image file) per zone
+    """
+    with open(filename) as infile:
+        config = json.load(infile)
+    base = os.path.dirname(os.path.abspath(filename))
+    def path(name):
+        return os.path.join(base, str(name)) if name else None
+
+    load = config.get("load", "lazy")
+    if load not in LOAD_MODES:
+        raise ValueError("unknown load mode: " + str(load))
+    specs = [(str(zone["name"]), path(zone["file"]), path(zone.get("image"))) for zone in config["zones"]]
+    return load, config.get("processes") or None, specs
+
+
+def compile_images(filename):
+    """ Compile the missing and stale images of the zones of an eager configuration
+
+    Python objects can not be shared between processes, images can: they are
+    compiled in parallel by a pool of processes and then mapped by the server.
+    With several server processes the supervisor calls this once before it
+    forks them, so they do not compile the same images at the same time.
+
+    Args:
+        filename (str): the configuration file
+    """
+    load, processes, specs = load_config(filename)
+    stale = [spec for spec in specs if spec[2] is not None and os.path.exists(spec[1])]
+    if load != "eager" or not stale:
+        return
+    started = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        compiled = [name for name, done in pool.map(compile_zone, stale) if done]
+    finally:
+        pool.close()
+        pool.join()
+    print("[+] - Compiled " + str(len(compiled)) + " zone images in %.2f s" % (time.time() - started))
+
+
+def read_config(filename, compile=True):
+    """ Build a catalog from a configuration file
+
+    The configuration file is a JSON object:
+        zones: list of objects with the root domain name (name), the master
+            file (file) and optionally the compiled image (image) of a zone,
+            relative paths are relative to the configuration file
+        load: "lazy" (default) to read every zone when it is first used,
+            "eager" to read all zones at once
+        processes: number of processes that compile the stale images of the
+            zones in eager mode (default: one per core)
+
+    Args:
+        filename (str): the configuration file
+        compile (bool): compile the stale images in eager mode first, see
+            compile_images
+
+    Returns:
+        the Catalog of the zones
+    """
+    if compile:
+        compile_images(filename)
+    load, _, specs = load_config(filename)
+
+    catalog = Catalog()
+    for name, zone_file, image_file in specs:
+        if load == "lazy":
+            zone = LazyZone(name, zone_file, image_file)
+        else:
+            zone = Zone(name)
+            zone.read_zone(zone_file, image_file)
+        catalog.add_zone(name, zone)
+    return catalog
@@ -0,0 +1,249 @@
+#!/usr/bin/env python2
+
+""" Compiled binary images of zones
+
+This module contains a binary format for the records of a Zone, written by
+dns_zonec.py from a master file. An image is memory-mapped and searched in
+place, so a zone is ready to serve as soon as it is opened, whatever its size.
+
+The layout of an image is:
+    header: magic, SHA-1 of the master file it was compiled from, the origin
+        and the number and offsets of the names, rrsets and records
+    data: the names and the rdata of all records, the rdata in wire format
+    names: (offset, length, first rrset, number of rrsets) of every name,
+        sorted by the key of the name: its lowercase labels from the root
+        down, separated by NUL characters, so all names below a name directly
+        follow it
+    rrsets: (type, class, first record, number of records) of every rrset
+    records: (offset, length) of the rdata and the ttl of every record
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+
+from dns.domainname import Composer, Parser
+from dns.resource import ResourceRecord, RecordData
+from dns.rtypes import Type
+from dns.files import replace_file
+
+
+MAGIC = b"PYDNSZ01"
+
+HEADER = struct.Struct("!8s20sIIIIIIII")
+NAME = struct.Struct("!IIII")
+RRSET = struct.Struct("!HHII")
+RECORD = struct.Struct("!III")
+
+
+class ZoneImageError(Exception):
+    """ The file is not a valid zone image """
+    pass
+
+
+def name_key(dname):
+    """ Key of a domain name in the name index of an image """
+    dname = dname.rstrip('.').lower()
+    return "\0".join(reversed(dname.split('.'))) if dname else ""
+
+
+def key_name(key):
+    """ Domain name of a key in the name index of an image """
+    return ".".join(reversed(key.split("\0"))) if key else ""
+
+
+def checksum(filename):
+    """ SHA-1 digest of a file, read in blocks """
+    digest = hashlib.sha1()
+    with open(filename, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+def write_image(filename, zone, digest):
+    """ Write the records of a zone to an image file
+
+    The image is written to a temporary file which is renamed to filename
+    (see dns.files.replace_file), so an image that is memory-mapped by a
+    server is never changed, and processes that compile the same image at the
+    same time do not write into each other's file.
+
+    Args:
+        filename (str): the image file
+        zone (Zone): the zone
+        digest (bytes): SHA-1 of the master file of the zone
+    """
+    names = {}
+    for name, type_, records in zone.rrsets():
+        names.setdefault(name_key(name), []).append((type_, records))
+
+    data = []
+    offset = [HEADER.size]
+    def store(string):
+        data.append(string)
+        offset[0] += len(string)
+        return offset[0] - len(string)
+
+    origin = zone.origin or ""
+    origin_offset = store(origin)
+    packed_names = []
+    packed_rrsets = []
+    packed_records = []
+    for key in sorted(names):
+        packed_names.append(NAME.pack(store(key), len(key), len(packed_rrsets), len(names[key])))
+        for type_, records in sorted(names[key]):
+            packed_rrsets.append(RRSET.pack(type_, records[0].class_, len(packed_records), len(records)))
+            for record in records:
+                rdata = record.rdata.to_bytes(0, Composer())
+                packed_records.append(RECORD.pack(store(rdata), len(rdata), record.ttl))
+
+    names_offset = offset[0]
+    rrsets_offset = names_offset + len(packed_names) * NAME.size
+    records_offset = rrsets_offset + len(packed_rrsets) * RRSET.size
+    replace_file(filename, [HEADER.pack(MAGIC, digest, origin_offset, len(origin), len(packed_names),
+            len(packed_rrsets), len(packed_records), names_offset, rrsets_offset, records_offset),
+            b"".join(data), b"".join(packed_names), b"".join(packed_rrsets), b"".join(packed_records)])
+
+
+class ZoneImage(object):
+    """ A memory-mapped image of a zone, see Zone.read_image """
+
+    def __init__(self, filename):
+        """ Open an image
+
+        Args:
+            filename (str): the image file
+        """
+        with open(filename, "rb") as infile:
+            size = os.fstat(infile.fileno()).st_size
+            if size < HEADER.size:
+                raise ZoneImageError("image too short: " + filename)
+            self.data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.digest, origin_offset, origin_length, self.name_count, self.rrset_count, \
+                self.record_count, self.names_offset, self.rrsets_offset, self.records_offset = \
+                HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or self.records_offset + self.record_count * RECORD.size != size:
+            raise ZoneImageError("not a zone image: " + filename)
+        self.origin = self.data[origin_offset:origin_offset+origin_length] or None
+
+    def __len__(self):
+        return self.record_count
+
+    def key(self, i):
+        """ Get the key of name i """
+        offset, length, _, _ = NAME.unpack_from(self.data, self.names_offset + i * NAME.size)
+        return self.data[offset:offset+length]
+
+    def search(self, key):
+        """ Get the index of the first name whose key is not below key """
+        low, high = 0, self.name_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, key):
+        """ Check a key in the name index
+
+        Returns:
+            (index, exists): the index of the name with the key, None if there
+            is none, and whether the name exists, possibly as the parent of
+            other names only
+        """
+        i = self.search(key)
+        if i == self.name_count:
+            return None, False
+        found = self.key(i)
+        if found == key:
+            return i, True
+        return None, found.startswith(key + "\0")
+
+    def records(self, i, type_, owner=None):
+        """ Get the records of name i and a type
+
+        Args:
+            i (int): index of the name
+            type_ (Type): type
+            owner (str): owner name of the records, the name itself if None
+        """
+        _, _, first, count = NAME.unpack_from(self.data, self.names_offset + i * NAME.size)
+        for j in range(first, first + count):
+            rrset_type, class_, first_record, record_count = \
+                    RRSET.unpack_from(self.data, self.rrsets_offset + j * RRSET.size)
+            if rrset_type != type_:
+                continue
+            if owner is None:
+                owner = key_name(self.key(i))
+            found = []
+            for k in range(first_record, first_record + record_count):
+                offset, length, ttl = RECORD.unpack_from(self.data, self.records_offset + k * RECORD.size)
+                rdata = RecordData.from_bytes(type_, self.data[offset:offset+length], 0, length, Parser())
+                found.append(ResourceRecord(owner, type_, class_, ttl, rdata))
+            return found
+        return []
+
+    def types(self, i):
+        """ Get the types of the rrsets of name i """
+        _, _, first, count = NAME.unpack_from(self.data, self.names_offset + i * NAME.size)
+        return [RRSET.unpack_from(self.data, self.rrsets_offset + j * RRSET.size)[0]
+                for j in range(first, first + count)]
+
+    def rrset(self, name, type_):
+        """ Get the record set of a domain name and type, [] if there is none """
+        i, exists = self.lookup(name_key(name))
+        return self.records(i, type_) if i is not None else []
+
+    def rrsets(self):
+        """ Generate (name, type, records) for every record set in the image """
+        for i in range(self.name_count):
+            name = key_name(self.key(i))
+            for type_ in self.types(i):
+                yield name, type_, self.records(i, type_, name)
+
+    def answer(self, i, type_, owner=None):
+        """ Get the records of name i for a type, or its CNAME record """
+        return self.records(i, type_, owner) or self.records(i, Type.CNAME, owner)
+
+    def find(self, dname, type_, origin):
+        """ Look up the records of a domain name and type, see Zone.find
+
+        The names from the origin down to dname are looked up in the index,
+        so the lookup takes a binary search per label below the origin.
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            origin (str): root domain name of the zone
+
+        Returns:
+            answer, authority and exists as Zone.find, except that the
+            authority of an answer is left to the caller
+        """
+        names = name_key(dname).split("\0") if dname.rstrip('.') else []
+        apex = len(name_key(origin).split("\0")) if origin else 0
+        if names[:apex] != (name_key(origin).split("\0") if origin else []):
+            return [], [], False
+
+        i = None
+        for depth in range(max(apex, 1), len(names) + 1):
+            key = "\0".join(names[:depth])
+            i, exists = self.lookup(key)
+            if not exists:
+                if depth - 1 < apex:
+                    return [], [], False
+                wildcard, _ = self.lookup("\0".join(names[:depth-1] + ["*"]))
+                if wildcard is None:
+                    return [], [], False
+                return self.answer(wildcard, type_, dname), [], True
+            if depth > apex and i is not None and Type.NS in self.types(i):#Delegated to other nameservers
+                return [], self.records(i, Type.NS), True
+
+        if i is None:
+            return [], [], True
+        return self.answer(i, type_), [], True
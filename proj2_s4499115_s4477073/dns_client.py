@@ -3,10 +3,76 @@
 """ Simple DNS client
 
 A simple example of a client using the DNS resolver.
+
+In batch mode (-b FILE) the client resolves every hostname in FILE, one per
+line ("-" reads stdin), many at a time, and writes one JSON object per
+hostname to stdout. Throughput and latency percentiles are printed to stderr
+at the end.
 """
 
+import json
+import sys
+import time
+
 import dns.resolver
 
+
+def percentile(values, p):
+    """ Nearest-rank percentile of a sorted list
+
+    Args:
+        values ([float]): sorted values
+        p (int): the percentile, between 0 and 100
+    """
+    if not values:
+        return 0
+    index = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def read_hostnames(infile):
+    """ Read the hostnames of a batch, skipping blank lines and comments """
+    for line in infile:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+
+def run_batch(resolver, infile, concurrency):
+    """ Resolve the hostnames in infile and report the results
+
+    Args:
+        resolver (Resolver): the resolver
+        infile (file): file with one hostname per line
+        concurrency (int): maximum number of resolutions in progress
+    """
+    #The resolver reports its progress on stdout, keep stdout for the results
+    out = sys.stdout
+    sys.stdout = sys.stderr
+
+    latencies = []
+    failed = 0
+    started = time.time()
+    try:
+        for hostname, aliases, addresses, seconds in resolver.resolve_many(read_hostnames(infile), concurrency):
+            out.write(json.dumps({"hostname": hostname, "aliases": aliases, "addresses": addresses,
+                    "time": round(seconds, 6)}) + "\n")
+            latencies.append(seconds)
+            if not addresses:
+                failed += 1
+        elapsed = time.time() - started
+        out.flush()
+    finally:
+        sys.stdout = out
+
+    latencies.sort()
+    rate = len(latencies) / elapsed if elapsed > 0 else 0
+    sys.stderr.write("Resolved {0} names in {1:.2f} s ({2:.1f} names/s), {3} without address\n".format(
+            len(latencies), elapsed, rate, failed))
+    sys.stderr.write("Latency p50 {0:.1f} ms, p90 {1:.1f} ms, p99 {2:.1f} ms\n".format(
+            *[percentile(latencies, p) * 1000 for p in (50, 90, 99)]))
+
+
 if __name__ == "__main__":
     # Parse arguments
     import argparse
@@ -14,14 +80,33 @@ if __name__ == "__main__":
     parser.add_argument("hostname", help="hostname to resolve", nargs='?', type=str, default="www.nu.nl")
     parser.add_argument("-c", "--caching", action="store_true",
             help="Enable caching")
-    parser.add_argument("-t", "--ttl", metavar="time", type=int, default=0, 
+    parser.add_argument("-t", "--ttl", metavar="time", type=int, default=0,
             help="TTL value of cached entries")
+    parser.add_argument("-b", "--batch", metavar="FILE", type=str,
+            help="Resolve the hostnames in FILE (- for stdin) and write JSON lines")
+    parser.add_argument("--concurrency", metavar="N", type=int, default=100,
+            help="Number of hostnames resolved at once in batch mode")
     args = parser.parse_args()
-    
+
+    resolver = dns.resolver.Resolver(5, args.caching, args.ttl)
+    resolver.open()
+
+    # Resolve the batch
+    if args.batch is not None:
+        infile = sys.stdin if args.batch == "-" else open(args.batch)
+        try:
+            run_batch(resolver, infile, args.concurrency)
+        finally:
+            infile.close()
+            resolver.close()
+            resolver.save_cache()
+        sys.exit(0)
+
     # Resolve hostname
-    resolver = dns.resolver.Resolver(args.caching, args.ttl)
     hostname, aliases, addresses = resolver.gethostbyname(args.hostname)
-    
+    resolver.close()
+    resolver.save_cache()
+
     # Print output
     print(hostname)
     print(aliases)
@@ -5,7 +5,9 @@
 This script contains the code for starting a DNS server.
 """
 
+import dns.cache
 import dns.server
+import sys
 import time
 
 if __name__ == "__main__":
@@ -18,10 +20,61 @@ if __name__ == "__main__":
             help="TTL value of cached entries (if > 0)")
     parser.add_argument("-p", "--port", type=int, default=5353,
             help="Port which server listens on")
+    parser.add_argument("-e", "--engine", choices=dns.server.Server.ENGINES, default="threaded",
+            help="Request handling engine: a thread per request or a worker pool")
+    parser.add_argument("--pool-size", type=int, default=16,
+            help="Number of worker threads of the pool engine")
+    parser.add_argument("--workers", metavar="N", type=int, default=0,
+            help="Fork N worker processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument("--cache-entries", metavar="N", type=int, default=0,
+            help="Maximum number of cached records (if > 0)")
+    parser.add_argument("--cache-bytes", metavar="N", type=int, default=0,
+            help="Approximate maximum size of the cache in bytes (if > 0)")
+    parser.add_argument("--cache-policy", choices=dns.cache.RecordCache.POLICIES, default="lru",
+            help="Eviction policy of the cache")
+    parser.add_argument("--cache-shards", metavar="N", type=int, default=0,
+            help="Split the cache over N independently locked shards (if > 1)")
+    parser.add_argument("--cache-journal", action="store_true",
+            help="Persist the cache incrementally in an append-only journal")
+    parser.add_argument("--cache-format", choices=dns.cache.RecordCache.FORMATS, default="json",
+            help="Format of the cache file: readable JSON or a memory-mapped binary snapshot")
+    parser.add_argument("--cache-prefetch", metavar="FRACTION", type=float, default=0.1,
+            help="Refresh popular records hit in this final part of their TTL (0 disables)")
+    parser.add_argument("--cache-stale", metavar="SECONDS", type=int, default=0,
+            help="Serve records up to SECONDS after their TTL when they can not be resolved (if > 0)")
+    parser.add_argument("--watch-zones", metavar="SECONDS", type=float, default=0,
+            help="Reload zones whose master file changed, checked every SECONDS (if > 0)")
+    parser.add_argument("--config", metavar="FILE", type=str, default=None,
+            help="Configuration file with the zones to serve (default: ru.nl from zone.txt)")
+    parser.add_argument("--response-cache", metavar="N", type=int, default=10000,
+            help="Number of encoded responses from the zones that are cached (0 disables)")
     args = parser.parse_args()
+    server_args = {
+        "cache_entries": args.cache_entries,
+        "cache_bytes": args.cache_bytes,
+        "cache_policy": args.cache_policy,
+        "cache_shards": args.cache_shards,
+        "cache_journal": args.cache_journal,
+        "cache_format": args.cache_format,
+        "cache_prefetch": args.cache_prefetch,
+        "cache_stale": args.cache_stale,
+        "watch_zones": args.watch_zones,
+        "config": args.config,
+        "response_cache": args.response_cache
+    }
+
+    # Start a supervised worker process per core
+    if args.workers > 0:
+        supervisor = dns.server.Supervisor(args.workers, args.port, args.caching, args.ttl,
+                engine=args.engine, pool_size=args.pool_size, **server_args)
+        supervisor.serve()
+        print("[*] - Workers stopped.")
+        sys.exit(0)
 
     # Start server
-    server = dns.server.Server(args.port, args.caching, args.ttl)
+    server = dns.server.Server(args.port, args.caching, args.ttl, args.engine, args.pool_size,
+            **server_args)
+    server.handle_signals()
     
     try:
         server.serve()
@@ -1,16 +1,39 @@
 #!/usr/bin/env python3
 
 import argparse
+import errno
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import StringIO
+import struct
+import tempfile
 import unittest
 import sys
 import time
+import threading
 from threading import Thread
 
+import dns.cache
+import dns.domainname
+import dns.files
+import dns.inflight
+import dns.message
+import dns.multiplexer
+import dns.rcodes
 import dns.resolver
 import dns.resource
+import dns.responsecache
 import dns.rtypes
 import dns.classes
 import dns.server
+import dns.socketpool
+import dns.zone
+import dns.zoneimage
+import dns_client
 
 
 """ Tests for your DNS resolver and server """
@@ -66,6 +89,1267 @@ class TestResolverCache(unittest.TestCase):
         self.assertEqual([], al)
         self.assertEqual([], ad)
 
+class TestRecordCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = dns.cache.RecordCache(None)
+
+    def record(self, name, address, ttl, timestamp=None):
+        return dns.resource.ResourceRecord(name, dns.rtypes.Type.A,\
+                dns.classes.Class.IN, ttl, dns.resource.ARecordData(address),\
+                timestamp)
+
+    def testLookupByKey(self):
+        self.cache.add_record(self.record("shuckle.ru.nl", "42.42.42.42", 60))
+        self.cache.add_record(self.record("shuckle.ru.nl", "42.42.42.43", 60))
+        self.cache.add_record(self.record("hestia.dance", "162.246.59.52", 60))
+
+        found = self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+        self.assertEqual(["42.42.42.42", "42.42.42.43"], sorted(r.rdata.data for r in found))
+        self.assertEqual([], self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.CNAME, dns.classes.Class.IN))
+
+    def testDuplicateExtendsTTL(self):
+        self.cache.add_record(self.record("shuckle.ru.nl", "42.42.42.42", 10))
+        self.cache.add_record(self.record("shuckle.ru.nl", "42.42.42.42", 100))
+
+        found = self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+        self.assertEqual(1, len(found))
+        self.assertTrue(found[0].ttl > 10)
+
+    def testCleanupRemovesExpired(self):
+        self.cache.add_record(self.record("shuckle.ru.nl", "42.42.42.42", 10, int(time.time()) - 20))
+        self.cache.add_record(self.record("hestia.dance", "162.246.59.52", 60))
+        self.cache.cleanup()
+
+        self.assertEqual(["hestia.dance"], [r.name for r in self.cache.all_records()])
+        self.assertEqual([], self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN))
+
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.cache = dns.cache.RecordCache(None, prefetch_fraction=0.1)
+        self.refreshed = []
+        self.release = threading.Event()
+        def prefetcher(dname, type_, class_):
+            self.refreshed.append(dname)
+            self.release.wait()
+        self.cache.set_prefetcher(prefetcher)
+
+    def record(self, name, address, ttl, timestamp=None):
+        return dns.resource.ResourceRecord(name, dns.rtypes.Type.A,\
+                dns.classes.Class.IN, ttl, dns.resource.ARecordData(address),\
+                timestamp)
+
+    def testPopularRecordIsRefreshedOnce(self):
+        self.cache.add_record(self.record("shuckle.ru.nl", "42.42.42.42", 100, int(time.time()) - 95))
+        for _ in range(5):
+            found = self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+            self.assertEqual(1, len(found))
+        self.release.set()
+
+        self.assertEqual(5, self.cache.hit_count("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN))
+        self.assertEqual(1, self.cache.prefetches)
+        while not self.refreshed:
+            time.sleep(0.01)
+        self.assertEqual(["shuckle.ru.nl"], self.refreshed)
+
+    def testFreshOrUnpopularRecordIsNotRefreshed(self):
+        self.cache.add_record(self.record("shuckle.ru.nl", "42.42.42.42", 100))
+        self.cache.add_record(self.record("hestia.dance", "162.246.59.52", 100, int(time.time()) - 95))
+        for _ in range(3):
+            self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+        self.cache.lookup("hestia.dance", dns.rtypes.Type.A, dns.classes.Class.IN)
+
+        self.assertEqual(0, self.cache.prefetches)
+
+    def testRefreshesAreBounded(self):
+        queue = dns.cache.PrefetchQueue(self.cache.prefetcher.prefetcher, workers=1, size=1)
+        self.cache.set_prefetch_queue(queue)
+        names = ["host" + str(i) + ".ru.nl" for i in range(5)]
+        threads = threading.active_count()
+        for name in names:
+            self.cache.add_record(self.record(name, "42.42.42.42", 100, int(time.time()) - 95))
+            for _ in range(2):
+                self.cache.lookup(name, dns.rtypes.Type.A, dns.classes.Class.IN)
+            while name == names[0] and not self.refreshed:#The worker is busy with the first name
+                time.sleep(0.01)
+
+        self.assertEqual(threads + 1, threading.active_count())
+        self.assertEqual(2, self.cache.prefetches)
+        self.assertEqual(3, queue.dropped)
+        self.release.set()
+        while len(self.refreshed) < 2:
+            time.sleep(0.01)
+        self.assertEqual(names[:2], self.refreshed)
+
+    def testResolverRefreshesRecord(self):
+        resolver = dns.resolver.Resolver(5, True, 100, ["192.0.2.1"], False, self.cache)
+        def ask_servers(query, hints):
+            header = dns.message.Header(query.header.ident, 0, 1, 1, 0, 0)
+            header.qr = 1
+            answer = dns.resource.ResourceRecord("shuckle.ru.nl", dns.rtypes.Type.A,\
+                    dns.classes.Class.IN, 100, dns.resource.ARecordData("42.42.42.42"))
+            response = dns.message.Message(header, query.questions, [answer])
+            resolver.cache_response(response)
+            return response, hints[:1]
+        resolver.ask_servers = ask_servers
+        self.cache.add_record(self.record("shuckle.ru.nl", "42.42.42.42", 100, int(time.time()) - 95))
+
+        for _ in range(2):
+            h, al, ad = resolver.gethostbyname("shuckle.ru.nl")
+            self.assertEqual(["42.42.42.42"], ad)
+        for _ in range(100):
+            found = self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+            if found[0].ttl > 10:
+                break
+            time.sleep(0.01)
+        self.assertTrue(found[0].ttl > 10)
+
+
+class TestServeStale(unittest.TestCase):
+    def setUp(self):
+        self.cache = dns.cache.RecordCache(None, stale_window=60)
+        self.cache.add_record(self.record("shuckle.ru.nl", "42.42.42.42", 10, int(time.time()) - 20))
+
+    def record(self, name, address, ttl, timestamp=None):
+        return dns.resource.ResourceRecord(name, dns.rtypes.Type.A,\
+                dns.classes.Class.IN, ttl, dns.resource.ARecordData(address),\
+                timestamp)
+
+    def resolver(self, ask_servers):
+        resolver = dns.resolver.Resolver(5, True, 60, ["192.0.2.1"], False, self.cache, stale_deadline=0.1)
+        resolver.ask_servers = ask_servers
+        return resolver
+
+    def testStaleRecordsAreKept(self):
+        self.cache.add_record(self.record("hestia.dance", "162.246.59.52", 10, int(time.time()) - 100))
+        self.cache.cleanup()
+
+        self.assertEqual([], self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN))
+        stale = self.cache.lookup_stale("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+        self.assertEqual([("42.42.42.42", dns.cache.RecordCache.STALE_TTL)], [(r.rdata.data, r.ttl) for r in stale])
+        self.assertEqual(["shuckle.ru.nl"], [r.name for r in self.cache.all_records()])
+
+    def testStaleAnswerWhenResolutionFails(self):
+        resolver = self.resolver(lambda query, hints: (None, hints))
+
+        self.assertEqual(("shuckle.ru.nl", [], ["42.42.42.42"], True), resolver.resolve("shuckle.ru.nl"))
+        self.assertEqual(("hestia.dance", [], [], False), resolver.resolve("hestia.dance"))
+
+    def testStaleAnswerWhenResolutionIsSlow(self):
+        release = threading.Event()
+        def ask_servers(query, hints):
+            release.wait()
+            header = dns.message.Header(query.header.ident, 0, 1, 1, 0, 0)
+            header.qr = 1
+            answer = dns.resource.ResourceRecord("shuckle.ru.nl", dns.rtypes.Type.A,\
+                    dns.classes.Class.IN, 60, dns.resource.ARecordData("42.42.42.43"))
+            response = dns.message.Message(header, query.questions, [answer])
+            resolver.cache_response(response)
+            return response, hints[:1]
+        resolver = self.resolver(ask_servers)
+
+        started = time.time()
+        self.assertEqual(("shuckle.ru.nl", [], ["42.42.42.42"], True), resolver.resolve("shuckle.ru.nl"))
+        self.assertTrue(time.time() - started < 1)
+
+        #The resolution goes on in the background and refreshes the cache
+        release.set()
+        for _ in range(100):
+            if self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN):
+                break
+            time.sleep(0.01)
+        self.assertEqual(("shuckle.ru.nl", [], ["42.42.42.43"]), resolver.gethostbyname("shuckle.ru.nl"))
+
+    def testOneRefreshPerName(self):
+        release = threading.Event()
+        asked = []
+        def ask_servers(query, hints):
+            asked.append(query.questions[0].qname)
+            release.wait()
+            return None, hints
+        resolver = self.resolver(ask_servers)
+
+        threads = threading.active_count()
+        for _ in range(5):
+            self.assertEqual(("shuckle.ru.nl", [], ["42.42.42.42"], True), resolver.resolve("shuckle.ru.nl"))
+        self.assertEqual(threads + 1, threading.active_count())
+        self.assertEqual(1, resolver.refreshing.leaders)
+        self.assertEqual(4, resolver.refreshing.coalesced)
+        release.set()
+        for _ in range(100):
+            if not resolver.refreshing.calls:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, len(asked))
+
+
+class TestRecordCacheEviction(unittest.TestCase):
+    def record(self, name):
+        return dns.resource.ResourceRecord(name, dns.rtypes.Type.A,\
+                dns.classes.Class.IN, 60, dns.resource.ARecordData("42.42.42.42"))
+
+    def lookup(self, cache, name):
+        return cache.lookup(name, dns.rtypes.Type.A, dns.classes.Class.IN)
+
+    def testLRUEvictsLeastRecentlyUsed(self):
+        cache = dns.cache.RecordCache(None, max_entries=2)
+        cache.add_record(self.record("a.ru.nl"))
+        cache.add_record(self.record("b.ru.nl"))
+        self.lookup(cache, "a.ru.nl")
+        cache.add_record(self.record("c.ru.nl"))
+
+        self.assertEqual(2, cache.entries)
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual([], self.lookup(cache, "b.ru.nl"))
+        self.assertNotEqual([], self.lookup(cache, "a.ru.nl"))
+
+    def test2QProtectsReusedKeys(self):
+        cache = dns.cache.RecordCache(None, max_entries=3, policy="2q")
+        cache.add_record(self.record("hot.ru.nl"))
+        self.lookup(cache, "hot.ru.nl")
+        for i in range(10):#A scan of names that are used only once
+            cache.add_record(self.record("scan" + str(i) + ".ru.nl"))
+
+        self.assertNotEqual([], self.lookup(cache, "hot.ru.nl"))
+        self.assertEqual(3, cache.entries)
+
+    def testByteBudget(self):
+        size = dns.cache.record_size(self.record("a.ru.nl"))
+        cache = dns.cache.RecordCache(None, max_bytes=3 * size)
+        for name in ["a.ru.nl", "b.ru.nl", "c.ru.nl", "d.ru.nl"]:
+            cache.add_record(self.record(name))
+
+        self.assertTrue(cache.size <= 3 * size)
+        self.assertEqual(1, cache.evictions)
+
+
+class TestShardedRecordCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = dns.cache.ShardedRecordCache(None, shards=4)
+
+    def testConcurrentAddAndLookup(self):
+        def work(n):
+            for i in range(200):
+                name = "host" + str(i) + ".ru.nl"
+                self.cache.add_record(dns.resource.ResourceRecord(name,\
+                        dns.rtypes.Type.A, dns.classes.Class.IN, 60,\
+                        dns.resource.ARecordData("10.0." + str(n) + "." + str(i))))
+                self.cache.lookup(name, dns.rtypes.Type.A, dns.classes.Class.IN)
+
+        threads = [Thread(target=work, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(800, self.cache.entries)
+        found = self.cache.lookup("host7.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+        self.assertEqual(4, len(found))
+
+    def testLookupDoesNotChangeCachedRecords(self):
+        record = dns.resource.ResourceRecord("shuckle.ru.nl", dns.rtypes.Type.A,\
+                dns.classes.Class.IN, 60, dns.resource.ARecordData("42.42.42.42"),\
+                int(time.time()) - 30)
+        self.cache.add_record(record)
+        found = self.cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+
+        self.assertTrue(found[0].ttl <= 30)
+        self.assertEqual(60, record.ttl)
+
+    def testPersistence(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(directory, "cache.json")
+            cache = dns.cache.ShardedRecordCache(cache_file, shards=4,\
+                    journal_file=os.path.join(directory, "cache.journal"))
+            self.assertFalse(isinstance(cache, dns.cache.RecordCache))
+            cache.add_record(dns.resource.ResourceRecord("shuckle.ru.nl", dns.rtypes.Type.A,\
+                    dns.classes.Class.IN, 60, dns.resource.ARecordData("42.42.42.42")))
+            cache.compact()
+            cache.save()
+
+            cache = dns.cache.ShardedRecordCache(cache_file, shards=2)
+            self.assertEqual(["42.42.42.42"], [record.rdata.data for record in\
+                    cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestCacheJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.dir, "cache.json")
+        self.journal_file = os.path.join(self.dir, "cache.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return dns.cache.RecordCache(self.cache_file, journal_file=self.journal_file)
+
+    def add(self, cache, name):
+        cache.add_record(dns.resource.ResourceRecord(name, dns.rtypes.Type.A,\
+                dns.classes.Class.IN, 60, dns.resource.ARecordData("42.42.42.42")))
+
+    def testReplayWithoutShutdown(self):
+        cache = self.open()
+        self.add(cache, "shuckle.ru.nl")
+        #No save, as if the process crashed
+
+        cache = self.open()
+        self.assertEqual(1, len(cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)))
+
+    def testCompactFoldsJournalIntoSnapshot(self):
+        cache = self.open()
+        self.add(cache, "shuckle.ru.nl")
+        cache.compact()
+        self.add(cache, "hestia.dance")
+        cache.save()
+
+        self.assertEqual(1, len(open(self.journal_file).readlines()))
+        cache = self.open()
+        self.assertEqual(2, cache.entries)
+
+    def testCompactKeepsRecordsCompactedByOthers(self):
+        first, second = self.open(), self.open()
+        self.add(first, "shuckle.ru.nl")
+        first.compact()
+        self.add(second, "hestia.dance")
+        second.compact()
+
+        cache = dns.cache.RecordCache(self.cache_file)
+        self.assertEqual(2, cache.entries)
+
+    def testAppendsDoNotWaitForCompaction(self):
+        cache = self.open()
+        self.add(cache, "shuckle.ru.nl")
+        writing, added = threading.Event(), threading.Event()
+        write_cache_file = cache.write_cache_file
+        def slow_write_cache_file(merge=False):
+            writing.set()
+            added.wait(1)
+            write_cache_file(merge)
+        cache.write_cache_file = slow_write_cache_file
+
+        compactor = Thread(target=cache.compact)
+        compactor.start()
+        writing.wait(1)
+        start = time.time()
+        self.add(cache, "hestia.dance")
+        elapsed = time.time() - start
+        added.set()
+        compactor.join()
+        cache.save()
+
+        self.assertTrue(elapsed < 0.5)
+        self.assertEqual(1, len(open(self.journal_file).readlines()))
+        self.assertFalse(os.path.exists(self.journal_file + ".old"))
+        self.assertEqual(2, self.open().entries)
+
+    def testSaveStopsCompactor(self):
+        cache = self.open()
+        compactor = cache.start_compactor(interval=0.01, min_size=0)
+        for i in range(50):
+            self.add(cache, "host" + str(i) + ".ru.nl")
+        cache.save()
+        compactor.join(1)
+        self.assertFalse(compactor.is_alive())
+
+
+class TestCacheSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.dir, "cache.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testLazyLoad(self):
+        cache = dns.cache.RecordCache(self.cache_file, cache_format="binary")
+        for i in range(100):
+            cache.add_record(dns.resource.ResourceRecord("host" + str(i) + ".ru.nl",\
+                    dns.rtypes.Type.A, dns.classes.Class.IN, 60,\
+                    dns.resource.ARecordData("10.0.0." + str(i))))
+        cache.add_record(dns.resource.ResourceRecord("www.ru.nl",\
+                dns.rtypes.Type.CNAME, dns.classes.Class.IN, 60,\
+                dns.resource.CNAMERecordData("host1.ru.nl")))
+        cache.save()
+
+        cache = dns.cache.RecordCache(self.cache_file, cache_format="binary")
+        self.assertEqual(101, len(cache.snapshot))
+        self.assertEqual(0, cache.entries)
+
+        found = cache.lookup("HOST42.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+        self.assertEqual(["10.0.0.42"], [r.rdata.data for r in found])
+        found = cache.lookup("www.ru.nl", dns.rtypes.Type.CNAME, dns.classes.Class.IN)
+        self.assertEqual(["host1.ru.nl"], [r.rdata.data for r in found])
+        self.assertEqual([], cache.lookup("host42.ru.nl", dns.rtypes.Type.CNAME, dns.classes.Class.IN))
+        self.assertEqual(2, cache.entries)
+
+    def testExportJSON(self):
+        cache = dns.cache.RecordCache(self.cache_file, cache_format="binary")
+        cache.add_record(dns.resource.ResourceRecord("shuckle.ru.nl",\
+                dns.rtypes.Type.A, dns.classes.Class.IN, 60,\
+                dns.resource.ARecordData("42.42.42.42")))
+        cache.save()
+
+        json_file = os.path.join(self.dir, "cache.json")
+        dns.cache.RecordCache(self.cache_file, cache_format="binary").export_json(json_file)
+        cache = dns.cache.RecordCache(json_file)
+        self.assertEqual(1, len(cache.lookup("shuckle.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)))
+
+    def testPermissionsFollowUmask(self):
+        umask = dns.files.UMASK
+        try:
+            for dns.files.UMASK, mode in [(0o022, 0o644), (0o077, 0o600)]:
+                dns.files.replace_file(self.cache_file, [b"snapshot"])
+                self.assertEqual(mode, os.stat(self.cache_file).st_mode & 0o777)
+        finally:
+            dns.files.UMASK = umask
+        self.assertEqual(["cache.bin"], os.listdir(self.dir))
+
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = dns.cache.RecordCache(None)
+        self.resolver = dns.resolver.Resolver(5, True, 60, ["192.0.2.1"], False, self.cache)
+
+    def negative_response(self, query, rcode):
+        header = dns.message.Header(query.header.ident, 0, 1, 0, 1, 0)
+        header.qr = 1
+        header.rcode = rcode
+        soa = dns.resource.ResourceRecord("dance", dns.rtypes.Type.SOA,\
+                dns.classes.Class.IN, 900, dns.resource.SOARecordData(\
+                "ns1.dance hostmaster.dance 2017 1800 900 604800 300"))
+        return dns.message.Message(header, query.questions, [], [soa])
+
+    def testNXDomainAppliesToAllTypes(self):
+        self.cache.add_negative("s.h.u.c.k.l.e", dns.rtypes.Type.A, dns.classes.Class.IN,\
+                dns.rcodes.RCode.NXDomain, 60)
+        self.assertEqual(dns.rcodes.RCode.NXDomain, self.cache.lookup_negative(\
+                "s.h.u.c.k.l.e", dns.rtypes.Type.AAAA, dns.classes.Class.IN))
+
+    def testNoDataAppliesToOneType(self):
+        self.cache.add_negative("hestia.dance", dns.rtypes.Type.AAAA, dns.classes.Class.IN,\
+                dns.rcodes.RCode.NoError, 60)
+        self.assertEqual(None, self.cache.lookup_negative(\
+                "hestia.dance", dns.rtypes.Type.A, dns.classes.Class.IN))
+
+    def testResolverCachesNXDomain(self):
+        queries = []
+        def ask_servers(query, servers):
+            queries.append(query)
+            return self.negative_response(query, dns.rcodes.RCode.NXDomain), servers[:1]
+        self.resolver.ask_servers = ask_servers
+
+        self.assertEqual(("typo.dance", [], []), self.resolver.gethostbyname("typo.dance"))
+        self.assertEqual(("typo.dance", [], []), self.resolver.gethostbyname("typo.dance"))
+        self.assertEqual(1, len(queries))
+        self.assertEqual(dns.rcodes.RCode.NXDomain, self.cache.lookup_negative(\
+                "typo.dance", dns.rtypes.Type.A, dns.classes.Class.IN))
+
+    def testSOARecordDataToBytes(self):
+        query = dns.message.Message(dns.message.Header(42, 0, 1, 0, 0, 0),\
+                [dns.message.Question("typo.dance", dns.rtypes.Type.A, dns.classes.Class.IN)])
+        response = self.negative_response(query, dns.rcodes.RCode.NXDomain)
+        parsed = dns.message.Message.from_bytes(response.to_bytes())
+
+        self.assertEqual(300, parsed.authorities[0].rdata.minimum)
+        self.assertEqual(300, self.resolver.negative_ttl(parsed))
+
+
+class TestDelegationCache(unittest.TestCase):
+    def setUp(self):
+        self.delegations = dns.cache.DelegationCache()
+
+    def testClosestZoneCut(self):
+        self.delegations.add("nl", ["192.0.2.1"], 60)
+        self.delegations.add("ru.nl", ["192.0.2.2"], 60)
+
+        self.assertEqual(("ru.nl", ["192.0.2.2"]), self.delegations.closest("www.cs.ru.nl"))
+        self.assertEqual(("nl", ["192.0.2.1"]), self.delegations.closest("uu.nl"))
+        self.assertEqual(None, self.delegations.closest("hestia.dance"))
+
+    def testExpiredZoneCut(self):
+        self.delegations.add("ru.nl", ["192.0.2.2"], -1)
+        self.assertEqual(None, self.delegations.closest("www.ru.nl"))
+
+    def testResolverStartsAtZoneCut(self):
+        resolver = dns.resolver.Resolver(5, True, 60, ["192.0.2.1"], False, dns.cache.RecordCache(None))
+        servers = []
+        def ask_servers(query, hints):
+            server = hints[0]
+            servers.append(server)
+            header = dns.message.Header(query.header.ident, 0, 1, 0, 0, 0)
+            header.qr = 1
+            qname = query.questions[0].qname
+            if server == "192.0.2.1":#Referral to the nameserver of ru.nl
+                ns = dns.resource.ResourceRecord("ru.nl", dns.rtypes.Type.NS,\
+                        dns.classes.Class.IN, 3600, dns.resource.NSRecordData("ns.ru.nl"))
+                glue = dns.resource.ResourceRecord("ns.ru.nl", dns.rtypes.Type.A,\
+                        dns.classes.Class.IN, 3600, dns.resource.ARecordData("192.0.2.53"))
+                return dns.message.Message(header, query.questions, [], [ns], [glue]), [server]
+            answer = dns.resource.ResourceRecord(qname, dns.rtypes.Type.A,\
+                    dns.classes.Class.IN, 3600, dns.resource.ARecordData("131.174.78.60"))
+            return dns.message.Message(header, query.questions, [answer]), [server]
+        resolver.ask_servers = ask_servers
+
+        resolver.gethostbyname("www.ru.nl")
+        self.assertEqual(["192.0.2.1", "192.0.2.53"], servers)
+        h, al, ad = resolver.gethostbyname("cs.ru.nl")
+        self.assertEqual(["131.174.78.60"], ad)
+        self.assertEqual(["192.0.2.1", "192.0.2.53", "192.0.2.53"], servers)
+
+
+class TestQueryRacing(unittest.TestCase):
+    def setUp(self):
+        self.resolver = dns.resolver.Resolver(5, False, 60, [], False, fanout=2, stagger=0.1)
+        self.silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.silent.bind(("127.0.0.1", 0))
+        self.resolver.port = self.silent.getsockname()[1]
+        self.responding = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.responding.bind(("127.0.0.2", self.resolver.port))
+
+    def tearDown(self):
+        self.silent.close()
+        self.responding.close()
+
+    def respond(self, ident=None):
+        data, addr = self.responding.recvfrom(1024)
+        query = dns.message.Message.from_bytes(data)
+        header = dns.message.Header(query.header.ident if ident is None else ident, 0, 1, 1, 0, 0)
+        header.qr = 1
+        answer = dns.resource.ResourceRecord(query.questions[0].qname, dns.rtypes.Type.A,\
+                dns.classes.Class.IN, 60, dns.resource.ARecordData("131.174.78.60"))
+        response = dns.message.Message(header, query.questions, [answer])
+        self.responding.sendto(response.to_bytes(), addr)
+
+    def query(self):
+        header = dns.message.Header(4242, 0, 1, 0, 0, 0)
+        return dns.message.Message(header, [dns.message.Question("ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)])
+
+    def testUnresponsiveServerDoesNotDelay(self):
+        helper = Thread(target=self.respond)
+        helper.start()
+        start = time.time()
+        response, asked = self.resolver.ask_servers(self.query(), ["127.0.0.1", "127.0.0.2"])
+        helper.join()
+
+        self.assertEqual(["127.0.0.1", "127.0.0.2"], asked)
+        self.assertEqual("131.174.78.60", response.answers[0].rdata.data)
+        self.assertTrue(time.time() - start < 1)
+
+    def testWrongIdentIsIgnored(self):
+        self.resolver.infra.max_timeout = 0.5
+        helper = Thread(target=self.respond, args=(1,))
+        helper.start()
+        response, asked = self.resolver.ask_servers(self.query(), ["127.0.0.1", "127.0.0.2"])
+        helper.join()
+
+        self.assertEqual(None, response)
+
+    def testDuplicateAddressIsAskedOnce(self):
+        def respond_late():
+            time.sleep(0.3)
+            self.respond()
+        helper = Thread(target=respond_late)
+        helper.start()
+        response, asked = self.resolver.ask_servers(self.query(), ["127.0.0.2", "127.0.0.2"])
+        helper.join()
+
+        self.assertEqual("131.174.78.60", response.answers[0].rdata.data)
+        self.responding.setblocking(0)
+        self.assertRaises(socket.error, self.responding.recv, 1024)
+        #The round trip is measured from the first send
+        self.assertTrue(self.resolver.infra.rtt("127.0.0.2") >= 0.3)
+
+
+class TestSocketPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = dns.socketpool.SocketPool(2)
+        self.pool.open()
+
+    def tearDown(self):
+        self.pool.close()
+
+    def testSocketsAreReused(self):
+        sock = self.pool.acquire()
+        port = sock.getsockname()[1]
+        self.pool.release(sock)
+        ports = [self.pool.acquire().getsockname()[1] for _ in range(2)]
+
+        self.assertTrue(port in ports)
+
+    def testStrayPacketsAreDiscarded(self):
+        sock = self.pool.acquire()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.sendto(b"late response", ("127.0.0.1", sock.getsockname()[1]))
+        sender.close()
+        time.sleep(0.1)
+        self.pool.release(sock)
+
+        sock.settimeout(0.1)
+        self.assertRaises(socket.timeout, sock.recv, 1024)
+
+    def testExtraSocketWhenExhausted(self):
+        sockets = [self.pool.acquire() for _ in range(3)]
+        for sock in sockets:
+            self.pool.release(sock)
+
+        self.assertEqual(2, self.pool.sockets.qsize())
+
+
+class FakeNameserver(Thread):
+    """ Answers every A query with 10.0.0.1, until stopped """
+
+    def __init__(self, address, port=0, silent=False):
+        super(FakeNameserver, self).__init__()
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.sock.settimeout(0.05)
+        self.port = self.sock.getsockname()[1]
+        self.silent = silent
+        self.queries = 0
+        self.done = False
+
+    def run(self):
+        while not self.done:
+            try:
+                data, addr = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            self.queries += 1
+            if self.silent:
+                continue
+            query = dns.message.Message.from_bytes(data)
+            header = dns.message.Header(query.header.ident, 0, 1, 1, 0, 0)
+            header.qr = 1
+            answer = dns.resource.ResourceRecord(query.questions[0].qname, dns.rtypes.Type.A,\
+                    dns.classes.Class.IN, 60, dns.resource.ARecordData("10.0.0.1"))
+            self.sock.sendto(dns.message.Message(header, query.questions, [answer]).to_bytes(), addr)
+
+    def stop(self):
+        self.done = True
+        self.join()
+        self.sock.close()
+
+
+class TestMultiplexer(unittest.TestCase):
+    def setUp(self):
+        self.nameserver = FakeNameserver("127.0.0.1")
+        self.nameserver.start()
+        self.resolver = dns.resolver.Resolver(5, False, 60, ["127.0.0.1"], False)
+        self.resolver.port = self.nameserver.port
+        self.results = []
+
+    def tearDown(self):
+        self.nameserver.stop()
+
+    def testManyLookups(self):
+        multiplexer = dns.multiplexer.Multiplexer(self.resolver)
+        for i in range(50):
+            multiplexer.submit("host" + str(i) + ".ru.nl", self.results.append)
+        multiplexer.run()
+        multiplexer.close()
+
+        self.assertEqual(50, len(self.results))
+        self.assertEqual(50, self.nameserver.queries)
+        self.assertTrue(all(ad == ["10.0.0.1"] for h, al, ad in self.results))
+
+    def testSilentServer(self):
+        silent = FakeNameserver("127.0.0.2", self.nameserver.port, silent=True)
+        silent.start()
+        self.resolver.nameservers = ["127.0.0.2"]
+        self.resolver.infra.max_timeout = 0.2
+
+        multiplexer = dns.multiplexer.Multiplexer(self.resolver)
+        multiplexer.submit("ru.nl", self.results.append)
+        multiplexer.run()
+        silent.stop()
+
+        self.assertEqual([("ru.nl", [], [])], self.results)
+
+    def testNoCandidateLeftAfterSilentServer(self):
+        silent = FakeNameserver("127.0.0.2", self.nameserver.port, silent=True)
+        silent.start()
+        self.resolver.nameservers = ["127.0.0.2", "127.0.0.2"]
+        self.resolver.fanout = 2
+        self.resolver.stagger = 0.05
+        self.resolver.infra.max_timeout = 0.2
+
+        multiplexer = dns.multiplexer.Multiplexer(self.resolver)
+        multiplexer.submit("ru.nl", self.results.append)
+        start = time.time()
+        while multiplexer.active and time.time() - start < 2:
+            multiplexer.poll(0.1)
+        silent.stop()
+
+        self.assertEqual([("ru.nl", [], [])], self.results)
+        self.assertEqual(1, silent.queries)
+
+    def testResolveMany(self):
+        hostnames = ["host" + str(i) + ".ru.nl" for i in range(40)]
+        results = list(self.resolver.resolve_many(iter(hostnames), concurrency=8))
+
+        self.assertEqual(sorted(hostnames), sorted(h for h, al, ad, t in results))
+        self.assertTrue(all(ad == ["10.0.0.1"] and t >= 0 for h, al, ad, t in results))
+        self.assertEqual(40, self.nameserver.queries)
+
+    def testBatchRestoresStdout(self):
+        def resolve_many(hostnames, concurrency):
+            yield ("ru.nl", [], ["10.0.0.1"], 0.01)
+            raise socket.error("network is unreachable")
+        self.resolver.resolve_many = resolve_many
+        stdout = sys.stdout
+        out = sys.stdout = StringIO.StringIO()
+        try:
+            self.assertRaises(socket.error, dns_client.run_batch, self.resolver, ["ru.nl", "uu.nl"], 2)
+            self.assertTrue(sys.stdout is out)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual("ru.nl", json.loads(out.getvalue())["hostname"])
+
+
+class TestInflightTable(unittest.TestCase):
+    def testIdenticalCallsAreCoalesced(self):
+        table = dns.inflight.InflightTable()
+        release = threading.Event()
+        calls = []
+        def resolve(name):
+            calls.append(name)
+            release.wait()
+            return name.upper()
+
+        results = []
+        threads = [Thread(target=lambda: results.append(table.call("ru.nl", resolve, "ru.nl")))\
+                for _ in range(5)]
+        for t in threads:
+            t.start()
+        while table.coalesced < 4:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(["ru.nl"], calls)
+        self.assertEqual(["RU.NL"] * 5, results)
+        self.assertEqual(1, table.leaders)
+
+    def testResolverCoalescesUpstreamQueries(self):
+        resolver = dns.resolver.Resolver(5, False, 60, ["192.0.2.1"], False)
+        release = threading.Event()
+        queries = []
+        def ask_servers(query, hints):
+            queries.append(query)
+            release.wait()
+            header = dns.message.Header(query.header.ident, 0, 1, 1, 0, 0)
+            answer = dns.resource.ResourceRecord("ru.nl", dns.rtypes.Type.A,\
+                    dns.classes.Class.IN, 60, dns.resource.ARecordData("131.174.78.60"))
+            return dns.message.Message(header, query.questions, [answer]), hints[:1]
+        resolver.ask_servers = ask_servers
+
+        helpers = [ThreadHelper(resolver, "ru.nl") for _ in range(3)]
+        for helper in helpers:
+            helper.start()
+        while resolver.upstream.coalesced < 2:
+            time.sleep(0.01)
+        release.set()
+        for helper in helpers:
+            helper.join()
+
+        self.assertEqual(1, len(queries))
+        self.assertEqual([["131.174.78.60"]] * 3, [helper.ad for helper in helpers])
+
+
+class TestInfraCache(unittest.TestCase):
+    def setUp(self):
+        self.infra = dns.cache.InfraCache(5, exploration=0)
+
+    def testOrderByRTT(self):
+        self.infra.add_rtt("192.0.2.1", 0.3)
+        self.infra.add_rtt("192.0.2.2", 0.02)
+        self.assertEqual(["192.0.2.2", "192.0.2.1", "192.0.2.3"],\
+                self.infra.order(["192.0.2.1", "192.0.2.2", "192.0.2.3"]))
+
+    def testTimeoutFollowsRTT(self):
+        for _ in range(20):
+            self.infra.add_rtt("192.0.2.1", 0.02)
+        self.assertTrue(self.infra.timeout("192.0.2.1") < 0.1)
+        self.assertTrue(self.infra.timeout("192.0.2.1") >= dns.cache.InfraCache.MIN_TIMEOUT)
+
+    def testTimeoutBacksOff(self):
+        self.infra.add_rtt("192.0.2.1", 0.02)
+        for _ in range(20):
+            self.infra.add_timeout("192.0.2.1")
+        self.assertEqual(5, self.infra.rtt("192.0.2.1"))
+        self.assertEqual(5, self.infra.timeout("192.0.2.1"))
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.catalog = dns.zone.Catalog()
+        for name in ["nl", "ru.nl", "cs.ru.nl", "dance"]:
+            self.catalog.add_zone(name, dns.zone.Zone())
+
+    def testClosestEnclosingZone(self):
+        self.assertEqual("cs.ru.nl", self.catalog.find_zone("www.cs.ru.nl")[0])
+        self.assertEqual("ru.nl", self.catalog.find_zone("WWW.RU.NL.")[0])
+        self.assertEqual("ru.nl", self.catalog.find_zone("ru.nl")[0])
+        self.assertEqual("nl", self.catalog.find_zone("uu.nl")[0])
+        self.assertEqual(None, self.catalog.find_zone("gaia.cs.umass.edu"))
+        self.assertEqual(None, self.catalog.find_zone("ru"))
+
+    def testWithZones(self):
+        ru, umass = dns.zone.Zone(), dns.zone.Zone()
+        catalog = self.catalog.with_zones({"ru.nl": ru, "umass.edu": umass})
+        self.assertTrue(catalog.find_zone("www.ru.nl")[1] is ru)
+        self.assertEqual("umass.edu", catalog.find_zone("gaia.cs.umass.edu")[0])
+        self.assertEqual("cs.ru.nl", catalog.find_zone("www.cs.ru.nl")[0])
+        #The catalog itself is not changed
+        self.assertTrue(self.catalog.find_zone("www.ru.nl")[1] is not ru)
+        self.assertEqual(None, self.catalog.find_zone("gaia.cs.umass.edu"))
+
+    def testCheckZone(self):
+        zone = dns.zone.Zone()
+        zone.read_master_file()
+        self.catalog = dns.zone.Catalog()
+        self.catalog.add_zone("ru.nl", zone)
+        question = dns.message.Question("cs.ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)
+        header = dns.message.Header(42, 0, 1, 0, 0, 0)
+        handler = dns.server.RequestHandler(None, None, 60, dns.message.Message(header, [question]),\
+                None, self.catalog)
+
+        answer, authority, found = handler.check_zone("cs.ru.nl")
+        self.assertTrue(found)
+        self.assertEqual([], answer)
+        self.assertEqual(["ns1.science.ru.nl"], [record.rdata.data for record in authority])
+
+        answer, authority, found = handler.check_zone("shuckle.ru.nl")
+        self.assertEqual(["ru.nl", "131.174.78.60"], [record.rdata.data for record in answer])
+
+
+class TestZone(unittest.TestCase):
+    def setUp(self):
+        self.zone = dns.zone.Zone("ru.nl")
+        for name, type_, rdata in [("ru.nl", dns.rtypes.Type.A, dns.resource.ARecordData("131.174.78.60")),\
+                ("ru.nl", dns.rtypes.Type.A, dns.resource.ARecordData("131.174.78.61")),\
+                ("ru.nl", dns.rtypes.Type.NS, dns.resource.NSRecordData("ns1.ru.nl")),\
+                ("cs.ru.nl", dns.rtypes.Type.NS, dns.resource.NSRecordData("ns1.science.ru.nl")),\
+                ("shuckle.ru.nl", dns.rtypes.Type.CNAME, dns.resource.CNAMERecordData("ru.nl")),\
+                ("*.ru.nl", dns.rtypes.Type.A, dns.resource.ARecordData("131.174.78.62"))]:
+            self.zone.add_node(name, dns.resource.ResourceRecord(name, type_, dns.classes.Class.IN, 3600, rdata))
+
+    def testRecordSets(self):
+        self.assertEqual(6, self.zone.count)
+        answer, authority, exists = self.zone.find("RU.NL.", dns.rtypes.Type.A)
+        self.assertEqual(["131.174.78.60", "131.174.78.61"], [record.rdata.data for record in answer])
+        self.assertEqual(["ns1.ru.nl"], [record.rdata.data for record in authority])
+
+    def testDelegation(self):
+        for name in ["cs.ru.nl", "www.cs.ru.nl"]:
+            answer, authority, exists = self.zone.find(name, dns.rtypes.Type.A)
+            self.assertEqual([], answer)
+            self.assertEqual(["ns1.science.ru.nl"], [record.rdata.data for record in authority])
+
+    def testWildcardAndCNAME(self):
+        answer, authority, exists = self.zone.find("www.ru.nl", dns.rtypes.Type.A)
+        self.assertEqual([("www.ru.nl", "131.174.78.62")], [(r.name, r.rdata.data) for r in answer])
+        answer, authority, exists = self.zone.find("shuckle.ru.nl", dns.rtypes.Type.A)
+        self.assertEqual([dns.rtypes.Type.CNAME], [record.type_ for record in answer])
+        self.assertEqual(([], [], False), self.zone.find("uu.nl", dns.rtypes.Type.A))
+
+
+class TestMasterFile(unittest.TestCase):
+    MASTER_FILE = """$ORIGIN ru.nl.
+$TTL 1h ; default TTL
+@   IN  SOA ns1 hostmaster.ru.nl. (
+            2017010101 ; serial
+            1d 2h 4w 30m )
+    IN  NS  ns1
+ns1 300 IN  A   131.174.78.1
+www IN 1w2d A   131.174.78.60
+
+        A   131.174.78.61
+cs  NS  ns1.science.ru.nl.
+"""
+
+    def testParse(self):
+        zone = dns.zone.Zone()
+        records = list(zone.parse(self.MASTER_FILE.splitlines(True)))
+
+        self.assertEqual([("ru.nl", dns.rtypes.Type.SOA, 3600), ("ru.nl", dns.rtypes.Type.NS, 3600),\
+                ("ns1.ru.nl", dns.rtypes.Type.A, 300), ("www.ru.nl", dns.rtypes.Type.A, 777600),\
+                ("www.ru.nl", dns.rtypes.Type.A, 3600), ("cs.ru.nl", dns.rtypes.Type.NS, 3600)],\
+                [(record.name, record.type_, record.ttl) for record in records])
+        soa = records[0].rdata
+        self.assertEqual(("ns1.ru.nl", "hostmaster.ru.nl", 2017010101, 86400, 7200, 2419200, 1800),\
+                (soa.mname, soa.rname, soa.serial, soa.refresh, soa.retry, soa.expire, soa.minimum))
+        self.assertEqual(["ns1.ru.nl", "131.174.78.61", "ns1.science.ru.nl"],\
+                [records[i].rdata.data for i in (1, 4, 5)])
+
+    def testLoad(self):
+        zone = dns.zone.Zone()
+        self.assertEqual(6, zone.load_and_parse(self.MASTER_FILE))
+        answer, authority, exists = zone.find("www.ru.nl", dns.rtypes.Type.A)
+        self.assertEqual(["131.174.78.60", "131.174.78.61"], [record.rdata.data for record in answer])
+
+    def testTimeToSeconds(self):
+        self.assertEqual(3600, dns.zone.Zone.time_to_seconds("3600"))
+        self.assertEqual(5400, dns.zone.Zone.time_to_seconds("1h30m"))
+        self.assertEqual(777600, dns.zone.Zone.time_to_seconds("1W2D"))
+
+
+class TestZoneImage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.master_file = os.path.join(self.dir, "zone.txt")
+        self.image_file = os.path.join(self.dir, "zone.img")
+        with open(self.master_file, "w") as outfile:
+            outfile.write(TestMasterFile.MASTER_FILE + "*.www A 131.174.78.62\nshuckle CNAME www\n")
+        self.tree = dns.zone.Zone()
+        self.tree.read_master_file(self.master_file)
+        dns.zoneimage.write_image(self.image_file, self.tree, dns.zoneimage.checksum(self.master_file))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testImageMatchesTree(self):
+        zone = dns.zone.Zone()
+        zone.read_zone(self.master_file, self.image_file)
+        self.assertTrue(zone.image is not None)
+        self.assertEqual("ru.nl", zone.origin)
+        self.assertEqual(self.tree.count, zone.count)
+
+        def summary(result):
+            answer, authority, exists = result
+            return ([(r.name, r.type_, r.ttl, r.rdata.data) for r in answer],\
+                    sorted(r.rdata.data for r in authority), exists)
+        for name in ["ru.nl", "www.ru.nl", "a.www.ru.nl", "shuckle.ru.nl", "cs.ru.nl", "x.cs.ru.nl",\
+                "nope.ru.nl", "uu.nl"]:
+            for type_ in [dns.rtypes.Type.A, dns.rtypes.Type.NS, dns.rtypes.Type.SOA]:
+                self.assertEqual(summary(self.tree.find(name, type_)), summary(zone.find(name, type_)))
+
+    def testStaleImage(self):
+        with open(self.master_file, "a") as outfile:
+            outfile.write("new A 131.174.78.63\n")
+        zone = dns.zone.Zone()
+        zone.read_zone(self.master_file, self.image_file)
+
+        self.assertEqual(None, zone.image)
+        self.assertEqual(self.tree.count + 1, zone.count)
+
+
+class TestZoneReload(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.master_file = os.path.join(self.dir, "zone.txt")
+        with open(self.master_file, "w") as outfile:
+            outfile.write(TestMasterFile.MASTER_FILE)
+        self.server = dns.server.Server(0, False, 60)
+        zone = dns.zone.Zone()
+        zone.read_zone(self.master_file, None)
+        self.server.catalog = dns.zone.Catalog().with_zone("ru.nl", zone)
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.dir)
+
+    def testReloadSwapsCatalog(self):
+        old_catalog = self.server.catalog
+        with open(self.master_file, "a") as outfile:
+            outfile.write("new A 131.174.78.63\n")
+        os.utime(self.master_file, (time.time() + 10, time.time() + 10))
+
+        self.assertEqual((1, 0), self.server.reload_zones(changed_only=True))
+        self.assertTrue(self.server.catalog is not old_catalog)
+        found = self.server.catalog.find_zone("new.ru.nl")[1].find("new.ru.nl", dns.rtypes.Type.A)[0]
+        self.assertEqual(["131.174.78.63"], [record.rdata.data for record in found])
+        #Handlers that hold the old catalog keep seeing the old zone
+        self.assertEqual([], old_catalog.find_zone("new.ru.nl")[1].find("new.ru.nl", dns.rtypes.Type.A)[0])
+
+    def testUnchangedZoneIsNotReloaded(self):
+        old_catalog = self.server.catalog
+        self.assertEqual((0, 0), self.server.reload_zones(changed_only=True))
+        self.assertEqual(old_catalog.zones, self.server.catalog.zones)
+
+
+class TestZoneConfig(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name in ["ru.nl", "uu.nl"]:
+            with open(os.path.join(self.dir, name + ".txt"), "w") as outfile:
+                outfile.write(TestMasterFile.MASTER_FILE.replace("ru.nl", name))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeConfig(self, load):
+        config = os.path.join(self.dir, "zones.json")
+        with open(config, "w") as outfile:
+            json.dump({"load": load, "processes": 2, "zones": [
+                {"name": "ru.nl", "file": "ru.nl.txt", "image": "ru.nl.img"},
+                {"name": "uu.nl", "file": "uu.nl.txt"}]}, outfile)
+        return config
+
+    def testLazyZoneLoadsOnFirstUse(self):
+        catalog = dns.zone.read_config(self.writeConfig("lazy"))
+        name, zone = catalog.find_zone("www.uu.nl")
+        self.assertEqual("uu.nl", name)
+        self.assertTrue(zone.zone is None)
+        self.assertEqual(0, zone.memory())
+        self.assertFalse(zone.changed())
+
+        answer = zone.find("www.uu.nl", dns.rtypes.Type.A)[0]
+        self.assertTrue(zone.zone is not None)
+        self.assertTrue(answer)
+        self.assertTrue(zone.memory() > 0)
+        self.assertTrue(catalog.find_zone("www.ru.nl")[1].zone is None)
+
+    def testLazyZoneReportsWhenLoaded(self):
+        catalog = dns.zone.read_config(self.writeConfig("lazy"))
+        zone = catalog.find_zone("www.uu.nl")[1]
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            zone.load()
+            zone.load()
+            report = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(1, report.count("Zone uu.nl loaded: " + str(zone.count) + " records"))
+
+    def testEagerConfigCompilesImages(self):
+        catalog = dns.zone.read_config(self.writeConfig("eager"))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "ru.nl.img")))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "uu.nl.img")))
+        ru, uu = catalog.zones["ru.nl"], catalog.zones["uu.nl"]
+        self.assertTrue(ru.image is not None)
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, "ru.nl.img")), ru.memory())
+        self.assertTrue(uu.image is None)
+        self.assertEqual(ru.find("www.ru.nl", dns.rtypes.Type.A)[0][0].rdata.data,
+                uu.find("www.uu.nl", dns.rtypes.Type.A)[0][0].rdata.data)
+
+    def testCompileOnlyOnRequest(self):
+        catalog = dns.zone.read_config(self.writeConfig("eager"), compile=False)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "ru.nl.img")))
+        self.assertTrue(catalog.zones["ru.nl"].find("www.ru.nl", dns.rtypes.Type.A)[0])
+
+    def testConcurrentCompiles(self):
+        spec = ("ru.nl", os.path.join(self.dir, "ru.nl.txt"), os.path.join(self.dir, "ru.nl.img"))
+        pool = multiprocessing.Pool(4)
+        try:
+            pool.map(dns.zone.compile_zone, [spec] * 8)
+        finally:
+            pool.close()
+            pool.join()
+
+        image = dns.zoneimage.ZoneImage(spec[2])
+        self.assertEqual(dns.zoneimage.checksum(spec[1]), image.digest)
+        self.assertEqual(sorted(["ru.nl.txt", "uu.nl.txt", "ru.nl.img"]), sorted(os.listdir(self.dir)))
+
+    def testUnknownLoadMode(self):
+        self.assertRaises(ValueError, dns.zone.read_config, self.writeConfig("sometimes"))
+
+
+class TestResponseCache(unittest.TestCase):
+    class Socket(object):
+        def __init__(self):
+            self.sent = []
+
+        def sendto(self, data, address):
+            self.sent.append(data)
+
+    def setUp(self):
+        zone = dns.zone.Zone()
+        zone.load_and_parse(TestMasterFile.MASTER_FILE)
+        self.catalog = dns.zone.Catalog().with_zone("ru.nl", zone)
+        self.responses = dns.responsecache.ResponseCache()
+        self.socket = self.Socket()
+
+    def ask(self, ident, qname="www.ru.nl", catalog=None):
+        question = dns.message.Question(qname, dns.rtypes.Type.A, dns.classes.Class.IN)
+        header = dns.message.Header(ident, 0, 1, 0, 0, 0)
+        header.rd = 1
+        handler = dns.server.RequestHandler(self.socket, None, 60, dns.message.Message(header, [question]),\
+                None, catalog or self.catalog, responses=self.responses)
+        handler.handle_request()
+        return self.socket.sent[-1]
+
+    def testHitPatchesIdent(self):
+        first = self.ask(1)
+        second = self.ask(2)
+        self.assertEqual((1, 1), (self.responses.hits, self.responses.misses))
+        self.assertEqual(first[2:], second[2:])
+        response = dns.message.Message.from_bytes(second)
+        self.assertEqual(2, response.header.ident)
+        self.assertEqual(["131.174.78.60", "131.174.78.61"], sorted(record.rdata.data for record in response.answers))
+
+    def testOtherCatalogMisses(self):
+        self.ask(1)
+        zone = dns.zone.Zone()
+        zone.load_and_parse(TestMasterFile.MASTER_FILE.replace("131.174.78.61", "131.174.78.62"))
+        response = dns.message.Message.from_bytes(self.ask(2, catalog=self.catalog.with_zone("ru.nl", zone)))
+        self.assertEqual(0, self.responses.hits)
+        self.assertEqual(["131.174.78.60", "131.174.78.62"], sorted(record.rdata.data for record in response.answers))
+
+    def testEviction(self):
+        self.responses = dns.responsecache.ResponseCache(max_entries=1)
+        self.ask(1, "www.ru.nl")
+        self.ask(2, "ns1.ru.nl")
+        self.assertEqual(1, len(self.responses))
+        self.ask(3, "www.ru.nl")
+        self.assertEqual(0, self.responses.hits)
+
+
+class TestParser(unittest.TestCase):
+    def setUp(self):
+        header = dns.message.Header(42, 0, 1, 1, 0, 0)
+        question = dns.message.Question("www.cs.ru.nl", dns.rtypes.Type.CNAME, dns.classes.Class.IN)
+        answer = dns.resource.ResourceRecord("www.cs.ru.nl", dns.rtypes.Type.CNAME, dns.classes.Class.IN, 60,\
+                dns.resource.CNAMERecordData("web.ru.nl"))
+        self.packet = dns.message.Message(header, [question], [answer]).to_bytes()
+
+    def testCompressedNames(self):
+        message = dns.message.Message.from_bytes(self.packet)
+        self.assertEqual("www.cs.ru.nl", message.questions[0].qname)
+        self.assertEqual("www.cs.ru.nl", message.answers[0].name)
+        self.assertEqual("web.ru.nl", message.answers[0].rdata.data)
+        #The answer points back at the question and the alias at a suffix of it
+        self.assertEqual(len(self.packet), 12 + 14 + 4 + 2 + 10 + 6)
+
+    def testPointerLoop(self):
+        packet = self.packet[:12] + b"\xc0\x0c" + self.packet[14:]
+        self.assertRaises(dns.domainname.ParseError, dns.message.Message.from_bytes, packet)
+        packet = self.packet[:12] + b"\x03www\xc0\x10" + self.packet[18:]
+        self.assertRaises(dns.domainname.ParseError, dns.message.Message.from_bytes, packet)
+
+    def testTruncated(self):
+        for size in range(len(self.packet)):
+            self.assertRaises(dns.domainname.ParseError, dns.message.Message.from_bytes, self.packet[:size])
+
+    def testShortHeader(self):
+        self.assertRaises(dns.message.ShortHeader, dns.message.Message.from_bytes, b"\x00" * 11)
+
+    def testCorruptRecordData(self):
+        query = dns.message.Message(dns.message.Header(42, 0, 1, 1, 0, 0), [dns.message.Question("ru.nl",\
+                dns.rtypes.Type.A, dns.classes.Class.IN)]).to_bytes()
+        def packet(type_, rdata, rdlength=None):
+            rdlength = len(rdata) if rdlength is None else rdlength
+            return query + b"\xc0\x0c" + struct.pack("!HHIH", type_, dns.classes.Class.IN, 60, rdlength) + rdata
+        self.assertEqual("1.2.3.4", dns.message.Message.from_bytes(packet(dns.rtypes.Type.A, b"\x01\x02\x03\x04"))\
+                .answers[0].rdata.data)
+        soa = b"\x03ns1\xc0\x0c\xc0\x0c" + struct.pack("!5I", 1, 2, 3, 4, 5)
+        for corrupt in [packet(dns.rtypes.Type.A, b"\x01\x02\x03"), packet(dns.rtypes.Type.AAAA, b"\x00" * 15),\
+                packet(dns.rtypes.Type.SOA, soa[:-1]), packet(dns.rtypes.Type.SOA, soa, len(soa) - 4),\
+                packet(dns.rtypes.Type.CNAME, b"\x03www\xc0\x0c", 5)]:
+            self.assertRaises(dns.domainname.ParseError, dns.message.Message.from_bytes, corrupt)
+
+
+class TestPoolEngine(unittest.TestCase):
+    class Handler(object):
+        def __init__(self, handled, fail=False):
+            self.handled = handled
+            self.fail = fail
+
+        def run(self):
+            self.handled.append(self)
+            if self.fail:
+                raise ValueError("broken request")
+
+    def setUp(self):
+        self.server = dns.server.Server(0, False, 0, engine="pool", pool_size=2, queue_size=2, response_cache=0)
+        self.address = ("127.0.0.1", self.server.socket.getsockname()[1])
+
+    def tearDown(self):
+        if not self.server.done:
+            self.server.shutdown()
+
+    def testRequestsAreAnsweredByWorkers(self):
+        serving = Thread(target=self.server.serve)
+        serving.daemon = True
+        serving.start()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(2)
+        for ident in range(5):
+            query = dns.message.Message(dns.message.Header(ident, 0, 1, 0, 0, 0),\
+                    [dns.message.Question("ru.nl", dns.rtypes.Type.A, dns.classes.Class.IN)])
+            client.sendto(query.to_bytes(), self.address)
+            response = dns.message.Message.from_bytes(client.recv(1024))
+            self.assertEqual(ident, response.header.ident)
+            self.assertEqual(["131.174.78.60"], [answer.rdata.data for answer in response.answers])
+
+        workers = self.server.workers
+        self.server.shutdown()
+        #Wake the main loop, which is waiting for the next datagram
+        client.sendto(b"wake up", self.address)
+        client.close()
+        serving.join(1)
+        for worker in workers:
+            worker.join(1)
+
+        self.assertEqual(2, len(workers))
+        self.assertFalse(serving.is_alive())
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+
+    def testFullQueueDropsRequests(self):
+        handled = []
+        handlers = [self.Handler(handled, fail=True), self.Handler(handled), self.Handler(handled)]
+        for handler in handlers:
+            self.server.dispatch(handler)
+        self.assertEqual(1, self.server.dropped)
+
+        #A failing request does not stop the worker, the sentinel does
+        worker = Thread(target=self.server.work)
+        worker.start()
+        self.server.queue.put(None)
+        worker.join(1)
+
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(handlers[:2], handled)
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = dns.server.Supervisor(2, 0, False, 0)
+        self.spawned = []
+        self.stopped = []
+        def spawn(index):
+            pid = 1000 + len(self.spawned)
+            self.spawned.append(index)
+            self.supervisor.pids[pid] = index
+            self.supervisor.started[index] = 0
+        self.supervisor.spawn = spawn
+        self.supervisor.stop = lambda: self.stopped.append(dict(self.supervisor.pids))
+        self.wait = os.wait
+        self.sighup = signal.getsignal(signal.SIGHUP)
+
+    def tearDown(self):
+        os.wait = self.wait
+        signal.signal(signal.SIGHUP, self.sighup)
+
+    def testDeadWorkersAreRespawned(self):
+        exits = [(1001, 256), OSError(errno.EINTR, "interrupted"), (4242, 0), (1000, 9), KeyboardInterrupt()]
+        def wait():
+            result = exits.pop(0)
+            if isinstance(result, BaseException):
+                raise result
+            return result
+        os.wait = wait
+        self.supervisor.serve()
+
+        #Worker 1 and then worker 0 die, the unknown child and the signal are ignored
+        self.assertEqual([0, 1, 1, 0], self.spawned)
+        self.assertEqual([{1002: 1, 1003: 0}], self.stopped)
+
+    def testWorkersShareThePort(self):
+        first = dns.server.Server(0, False, 0, reuse_port=True)
+        second = dns.server.Server(first.socket.getsockname()[1], False, 0, reuse_port=True)
+        self.assertEqual(first.socket.getsockname()[1], second.socket.getsockname()[1])
+        first.shutdown()
+        second.shutdown()
+
+
 class TestServer(unittest.TestCase):
     def setUp(self):
         self.resolver = dns.resolver.Resolver(5, False, 10)
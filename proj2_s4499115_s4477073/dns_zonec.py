@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+""" DNS zone compiler
+
+This script compiles a zone master file into a binary image that the server
+memory-maps at startup instead of parsing the master file.
+"""
+
+import os
+import time
+
+import dns.consts as Consts
+import dns.zone
+import dns.zoneimage
+
+if __name__ == "__main__":
+    # Parse arguments
+    import argparse
+    parser = argparse.ArgumentParser(description="DNS Zone Compiler")
+    parser.add_argument("master_file", help="master file of the zone", nargs='?', type=str,
+            default=Consts.ZONE_FILE)
+    parser.add_argument("-o", "--output", metavar="FILE", type=str, default=None,
+            help="image file (default: the master file with extension .img)")
+    parser.add_argument("--origin", metavar="NAME", type=str, default=None,
+            help="origin of the zone (default: $ORIGIN or the owner of the SOA record)")
+    args = parser.parse_args()
+    output = args.output or os.path.splitext(args.master_file)[0] + ".img"
+
+    # Parse the master file
+    zone = dns.zone.Zone(args.origin)
+    zone.read_master_file(args.master_file)
+
+    # Write the image
+    started = time.time()
+    dns.zoneimage.write_image(output, zone, dns.zoneimage.checksum(args.master_file))
+    print("[+] - Wrote {0} records to {1} ({2} bytes) in {3:.2f} s".format(
+            zone.count, output, os.path.getsize(output), time.time() - started))